@@ -0,0 +1,268 @@
+'''
+This module contains classes for caching datastore entities across and within
+requests.
+'''
+import google.appengine.ext.db as db
+import google.appengine.api.memcache as memcache
+from google.appengine.datastore import entity_pb
+import time
+
+namespace = 'he3'
+
+#the number of times bump_generation() has been called for each kind in this
+#process
+_bump_counts = {}
+
+class EntityCache(object):
+	'''
+	This class resolves datastore keys to entities through three tiers: a
+	request-local dictionary, then memcache, then a single batched db.get()
+	for any keys still missing. Entities retrieved from the datastore are
+	written back to memcache and the local dictionary so later lookups for the
+	same keys are cheaper.
+
+	USAGE:
+
+	Create one EntityCache per request and share it between the objects that
+	need to resolve keys:
+
+	myCache = EntityCache()
+	myEntities = myCache.get(myKeys)
+
+	The entities are returned in the same order as the keys. None is returned
+	in place of any key that does not exist in the datastore.
+
+	PagedQuery uses an EntityCache to resolve the keys of a keys-only page
+	query:
+
+	myPagedQuery = PagedQuery(myQuery, 10, entity_cache=myCache)
+
+	Any object with a get() method matching that of EntityCache can be used
+	in its place.
+
+	Data Updates: Cached entities are not refreshed when they are changed in
+	the datastore. Call delete() with the keys of changed entities to remove
+	them from the cache.
+	'''
+
+	def __init__(self, time=0):
+		'''
+		Constructor for an EntityCache.
+		@param time: the number of seconds entities are kept in memcache, as
+		per memcache.set(). 0 (the default) means no expiry.
+		'''
+		self._time = time
+		self._local = {}
+
+		self._num_local_hits = 0
+		self._num_memcache_hits = 0
+		self._num_datastore_gets = 0
+
+	def get(self, keys):
+		'''Returns the entities for a list of keys, in the same order as the
+		keys
+		@param keys: A list of db.Key objects or string encoded keys
+		@return: A list of entities. None is returned in place of any key that
+		does not exist in the datastore
+		'''
+		str_keys = [str(k) for k in keys]
+		missing = [k for k in set(str_keys) if not self._local.has_key(k)]
+		self._num_local_hits += len(str_keys) - len(missing)
+
+		if missing:
+			cached = memcache.Client().get_multi(missing,
+												key_prefix=self._key_prefix())
+			self._local.update(
+						zip(cached.keys(), deserialize_entities(cached.values())))
+			self._num_memcache_hits += len(cached)
+			missing = [k for k in missing if not self._local.has_key(k)]
+
+		if missing:
+			found = dict((str(e.key()), e) for e in db.get(missing)
+						if e is not None)
+			self._num_datastore_gets += 1
+			self._local.update(found)
+			memcache.Client().set_multi(
+						dict(zip(found.keys(), serialize_entities(found.values()))),
+						time=self._time, key_prefix=self._key_prefix())
+
+		return [self._local.get(k) for k in str_keys]
+
+	def delete(self, keys):
+		'''Removes the entities for a list of keys from the cache, both locally
+		and in memcache
+		@param keys: A list of db.Key objects or string encoded keys
+		@return: nothing
+		'''
+		str_keys = [str(k) for k in keys]
+		for k in str_keys:
+			if self._local.has_key(k): del self._local[k]
+		memcache.Client().delete_multi(str_keys, key_prefix=self._key_prefix())
+
+	def clear(self):
+		'''Clears the request-local tier of the cache. Entities cached in
+		memcache are not affected.
+		@return: nothing
+		'''
+		self._local = {}
+
+	def _key_prefix(self):
+		'''Returns the prefix applied to all memcache keys used by the cache
+		@return: A string memcache key prefix
+		'''
+		return namespace + '_EntityCache_'
+
+
+class LRUCache(object):
+	'''
+	This class is a bounded in-process cache. Once max_size values are held,
+	setting a new value discards the least recently used one. A module level
+	LRUCache is shared by every request served by the same instance.
+	
+	myCache = LRUCache(100)
+	myCache.set('key', 'value')
+	value = myCache.get('key')
+	'''
+	
+	def __init__(self, max_size):
+		'''
+		Constructor for an LRUCache.
+		@param max_size: the positive non-zero maximum number of values held
+		'''
+		self.max_size = max_size
+		self._values = {}
+		self._order = []
+	
+	def get(self, key, default=None):
+		'''Returns a cached value, marking it as the most recently used
+		@param key: the key of the value
+		@param default: the value to return if the key is not cached
+		@return: the cached value or default
+		'''
+		if not self._values.has_key(key): return default
+		self._order.remove(key)
+		self._order.append(key)
+		return self._values[key]
+	
+	def set(self, key, value):
+		'''Caches a value as the most recently used, discarding the least 
+		recently used value if the cache is full
+		@param key: the key of the value
+		@param value: the value to cache
+		@return: nothing
+		'''
+		if self._values.has_key(key): self._order.remove(key)
+		self._values[key] = value
+		self._order.append(key)
+		while len(self._order) > self.max_size:
+			del self._values[self._order.pop(0)]
+	
+	def delete(self, key):
+		'''Removes a value from the cache, if present
+		@param key: the key of the value
+		@return: nothing
+		'''
+		if self._values.has_key(key):
+			del self._values[key]
+			self._order.remove(key)
+	
+	def clear(self):
+		'''Removes all values from the cache
+		@return: nothing
+		'''
+		self._values = {}
+		self._order = []
+
+
+class GenerationalModel(db.Model):
+	'''
+	This class is a base for models whose kind generation (see 
+	get_generation()) changes whenever one of its entities is written. Caches
+	keyed by the generation, such as the PagedQuery page cache, are then never
+	stale:
+	
+	class Post(GenerationalModel):
+		...
+	
+	Entities written with the module level db.put() and db.delete() functions
+	do not change the generation. Call bump_generation() after using them.
+	'''
+	
+	def put(self):
+		'''Writes the entity to the datastore as per db.Model.put(), then 
+		changes the generation of its kind
+		@return: the key of the entity
+		'''
+		key = super(GenerationalModel, self).put()
+		bump_generation(self.kind())
+		return key
+	
+	def delete(self):
+		'''Deletes the entity from the datastore as per db.Model.delete(), then
+		changes the generation of its kind
+		@return: nothing
+		'''
+		super(GenerationalModel, self).delete()
+		bump_generation(self.kind())
+
+
+def get_generation(kind):
+	'''Returns the current generation of a kind. The generation is a number 
+	held in memcache that changes whenever bump_generation() is called for the
+	kind. If memcache has lost the generation, a new one is started from the
+	current time, so that earlier generations are not reused.
+	@param kind: a string kind
+	@return: an integer generation
+	'''
+	key = _get_generation_key(kind)
+	generation = memcache.get(key)
+	if generation is None:
+		generation = int(time.time() * 1000)
+		if not memcache.add(key, generation):
+			#another request started a generation first
+			generation = memcache.get(key) or generation
+	return generation
+
+def bump_generation(kind):
+	'''Changes the generation of a kind, so that anything cached against the
+	previous generation is no longer used
+	@param kind: a string kind
+	@return: nothing
+	'''
+	#a generation lost from memcache is restarted by get_generation()
+	memcache.incr(_get_generation_key(kind))
+	_bump_counts[kind] = _bump_counts.get(kind, 0) + 1
+
+def get_bump_count(kind):
+	'''Returns the number of times bump_generation() has been called for a 
+	kind in this process, so that a generation read earlier can be reused 
+	until it changes
+	@param kind: a string kind
+	@return: an integer count
+	'''
+	return _bump_counts.get(kind, 0)
+
+def _get_generation_key(kind):
+	'''Returns the memcache key the generation of a kind is held under
+	@param kind: a string kind
+	@return: a string memcache key
+	'''
+	return namespace + '_generation_' + kind
+
+def serialize_entities(entities):
+	'''Serializes a list of model instances to a list of encoded entity
+	protobufs, a cheaper and more compact form to store in memcache than a
+	pickled model instance. None values are preserved.
+	@param entities: A list of db.Model instances
+	@return: A list of strings
+	'''
+	return [db.model_to_protobuf(e).Encode() if e is not None else None
+			for e in entities]
+
+def deserialize_entities(data):
+	'''Rebuilds model instances from a list produced by serialize_entities()
+	@param data: A list of encoded entity protobuf strings
+	@return: A list of db.Model instances
+	'''
+	return [db.model_from_protobuf(entity_pb.EntityProto(d))
+			if d is not None else None for d in data]
@@ -0,0 +1,283 @@
+'''
+This module contains classes for counting datastore entities without
+scanning query indexes. Totals are kept in sharded counter entities and
+cached in memcache.
+'''
+import google.appengine.ext.db as db
+import google.appengine.api.memcache as memcache
+from google.appengine.ext import deferred
+import hashlib
+import random
+
+from he3.db.tower.paging import canonical_form
+
+namespace = 'he3'
+
+class CounterShard(db.Model):
+	'''A single shard of a ShardedCounter. The key name of each shard is the
+	counter name followed by the shard index.'''
+
+	name = db.StringProperty(required=True)
+	count = db.IntegerProperty(required=True, default=0)
+
+
+class ShardedCounter(object):
+	'''
+	This class is a counter whose total is split across a number of
+	CounterShard entities, so that frequent updates do not contend on a single
+	entity. The total is cached in memcache and kept up to date as the counter
+	is incremented.
+
+	USAGE:
+
+	myCounter = ShardedCounter('my-counter')
+	myCounter.increment()
+	myCounter.increment(-1)
+	total = myCounter.count()
+
+	The number of shards must not change once a counter is in use, otherwise
+	the counts held in the dropped shards are lost.
+	'''
+
+	num_shards = 20
+	cache_time = 3600
+
+	def __init__(self, name):
+		'''
+		Constructor for a ShardedCounter.
+		@param name: a string uniquely naming the counter
+		'''
+		self.name = name
+
+	def increment(self, delta=1):
+		'''Adds to the counter. A single randomly chosen shard is updated in a
+		transaction and the cached total adjusted.
+		@param delta: the integer amount to add. May be negative
+		@return: nothing
+		'''
+		key_name = self._get_shard_key_names()[
+									random.randint(0, self.num_shards - 1)]
+		def txn():
+			shard = CounterShard.get_by_key_name(key_name)
+			if shard is None:
+				shard = CounterShard(key_name=key_name, name=self.name)
+			shard.count += delta
+			shard.put()
+		db.run_in_transaction(txn)
+
+		#adjusting the cached total is a no-op if it is not cached
+		if delta > 0: memcache.incr(self._get_memcache_key(), delta)
+		elif delta < 0: memcache.decr(self._get_memcache_key(), -delta)
+
+	def count(self):
+		'''Returns the total of the counter. The cached total is used if
+		available, otherwise the shards are retrieved in a single batch and
+		summed.
+		@return: an integer total
+		'''
+		total = memcache.get(self._get_memcache_key())
+		if total is None:
+			shards = CounterShard.get_by_key_name(self._get_shard_key_names())
+			total = sum([s.count for s in shards if s is not None])
+			memcache.add(self._get_memcache_key(), total, self.cache_time)
+		return total
+
+	def _get_shard_key_names(self):
+		'''Returns the key names of all shards of the counter
+		@return: a list of strings
+		'''
+		return ['%s-%d' % (self.name, i) for i in range(self.num_shards)]
+
+	def _get_memcache_key(self):
+		'''Returns the memcache key the total of the counter is cached under
+		@return: a string memcache key
+		'''
+		return namespace + '_ShardedCounter_' + self.name
+
+
+class CountedModel(db.Model):
+	'''
+	This class is a base for models whose totals are kept in sharded counters.
+	A total is kept for each 'query shape' listed in the counted_filters
+	class attribute. A shape is a tuple of property names; its counters hold
+	the number of entities having each combination of values of those
+	properties. The empty tuple counts all entities of the kind:
+
+	class Post(CountedModel):
+		counted_filters = ((), ('topic',), ('author', 'status'))
+
+	The counters are updated by put() and delete() on model instances, and
+	can then be retrieved with get_counter():
+
+	num_posts = get_counter(Post, topic=myTopic).count()
+
+	Counters are updated after the entity is written. Within a transaction, 
+	they are instead updated by a task (see google.appengine.ext.deferred) 
+	added transactionally, so only if the transaction commits; the deferred
+	builtin must be enabled in app.yaml. 
+	A new instance put over a stored entity of the same key name is
+	counted as a change to that entity, which costs a datastore get when 
+	such an instance is first put or deleted. Pass new=True to put() to skip
+	it for an entity known not to be stored yet. Entities written with the 
+	module level db.put() and db.delete() functions are not counted.
+	'''
+
+	counted_filters = ((),)
+
+	def __init__(self, parent=None, key_name=None, _app=None, _from_entity=False
+				, **kwds):
+		super(CountedModel, self).__init__(parent, key_name, _app, _from_entity,
+										**kwds)
+		#remember the counters that include the stored entity
+		self._counted_names = _from_entity and self._get_counter_names() or None
+
+	def put(self, new=False):
+		'''Writes the entity to the datastore as per db.Model.put(), then moves
+		the entity between counters for any query shape whose values have
+		changed.
+		@param new: True if the entity is known not to be stored yet, so no
+		stored entity of the same key name need be looked up
+		@return: the key of the entity
+		'''
+		if self._counted_names is None and not new:
+			self._counted_names = self._get_stored_counter_names()
+		key = super(CountedModel, self).put()
+
+		new_names = self._get_counter_names()
+		old_names = self._counted_names or [None] * len(new_names)
+		increments = []
+		for (old_name, new_name) in zip(old_names, new_names):
+			if old_name != new_name:
+				if old_name: increments.append((old_name, -1))
+				increments.append((new_name, 1))
+		_apply_increments(increments)
+
+		self._counted_names = new_names
+		return key
+
+	def delete(self):
+		'''Deletes the entity from the datastore as per db.Model.delete(),
+		then removes it from the counters that included it.
+		@return: nothing
+		'''
+		if self._counted_names is None:
+			self._counted_names = self._get_stored_counter_names()
+		super(CountedModel, self).delete()
+
+		_apply_increments([(name, -1) for name in self._counted_names or []])
+		self._counted_names = None
+
+	def _get_stored_counter_names(self):
+		'''Returns the names of the counters including the stored entity with
+		the same key as this new instance, if there is one, as happens when
+		an instance is created with the key name of an existing entity
+		@return: a list of strings, or None if no entity is stored
+		'''
+		try:
+			key = self.key()
+		except db.NotSavedError:
+			#a key is only allocated once the entity is first put
+			return None
+		stored = self.get(key)
+		return stored and stored._counted_names
+
+	def _get_counter_names(self):
+		'''Returns the names of the counters including the entity, one per
+		query shape in counted_filters
+		@return: a list of strings
+		'''
+		properties = self.properties()
+		counted = set([name for shape in self.counted_filters 
+					for name in shape])
+		#converting to and from the datastore form gives the values used in 
+		#filters, with references as keys rather than dereferenced entities
+		values = dict((name, properties[name].make_value_from_datastore(
+							properties[name].get_value_for_datastore(self)))
+					for name in counted)
+		return [counter_name(self.kind(), 
+							dict((p, values[p]) for p in shape)) 
+				for shape in self.counted_filters]
+
+
+def _apply_increments(increments):
+	'''Increments counters now, or if called within a transaction, in a task
+	added transactionally, so that the counters only change if the 
+	transaction commits. Counters can not be incremented directly within 
+	another transaction, as each increment is its own transaction.
+	@param increments: a list of tuples of counter name and integer delta
+	@return: nothing
+	'''
+	if not increments: return
+	if db.is_in_transaction():
+		deferred.defer(_increment_counters, increments, _transactional=True)
+	else:
+		_increment_counters(increments)
+
+def _increment_counters(increments):
+	'''Increments counters, as deferred by _apply_increments()
+	@param increments: a list of tuples of counter name and integer delta
+	@return: nothing
+	'''
+	for (name, delta) in increments:
+		ShardedCounter(name).increment(delta)
+
+def counter_name(kind, filters):
+	'''Returns the name of the counter holding the number of entities of a
+	kind matching a set of equality filters
+	@param kind: the string kind of the entities
+	@param filters: a dictionary of property names and values
+	@return: a string counter name
+	'''
+	return 'count_%s_%s' % (kind,
+						hashlib.sha1(canonical_form(filters)).hexdigest())
+
+def get_counter(model_class, **filters):
+	'''Returns the counter holding the number of entities of a CountedModel
+	subclass matching a set of equality filters.
+
+	Eg. get_counter(Post, topic=myTopic) counts Post.all().filter('topic =',
+	myTopic)
+	@param model_class: a subclass of CountedModel
+	@param filters: the properties and values of the equality filters
+	@return: a ShardedCounter
+	@raise TypeError: raised if the filtered properties are not a query shape
+	listed in the counted_filters attribute of model_class
+	'''
+	if sorted(filters.keys()) not in [sorted(shape) for shape
+									in model_class.counted_filters]:
+		raise TypeError('Filters not counted for %s: %s' %
+					(model_class.kind(), ', '.join(filters.keys())))
+
+	return ShardedCounter(counter_name(model_class.kind(), filters))
+
+def get_query_counter(query):
+	'''Returns the counter holding the number of results of a db.Query of a 
+	CountedModel subclass, which may only have equality filters, on the 
+	properties of a shape listed in counted_filters.
+	
+	Eg. get_query_counter(Post.all().filter('topic =', myTopic)) returns
+	get_counter(Post, topic=myTopic)
+	@param query: a db.Query
+	@return: a ShardedCounter
+	@raise TypeError: raised if the query is not a db.Query of a CountedModel
+	subclass, has an ancestor or a filter other than an equality filter, or 
+	its filters are not a counted shape
+	'''
+	if not isinstance(query, db.Query) or not query._model_class\
+		or not issubclass(query._model_class, CountedModel):
+		raise TypeError('Only queries of CountedModel subclasses are counted')
+	query_sets = query._Query__query_sets
+	if query._Query__ancestor or len(query_sets) != 1:
+		raise TypeError('Queries with ancestors, IN or != filters are not '\
+			'counted')
+	
+	filters = {}
+	for (property_operator, value) in query_sets[0].items():
+		parts = property_operator.split()
+		if len(parts) == 2 and parts[1] not in ('=', '=='):
+			raise TypeError('Only equality filters are counted: '\
+				+ property_operator)
+		#filters on references may be given entities rather than keys
+		if isinstance(value, db.Model): value = value.key()
+		filters[parts[0]] = value
+	return get_counter(query._model_class, **filters)
@@ -0,0 +1,157 @@
+'''
+This module contains classes for collecting statistics about how queries are
+run, aggregated across requests.
+'''
+import google.appengine.api.memcache as memcache
+from django.utils import simplejson
+import logging
+import time
+
+namespace = 'he3'
+
+class QueryStats(object):
+	'''
+	This class aggregates statistics reported for queries, keyed by query
+	fingerprint (see he3.db.tower.paging.query_fingerprint()). Reports are
+	held in an in-process ring buffer of buffer_size reports, which is flushed
+	into totals held in memcache whenever it fills or flush_interval seconds
+	have passed since it was last flushed. The totals therefore combine the
+	reports of every request served by every instance, less those not yet
+	flushed elsewhere. Totals that cannot be flushed within cas_retries 
+	compare-and-set attempts are kept in-process and added by the next flush.
+
+	USAGE:
+
+	Report the statistics of a query as a dictionary of named numbers:
+
+	myStats = QueryStats('my-stats')
+	myStats.record(query_fingerprint(myQuery), {'offset_queries':1})
+
+	Retrieve the totals for each fingerprint, or dump them as JSON from a
+	handler:
+
+	totals = myStats.get_stats()
+	self.response.out.write(myStats.to_json())
+
+	Each fingerprint's totals include 'reports', the number of reports made
+	for it. PagedQuery reports to he3.db.tower.paging.paged_query_stats.
+
+	As with anything held in memcache, the totals may be lost at any time.
+	'''
+
+	buffer_size = 100
+	flush_interval = 60
+	cas_retries = 3
+
+	def __init__(self, name):
+		'''
+		Constructor for a QueryStats.
+		@param name: a string uniquely naming the statistics
+		'''
+		self.name = name
+		self._buffer = [None] * self.buffer_size
+		self._next = 0
+		self._unflushed = {}
+		self._last_flush = time.time()
+
+		self._num_flushes = 0
+
+	def record(self, fingerprint, stats):
+		'''Adds a report for a query to the ring buffer, flushing the buffer
+		if required
+		@param fingerprint: the string fingerprint of the query
+		@param stats: a dictionary of statistic names and numbers to add to
+		the query's totals
+		@return: nothing
+		'''
+		self._buffer[self._next] = (fingerprint, stats)
+		self._next = (self._next + 1) % len(self._buffer)
+		if self._next == 0\
+			or time.time() - self._last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		'''Adds the reports in the ring buffer to the totals held in memcache,
+		using a compare-and-set so that concurrent flushes are not lost, and
+		empties the buffer. If every attempt fails, the totals are kept to be
+		added by the next flush.
+		@return: nothing
+		'''
+		buffered = _add_totals(self._get_buffered_totals(), self._unflushed)
+		self._unflushed = {}
+		self._buffer = [None] * len(self._buffer)
+		self._next = 0
+		self._last_flush = time.time()
+		if not buffered: return
+
+		key = self._get_memcache_key()
+		client = memcache.Client()
+		for attempt in range(self.cas_retries):
+			stored = client.gets(key)
+			if stored is None:
+				if client.add(key, buffered): break
+			elif client.cas(key, _add_totals(stored, buffered)): break
+		else:
+			logging.warning('Could not flush QueryStats %s, keeping %d queries '
+						'for the next flush', self.name, len(buffered))
+			self._unflushed = buffered
+			return
+		self._num_flushes += 1
+
+	def get_stats(self):
+		'''Returns the totals of each query, including reports not yet
+		flushed from the ring buffer
+		@return: a dictionary of fingerprints and dictionaries of statistic
+		names and totals
+		'''
+		stored = memcache.Client().get(self._get_memcache_key()) or {}
+		_add_totals(stored, self._unflushed)
+		return _add_totals(stored, self._get_buffered_totals())
+
+	def to_json(self):
+		'''Returns the totals of each query as per get_stats(), as JSON
+		@return: a string
+		'''
+		return simplejson.dumps(self.get_stats(), sort_keys=True)
+
+	def clear(self):
+		'''Discards the totals held in memcache and in-process, and empties
+		the ring buffer, sizing it from buffer_size again
+		@return: nothing
+		'''
+		memcache.Client().delete(self._get_memcache_key())
+		self._buffer = [None] * self.buffer_size
+		self._next = 0
+		self._unflushed = {}
+
+	def _get_buffered_totals(self):
+		'''Returns the totals of the reports held in the ring buffer
+		@return: a dictionary of fingerprints and dictionaries of statistic
+		names and totals
+		'''
+		totals = {}
+		for report in self._buffer:
+			if report is None: continue
+			(fingerprint, stats) = report
+			_add_totals(totals, {fingerprint:dict(stats, reports=1)})
+		return totals
+
+	def _get_memcache_key(self):
+		'''Returns the memcache key the totals are held under
+		@return: a string memcache key
+		'''
+		return namespace + '_QueryStats_' + self.name
+
+
+def _add_totals(totals, more_totals):
+	'''Adds one set of totals to another
+	@param totals: a dictionary of fingerprints and dictionaries of statistic
+	names and totals, which is updated
+	@param more_totals: a dictionary of the same form to add
+	@return: totals
+	'''
+	for (fingerprint, stats) in more_totals.items():
+		query_totals = totals.setdefault(fingerprint, {})
+		for (name, value) in stats.items():
+			query_totals[name] = query_totals.get(name, 0) + value
+	return totals
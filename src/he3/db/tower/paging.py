@@ -3,11 +3,72 @@ This module contains classes for managing paging.
 '''
 import google.appengine.ext.db as db
 import google.appengine.api.memcache as memcache
+from google.appengine.api import datastore
+import base64
+import datetime
+import hashlib
+import heapq
+import hmac
 import logging
 import pickle
+import struct
+import time
+import zlib
+
+from he3.db.tower.caching import serialize_entities, deserialize_entities,\
+	get_generation, get_bump_count, LRUCache
+from he3.db.tower.monitoring import QueryStats
 
 namespace = 'he3'
 
+#persisted forms of recently used queries, shared by all requests served by
+#this instance
+_local_states = LRUCache(100)
+
+#the encoding of persisted forms and the types of cursor held within them
+_persisted_form_version = 2
+_cursor_none = 0
+_cursor_base64 = 1
+_cursor_raw = 2
+
+#the separator of the sub-query cursors within a merged query's cursor, the
+#cursor of a sub-query with no more results, and the separator of a 
+#sub-query's cursor and the number of results to skip after it
+_cursor_separator = ' '
+_cursor_exhausted = '!'
+_cursor_offset_separator = ':'
+
+#the length of the signature of a bookmark
+_bookmark_signature_length = 12
+
+#the filter operators the datastore sorts results by the property of first
+_inequality_operators = ('<', '<=', '>', '>=')
+
+#statistics reported by every PagedQuery, aggregated across requests
+paged_query_stats = QueryStats('PagedQuery')
+
+def _timed(category):
+	'''Returns a decorator for PagedQuery methods that adds the wall-clock 
+	time taken by each call to the instance's total for a category. Time
+	spent in timed calls made by the method is left to their own categories.
+	@param category: 'datastore', 'memcache' or 'entity_cache'
+	@return: a decorator
+	'''
+	def decorator(method):
+		def timed_method(self, *args, **kwds):
+			started = time.time()
+			self._nested_timings.append(0.0)
+			try:
+				return method(self, *args, **kwds)
+			finally:
+				elapsed = time.time() - started
+				self._timings[category] += elapsed - self._nested_timings.pop()
+				if self._nested_timings: self._nested_timings[-1] += elapsed
+		timed_method.__name__ = method.__name__
+		timed_method.__doc__ = method.__doc__
+		return timed_method
+	return decorator
+
 class PagedQuery(object):
 	'''
 	This class is a facade to a db.Query object that offers additional
@@ -47,6 +108,13 @@ class PagedQuery(object):
 	To fetch any particular page, use a page number:
 	myResults = myPagedQuery.fetch_page(3)
 	
+	To fetch the last page:
+	myResults = myPagedQuery.fetch_last_page()
+	
+	To walk through the pages in turn, such as in a background job:
+	for myResults in myPagedQuery.iter_pages():
+		...
+	
 	On a subsequent request, recreate the same query and PagedQuery object, and
 	request another page:
 	myResults = myPagedQuery.fetch_page(4)
@@ -57,13 +125,22 @@ class PagedQuery(object):
 	To get a count of the number of pages available with the dataset:
 	num_pages = myPagedQuery.page_count()
 	
+	To count the pages only as far as a limit, such as for page links:
+	num_pages = myPagedQuery.count_pages(11)
+	
+	The optional constructor arguments trade memcache or datastore calls for
+	fewer offset queries and counts; see __init__(). To page the union of 
+	several queries, use UnionPagedQuery, and to restore and persist several
+	PagedQuery objects together, use PagedQueryBatch.
+	
 	Some necessary implementation details: 
 	
 	Cursor Limits: This class works using the Cursor features introduced in the
 	Google App Engine SDK 1.3.1. All cursor restrictions apply. In particular
 	, pages will not re-order if changes are made to the query results prior 
-	to current page. Some query features (IN and != filters) will not work and
-	sorting on multi-value fields will be unreliable. 
+	to current page. Sorting on multi-value fields will be unreliable. Queries
+	with IN and != filters, which cursors do not support, are run as their 
+	sub-queries, each from its own cursor, and the results merged.
 	
 	See http://code.google.com/appengine/docs/python/datastore/queriesandindexes.html#Query_Cursors  
 	for more information 
@@ -77,7 +154,8 @@ class PagedQuery(object):
 	information cached includes a query identifier and a hash of pages and
 	cursors. Due to the unreliable nature of memcache, persistence can not be
 	ensured. PagedQuery will handle memcache misses, at a reduced
-	performance profile. 
+	performance profile. Cursors are held by result offset, so PagedQuery 
+	objects of any page size share those of the same query. 
 	
 	Data Updates: Because of the cached nature of the internal cursors, if you
 	need to ensure the most up to data is retrieve, clear all cached data:
@@ -94,24 +172,135 @@ class PagedQuery(object):
 	are checked for changes. If changes exist, the cursors corresponding to all
 	subsequent pages are cleared from the cache. 
 	'''
+	
+	#when checkpointing, the most checkpoints persisted before the interval 
+	#between them is doubled, and the number of recently used pages whose 
+	#cursors are persisted as well
+	max_checkpoints = 100
+	recent_page_limit = 10
+	#if non-zero, the encoded size in bytes the persisted form is kept within
+	#by leaving out the cursors of the pages with the fewest hits (see 
+	#_retain_cursors()), the interval between the pages whose cursors are 
+	#always kept, the seconds over which hits halve, the most pages whose 
+	#hits are kept, and the seconds within which a change of hits alone is
+	#not persisted again
+	max_persisted_size = 0
+	retention_interval = 10
+	hit_half_life = 3600
+	hit_page_limit = 100
+	hit_persist_interval = 60
+	#the seconds pages stored by look-ahead and by page_cache are kept for
+	lookahead_time = 60
+	page_cache_time = 3600
+	#the seconds the in-process copy of the persisted form is trusted before
+	#memcache is consulted again
+	local_state_time = 10
+	iter_persist_interval = 10
+	cas_retries = 3
+	#if set, statistics are reported to paged_query_stats (see get_stats()),
+	#at the cost of memcache calls
+	collect_stats = False
+	#the most results counted per keys-only query by count_all(), and the 
+	#seconds page_count() spends counting before settling for a lower bound
+	count_batch_size = 1000
+	count_deadline = 1
+	
+	#the statistics returned by get_stats(), held in _num_ attributes
+	_counted_stats = ('offset_queries', 'cursor_queries', 'page1_queries', 
+					'count_calls', 'persist', 'restore', 'local_restore', 
+					'prewalk_queries', 'counter_calls', 'lookahead_hits', 
+					'page_cache_hits', 'reverse_queries', 'cas_retries', 
+					'count_pages_queries', 'sub_queries', 'rebase_queries',
+					'count_batches')
 
-	def __init__(self, query, page_size):
+	def __init__(self, query, page_size, prewalk_budget=0, entity_cache=None,
+				checkpoint_interval=0, counter=None, lookahead=False,
+				page_cache=False, datastore_fallback=False, bookmark_secret=None,
+				count_ttl=None):
 		'''
 		Constructor for a paged query.
 		@param query: a google.appengine.ext.db.query object
 		@param page_size: a positive non-zero integer defining the size of 
 		each page.
+		@param prewalk_budget: the maximum number of keys-only queries to make
+		when walking forward to a page without a cursor, one page at a time 
+		from the nearest known cursor, rather than skipping the earlier 
+		results with an offset query. If the budget runs out, the page is 
+		fetched by offset from the furthest cursor reached. 0 (the default) 
+		disables pre-walking.
+		@param entity_cache: an object with a get() method resolving a list of
+		keys to a list of entities, such as he3.db.tower.caching.EntityCache. If
+		supplied, page queries are run keys-only and resolved through it, so
+		a facade such as PrefetchingQuery does not process the results.
+		@param checkpoint_interval: if non-zero, only the cursors of every
+		checkpoint_interval-th page (pages 1, k+1, 2k+1 ...) and of the 
+		recent_page_limit most recently used pages are persisted, and other
+		pages are fetched by a small offset from the nearest before them. 0 
+		(the default) persists every cursor.
+		@param counter: an object with a count() method returning the total
+		number of results of the query, such as a 
+		he3.db.tower.counting.ShardedCounter. If supplied, it is used instead
+		of counting the query results, and pages near the end of the results
+		are fetched in reverse (see fetch_last_page()). A ShardedCounter
+		given for a query of a CountedModel subclass must be the counter of 
+		that query (see he3.db.tower.counting.get_query_counter()).
+		@param lookahead: if True, each fetch_page() starts fetching the 
+		following page, to be stored by complete_lookahead()
+		@param page_cache: if True, page results are cached in memcache until
+		the generation of the query's kind changes (see 
+		he3.db.tower.caching.get_generation()), so stale pages are never 
+		served. The generation is read from memcache once per instance, and
+		again only after bump_generation() is called for the kind in the 
+		same process, so create a PagedQuery per request.
+		@param datastore_fallback: if True, persisted information is also
+		written to the datastore and restored from there on a memcache miss
+		@param bookmark_secret: if supplied, a string secret used to sign the 
+		bookmarks returned by get_bookmark(), in place of persisting any
+		information. No memcache calls are then made (other than by a 
+		counter), so lookahead and page_cache are ignored.
+		@param count_ttl: the number of seconds the number of results (or a 
+		lower bound on it) learned by counting or fetching pages is trusted
+		for, or None (the default) to trust it until the cache is cleared. 
+		If supplied, pages near the end of the results are fetched in 
+		reverse (see fetch_last_page()).
 		
 		@raise TypeError: raised if query is not an instance of db.Query or 
-		db.GqlQuery 
+		db.GqlQuery, or counter is not the counter of the query
 		'''
 		
 		self._query = query
+		self._keys_query = None
+		self._sub_queries = {}
 		self._page_size = page_size
+		self.entity_cache = entity_cache
+		self.counter = counter
+		self.lookahead = lookahead
+		self._lookahead = None
+		self.page_cache = page_cache
+		self._generations = {}
+		self.datastore_fallback = datastore_fallback
+		self.bookmark_secret = bookmark_secret
+		self.count_ttl = count_ttl
 		self._page_cursors = [None]
+		self._offset_cursors = {}
+		self._recent_pages = []
+		self._page_hits = {}
+		self._lookahead_offsets = {}
 		self._page_count = None
+		self._result_count = None
+		self._min_result_count = None
+		self._counted_at = None
+		self._count_approximate = False
+		self._walked_offsets = set()
+		self._retained_for = None
+		self._reverse_query = None
+		self._reverse_cursors = {}
 		self._id = None
 		self._last_persisted_as = None
+		self._restored = False
+		self._batch = None
+		self._memcache_client = None
+		self._cas_read = None
 
 		self._num_offset_queries = 0
 		self._num_cursor_queries = 0
@@ -119,6 +308,20 @@ class PagedQuery(object):
 		self._num_count_calls = 0
 		self._num_persist = 0
 		self._num_restore = 0
+		self._num_local_restore = 0
+		self._num_prewalk_queries = 0
+		self._num_counter_calls = 0
+		self._num_lookahead_hits = 0
+		self._num_page_cache_hits = 0
+		self._num_reverse_queries = 0
+		self._num_cas_retries = 0
+		self._num_count_pages_queries = 0
+		self._num_sub_queries = 0
+		self._num_rebase_queries = 0
+		self._num_count_batches = 0
+		self._timings = {'datastore':0.0, 'memcache':0.0, 'entity_cache':0.0}
+		self._nested_timings = []
+		self._reported_stats = {}
 		
 		#find out if we are dealing with another facade object
 		if query.__dict__.has_key('_query'): query_to_check = query._query
@@ -130,8 +333,11 @@ class PagedQuery(object):
 			 + type(query).__name__)
 		
 		self._check_page_size(page_size)
+		self._check_counter(query_to_check, counter)
+		self.prewalk_budget = prewalk_budget
+		self.checkpoint_interval = checkpoint_interval
 			
-	def fetch_page(self, page_number=1, clear=False):
+	def fetch_page(self, page_number=1, clear=False, bookmark=None):
 		'''Fetches a single page of results from the datastore. A page in the
 		datastore starts at a specific position equal to 
 		(page_size x page_number) - page_size (zero-based). If the page does
@@ -140,6 +346,8 @@ class PagedQuery(object):
 		@param page_number: The number of the page to return. If None or no
 		parameter is specified for page_number, page 1 is returned and cache
 		cleared. 
+		@param bookmark: A bookmark returned by get_bookmark() for the page (or
+		an earlier page), or None. Only used if a bookmark_secret is set.
 		@return: A list of all entities on the specified page.
 		'''
 		
@@ -150,61 +358,359 @@ class PagedQuery(object):
 			self._restore_if_required()	
 		
 		self._check_page_number(page_number)	
+		if bookmark: self._apply_bookmark(bookmark)
 
-		if self._has_cursor_for_page(page_number):
-			offset = 0
-			self._query.with_cursor(self._get_cursor_for_page(page_number))
-			self._num_cursor_queries += 1 
-		elif page_number > 1:
-			
-			#if we can not use a cursor, we need to use the offset method
-			#the offset method errors if it is out of range. Therefore:
-			#if page_number > 1 and page_number > self.page_count(): return []
-			
-			self._query.with_cursor(None)			
-			offset = (self.page_size * (page_number -1))
-			
-			#record that we did an offset query. Useful for testing
-			self._num_offset_queries += 1
-		else:
-			self._num_page1_queries += 1
-			self._query.with_cursor(None)
-			offset= 0
-
-		results = self.fetch(limit=self.page_size, offset=offset)
-		
-		self._update_cursors_with_results(page_number, results)
+		results = self._fetch_page(page_number)
+		if self.lookahead and not self.bookmark_secret\
+			and len(results) == self.page_size\
+			and self._has_cursor_for_page(page_number + 1)\
+			and not self._is_merged():
+			self._start_lookahead(page_number + 1)
 		
-		self._query.with_cursor(None)
 		self._persist_if_required()
+		self._report_stats()
 
+		#entities deleted since their keys were returned come back as None
+		return [r for r in results if r is not None]
+	
+	def iter_pages(self, start=1, stop=None):
+		'''Generates successive pages of results, moving forward from one page
+		to the next by cursor. The cursor of every page passed is recorded,
+		but persisted only every iter_persist_interval pages and once the
+		iteration ends, so walking a whole result set costs few memcache 
+		calls. Only one page of results is held at a time.
+		@param start: The number of the first page to generate
+		@param stop: The number of the page to stop before (as per range()),
+		or None to continue to the last page
+		@return: A generator of lists of the entities on each page. Empty 
+		pages are not generated.
+		'''
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		self._check_page_number(start)
+		
+		page_number = start
+		try:
+			while stop is None or page_number < stop:
+				results = self._fetch_page(page_number)
+				if not results: break
+				
+				yield [r for r in results if r is not None]
+				if len(results) < self.page_size: break
+				
+				page_number += 1
+				if (page_number - start) % self.iter_persist_interval == 0:
+					self._persist_if_required()
+		finally:
+			self._persist_if_required()
+			self._report_stats()
+	
+	def fetch_last_page(self):
+		'''Fetches the last page of results. The number of pages is found by
+		page_count(), and the page fetched in reverse if no cursor is known 
+		for it. 
+		
+		Once the number of results is known from a counter, or from counting 
+		when a count_ttl is supplied, any page without a cursor that is 
+		nearer the end of the results than the nearest cursor before it is 
+		fetched by running the query with every sort order reversed, and the
+		reversed query's cursors are kept to walk earlier pages backwards. 
+		This is only done for db.Query objects. The reversed orders end with
+		a descending __key__ order, which may need its own composite index, 
+		and a facade's processing is not applied to pages fetched in reverse.
+		@return: A list of all entities on the last page, or an empty list if
+		there are no results
+		'''
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		
+		page_count = self.page_count()
+		if not page_count: return []
+		return self.fetch_page(page_count)
+	
+	def get_bookmark(self, page_number):
+		'''Returns a bookmark for a page, holding its cursor and result offset
+		signed with the bookmark_secret, for fetch_page() to start from in a
+		later request, whatever its page size. Cursors are known for each page
+		fetched and the page following it.
+		@param page_number: The non-zero positive integer page number
+		@return: A URL-safe string bookmark, or None if the page is page 1 or 
+		no cursor is known for it
+		@raise TypeError: raised if no bookmark_secret is set
+		'''
+		if not self.bookmark_secret:
+			raise TypeError('Bookmarks require a bookmark_secret')
+		self._check_page_number(page_number)
+		if page_number == 1 or not self._has_cursor_for_page(page_number):
+			return None
+		
+		(cursor_type, data) = _pack_cursor(
+											self._get_cursor_for_page(page_number))
+		payload = struct.pack('>IB', self._page_offset(page_number), 
+							cursor_type) + data
+		bookmark = self._sign_bookmark(payload) + payload
+		return base64.urlsafe_b64encode(bookmark).rstrip('=')
+	
+	def get_stats(self):
+		'''Returns the statistics of the PagedQuery: the number of each kind
+		of query and persistence operation made, and the wall-clock seconds
+		spent in datastore, memcache and entity_cache calls. If collect_stats
+		is set, they are also reported to paged_query_stats, which aggregates
+		them by query id across requests, and can be dumped from a handler
+		to find which queries fall back to offset queries:
+		
+		self.response.out.write(paged_query_stats.to_json())
+		@return: a dictionary of statistic names and numbers
+		'''
+		stats = dict((name, getattr(self, '_num_' + name)) 
+					for name in self._counted_stats)
+		stats['datastore_time'] = self._timings['datastore']
+		stats['memcache_time'] = self._timings['memcache']
+		stats['entity_cache_time'] = self._timings['entity_cache']
+		return stats
+	
+	def _report_stats(self):
+		'''Reports the statistics gathered since the last report to 
+		paged_query_stats, if collect_stats is set
+		@return: nothing
+		'''
+		if not self.collect_stats: return
+		
+		stats = self.get_stats()
+		changes = dict((name, value - self._reported_stats.get(name, 0))
+					for (name, value) in stats.items())
+		self._reported_stats = stats
+		paged_query_stats.record(self.id, changes)
+	
+	def _fetch_page(self, page_number):
+		'''Fetches a single page of results and records what it reveals about
+		the cursors, without restoring or persisting the PagedQuery.
+		@param page_number: The non-zero positive integer page number
+		@return: A list of the results of the page, which may contain None
+		values for entities deleted since their keys were returned. An empty
+		list is returned if the page does not exist
+		'''
+		page_cache = self.page_cache and not self.bookmark_secret
+		page = page_cache and self._get_cached_page(page_number)
+		if page:
+			self._num_page_cache_hits += 1
+		else:
+			page = self._query_page(page_number)
+			if page is None:
+				#the walk ran out of results before reaching the page
+				return []
+			if page_cache: self._set_cached_page(page_number, page)
+		(results, end_cursor) = page
+		
+		self._update_cursors_with_results(page_number, results, end_cursor)
+		if self.checkpoint_interval:
+			self._touch_pages(page_number, page_number + 1)
+		if self.max_persisted_size:
+			self._record_page_hit(page_number)
 		return results
 	
+	@_timed('datastore')
+	def complete_lookahead(self):
+		'''Completes the look-ahead query started by the last fetch_page(), 
+		storing the results in memcache for the next fetch_page() of the 
+		following page. This waits for the query to finish, so should be 
+		called after the response for the current page has been produced. 
+		Nothing is done if no look-ahead query is pending.
+		@return: nothing
+		'''
+		if not self._lookahead: return
+		
+		(page_number, start_cursor, query, results) = self._lookahead
+		self._lookahead = None
+		
+		self._set_lookahead_page(page_number, {
+				'start_cursor':start_cursor,
+				'results':serialize_entities(list(results)),
+				'end_cursor':query.cursor()
+				})
+	
+	@_timed('memcache')
+	def _set_lookahead_page(self, page_number, page):
+		'''Stores the results of a completed look-ahead query in memcache
+		@param page_number: The page number the results belong to
+		@param page: A dictionary of the start cursor, serialized results and
+		end cursor of the page
+		@return: nothing
+		'''
+		memcache.Client().set(self._get_lookahead_key(page_number), page,
+							time=self.lookahead_time)
+	
 	def clear(self):
 		'''Clears the cached data for the current query'''
-		memcache.Client().delete(self._get_memcache_key())
+		if not self.bookmark_secret:
+			key = self._get_memcache_key()
+			_local_states.delete(key)
+			memcache.Client().delete(key)
+			if self.datastore_fallback:
+				db.delete(db.Key.from_path(PagedQueryState.kind(), key))
 		self._page_cursors = [None]
+		self._offset_cursors = {}
+		self._recent_pages = []
+		self._page_hits = {}
+		self._lookahead_offsets = {}
 		self._page_count = None
+		self._result_count = None
+		self._min_result_count = None
+		self._counted_at = None
+		self._count_approximate = False
+		self._walked_offsets = set()
+		self._retained_for = None
+		self._reverse_query = None
+		self._reverse_cursors = {}
 		self._last_persisted_as = None
+		self._restored = False
+		self._cas_read = None
 		self._id = None
+		self._keys_query = None
+		self._sub_queries = {}
+		self._lookahead = None
+	
+	def warm(self, max_pages, deadline=None):
+		'''Discards the persisted state of the query and learns it afresh, so
+		that pages are served from cursors again after the results change.
+		The cursors of the first max_pages pages are found by walking the 
+		query keys-only one page at a time, then the remaining results are
+		counted as by count_all(). Merged queries can not be walked by 
+		cursor, so only their results are counted, up to 1000 per query. See
+		he3.db.tower.warming for warming in the background.
+		@param max_pages: the integer number of pages, 0 or higher, to walk 
+		page by page
+		@param deadline: The number of seconds after which to stop counting,
+		or None to count all the results
+		@return: nothing
+		@raise TypeError: if max_pages is not an integer of 0 or higher
+		'''
+		self._check_non_negative_integer(max_pages, 'number of pages')
+		self.clear()
+		self.id #force id to be assigned now
+		#the persisted state was just discarded, so there is none to restore
+		self._restored = True
+		
+		if max_pages and not self._is_merged():
+			self._prewalk_to_page(max_pages + 1, max_pages)
+		self.count_all(deadline)
+		self._persist_if_required()
 				
 	def page_count(self):
-		'''Returns the number of pages that can be returned by the query
+		'''Returns the number of pages that can be returned by the query. 
+		Fetching a page that is short or empty reveals the exact number of 
+		results, and a full page a lower bound, so no count is made once such
+		a page has been seen. Otherwise the results are counted by count_all()
+		within count_deadline seconds. A lower bound left by a count that ran
+		out of time is persisted and used as it is, rather than counted 
+		further; count_all() and warm() count further.
 		@return: an integer value of 0 or higher indicating the total number
-		of pages available, up to limit
-		@warning: The maximum number of pages return is equal to 1000/page_size
-		or the maximum number of pages returned by fetch_page(), whichever is greater.
+		of pages available
+		@warning: If the count_deadline passes before all the results are 
+		counted, the number of pages counted so far is returned. Merged 
+		queries are counted only up to 1000 results per query.
+		'''
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		self._expire_result_counts()
+		if self._count_approximate and self._result_count is None:
+			return self._pages_for_results(self._min_result_count or 0)
+		return self._pages_for_results(self.count_all(self.count_deadline)[0])
+	
+	def count_all(self, deadline=None):
+		'''Returns the number of results of the query, counting them unless
+		already known. Unless a counter is set, the results are counted by 
+		walking the query keys-only in batches of up to count_batch_size 
+		results, recording the cursor at the end of each batch (which ends a 
+		page), so counts are not limited to 1000. The walk starts from the 
+		furthest cursor known to be current (see _get_walk_start_page()). 
+		The number found is persisted with the cursors. If the deadline 
+		passes before the end of the results is reached, the number counted 
+		so far is persisted and returned as a lower bound, which the next 
+		count_all() continues from.
+		@param deadline: The number of seconds after which to stop counting,
+		or None to count all the results
+		@return: A tuple of the integer number of results, and True if it is
+		only a lower bound or False if it is exact
 		'''
-		if not self._page_count:
-			result_count = self._query.count()
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		if self.counter:
+			return (self._get_result_count(), False)
+		
+		self._expire_result_counts()
+		if self._result_count is None:
+			if self._is_merged():
+				#merged queries can not be walked by cursor
+				(result_count, approximate) = self._count_results()
+			else:
+				(result_count, approximate) = self._walk_results(deadline)
 			
-			(full_pages, remainder) = divmod(result_count, self.page_size)
-			self._page_count = full_pages if remainder == 0 else full_pages + 1
+			if approximate:
+				self._record_min_result_count(result_count)
+				self._count_approximate = True
+			else:
+				self._record_result_count(result_count)
 			
 			#Record we did a query.count() call 
 			self._num_count_calls += 1
-		return self._page_count 
+			self._persist_if_required()
+			self._report_stats()
+		
+		if self._result_count is not None:
+			return (self._result_count, False)
+		return (self._min_result_count or 0, True)
 				
+	def count_pages(self, limit, start=1):
+		'''Returns the number of pages that can be returned by the query, up
+		to limit. Unless the number of pages is already known, the pages are 
+		found from the known cursors and at most one keys-only query for the
+		results of the pages after the furthest of them, rather than by
+		counting all the results. If that query reaches the end of the 
+		results, the number of pages becomes known. Only the results of the 
+		pages from start are fetched; any before them, after the furthest 
+		cursor, are skipped by offset. Merged queries are counted by a count 
+		of each query up to the results of limit pages.
+		@param limit: The positive non-zero maximum number of pages to count
+		@param start: The first page whose results need be fetched, such as
+		the first page linked to. If the results end before it, the pages are
+		counted by page_count() instead.
+		@return: an integer value between 0 and limit
+		'''
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		self._check_page_number(limit)
+		self._expire_result_counts()
+		
+		if (self._min_result_count or 0) > self._page_offset(limit):
+			return limit
+		if self.counter or self._page_count is not None:
+			return min(self.page_count(), limit)
+		if self._is_merged():
+			return self._count_merged_pages(limit)
+		
+		#every page before one with a cursor is full
+		cursor_page = self._get_nearest_cursor_page(limit)
+		start_page = max(cursor_page, min(start, limit))
+		max_results = self.page_size * (limit - start_page + 1)
+		(num_results, end_cursor) = self._count_results_from(cursor_page, 
+					max_results, self._page_offset(start_page) 
+					- self._page_offset(cursor_page))
+		if not num_results and start_page > cursor_page:
+			#the results end before start, but it is not known where
+			return min(self.page_count(), limit)
+		
+		page_count = start_page - 1 + self._pages_for_results(num_results)
+		if num_results < max_results:
+			self._record_result_count(self._page_offset(start_page) + num_results)
+		else:
+			self._set_cursor_for_page(limit + 1, end_cursor)
+			self._record_min_result_count(self._page_offset(limit + 1))
+		
+		self._persist_if_required()
+		self._report_stats()
+		return page_count
+	
 	def has_page(self, page_number):
 		'''Returns True if the requested page exists for the current 
 		PagedQuery object. Note that calling this method for a page at or below 
@@ -217,9 +723,15 @@ class PagedQuery(object):
 		has_page(n) == len(fetch_page(n)) > 0'''
 		
 		#we might be able to avoid an unneccesary query.count() if we can see
-		#a cursor already exists for page-number or a higher page.
+		#a cursor already exists for page-number or a higher page, or a lower
+		#bound on the number of results reaches it.
+		self.id #force id to be assigned now
+		self._restore_if_required()
+		self._expire_result_counts()
 		
-		return page_number > 0 and (len(self._page_cursors) > page_number or page_number <= self.page_count())
+		return page_number > 0 and (len(self._page_cursors) > page_number 
+			or (self._min_result_count or 0) > self._page_offset(page_number)
+			or page_number <= self.page_count())
 
 	def fetch(self, limit, offset=0):
 		''' executes query against datastore as per db.Query.fetch()
@@ -308,9 +820,12 @@ class PagedQuery(object):
 		
 		@see: http://code.google.com/appengine/docs/python/datastore/queryclass.html
 		
-		@param limit: The maximum number of results to count.
+		@param limit: The maximum number of results to count, or None to 
+		count every result by count_all() (which is not part of the db.Query
+		interface)
 		@return: Returns the number of result this query fetches
 		'''
+		if limit is None: return self.count_all()[0]
 		return self._query.count(limit)		
 
 	def _get_page_size(self):
@@ -322,8 +837,8 @@ class PagedQuery(object):
 		return self._page_size
 	
 	def _set_page_size(self, new_page_size):
-		'''Sets the page size of the PagedQuery. If the new page_size differs 
-		from the existing page size, the cache is cleared.
+		'''Sets the page size of the PagedQuery. As cursors are held by 
+		result offset, those known are kept for the pages of the new size.
 		
 		@param new_page_size: an integer greater than zero indicating the number
 		of results to be returned on each page. 
@@ -331,8 +846,101 @@ class PagedQuery(object):
 		'''
 		self._check_page_size(new_page_size)
 		if new_page_size != self._page_size:
-			self.clear()
+			cursors = self._get_offset_cursors()
+			recent_offsets = [self._page_offset(p) for p in self._recent_pages]
+			
 			self._page_size = new_page_size
+			self._page_cursors = [None]
+			self._offset_cursors = {}
+			self._add_offset_cursors(cursors)
+			self._recent_pages = self._pages_at_offsets(recent_offsets)
+			self._page_count = self._get_known_page_count()
+			self._lookahead = None
+	
+	def _apply_bookmark(self, bookmark):
+		'''Adds the cursor held by a bookmark at its result offset, if the 
+		bookmark was signed for this query with the bookmark_secret. Bookmarks
+		that were not are logged and ignored.
+		@param bookmark: A string bookmark returned by get_bookmark()
+		@return: nothing
+		'''
+		if not self.bookmark_secret: return
+		
+		try:
+			bookmark = str(bookmark)
+			data = base64.urlsafe_b64decode(bookmark + '=' * (-len(bookmark) % 4))
+		except (TypeError, UnicodeError):
+			data = ''
+		signature = data[:_bookmark_signature_length]
+		payload = data[_bookmark_signature_length:]
+		header_size = struct.calcsize('>IB')
+		if len(payload) < header_size\
+			or not _digests_equal(signature, self._sign_bookmark(payload)):
+			logging.warning('Ignoring invalid PagedQuery bookmark: %s', bookmark)
+			return
+		
+		(offset, cursor_type) = struct.unpack_from('>IB', payload)
+		self._add_offset_cursors({offset:
+								_unpack_cursor(cursor_type, payload[header_size:])})
+	
+	def _sign_bookmark(self, payload):
+		'''Returns the signature of a bookmark's payload for this query
+		@param payload: The string payload of the bookmark
+		@return: A string signature of _bookmark_signature_length bytes
+		'''
+		return hmac.new(str(self.bookmark_secret), str(self.id) + payload, 
+					hashlib.sha1).digest()[:_bookmark_signature_length]
+	
+	def _page_offset(self, page_number):
+		'''Returns the offset of the first result of a page
+		@param page_number: The non-zero positive integer page number
+		@return: An integer offset
+		'''
+		return self.page_size * (page_number - 1)
+	
+	def _pages_at_offsets(self, offsets):
+		'''Returns the numbers of the pages starting at some offsets, ignoring
+		offsets that are not at the start of a page
+		@param offsets: A list of integer offsets
+		@return: A list of page numbers, in the same order
+		'''
+		return [o // self.page_size + 1 for o in offsets 
+			if o % self.page_size == 0]
+	
+	def _get_offset_cursors(self):
+		'''Returns every known cursor, keyed by the offset of the result it 
+		starts at
+		@return: A dictionary of integer offsets and string cursors
+		'''
+		cursors = dict(self._offset_cursors)
+		for (index, cursor) in enumerate(self._page_cursors):
+			if cursor: cursors[self.page_size * index] = cursor
+		return cursors
+	
+	def _add_offset_cursors(self, cursors):
+		'''Adds cursors keyed by result offset, such as those found by a 
+		PagedQuery of another page size, where no cursor is already held. 
+		Cursors at the start of a page become page cursors; others are kept
+		to start offset queries from.
+		@param cursors: A dictionary of integer offsets and cursors
+		@return: nothing
+		'''
+		for (offset, cursor) in cursors.items():
+			if not cursor or not offset: continue
+			(index, remainder) = divmod(offset, self.page_size)
+			if remainder:
+				self._offset_cursors.setdefault(offset, cursor)
+			elif not self._has_cursor_for_page(index + 1):
+				self._set_cursor_for_page(index + 1, cursor)
+	
+	def _get_known_page_count(self):
+		'''Returns the number of pages implied by the known number of results
+		@return: An integer number of pages, or None if the number of results
+		is not known
+		'''
+		if self._result_count is not None:
+			return self._pages_for_results(self._result_count)
+		return None
 	
 	def _has_cursor_for_page(self, page_number):
 		'''Returns True if a page_cursor is available for a specific page, False
@@ -367,13 +975,683 @@ class PagedQuery(object):
 		'''
 		return self._page_cursors[page_number-1]
 	
+	def _start_lookahead(self, page_number):
+		'''Starts an asynchronous query for a page, to be completed by 
+		complete_lookahead(), and records the time it started so that it is 
+		persisted. No query is started if the page is already stored in 
+		memcache, which is only checked if a look-ahead of the page is 
+		recorded as started within lookahead_time seconds.
+		@param page_number: The non-zero positive integer page number to fetch.
+		A cursor for the page must be known.
+		@return: nothing
+		'''
+		cursor = self._get_cursor_for_page(page_number)
+		if self._has_lookahead(page_number)\
+			and self._get_lookahead_page(page_number, cursor): return
+		
+		query = _copy_query(self._query)
+		query.with_cursor(cursor)
+		self._lookahead = (page_number, cursor, query, 
+					query.run(limit=self.page_size, batch_size=self.page_size))
+		self._lookahead_offsets[self._page_offset(page_number)] = time.time()
+	
+	def _has_lookahead(self, page_number):
+		'''Returns True if a look-ahead of a page is recorded as started within
+		lookahead_time seconds, so the page may be stored in memcache
+		@param page_number: The non-zero positive integer page number
+		@return: True if the page may be stored
+		'''
+		started_at = self._lookahead_offsets.get(self._page_offset(page_number))
+		return started_at is not None\
+			and time.time() - started_at < self.lookahead_time
+	
+	@_timed('memcache')
+	def _get_lookahead_page(self, page_number, cursor):
+		'''Returns a page stored in memcache by complete_lookahead(), provided
+		it was fetched from the cursor now known for the page.
+		@param page_number: The non-zero positive integer page number
+		@param cursor: The cursor currently known for the page
+		@return: A tuple of the page's results and the cursor following them,
+		or None if the page is not stored
+		'''
+		stored = memcache.Client().get(self._get_lookahead_key(page_number))
+		if stored and stored['start_cursor'] == cursor:
+			return (deserialize_entities(stored['results']), 
+					stored['end_cursor'])
+		return None
+	
+	def _get_lookahead_key(self, page_number):
+		'''Returns the memcache key a page fetched by look-ahead is stored under
+		@param page_number: The non-zero positive integer page number
+		@return: A string memcache key
+		'''
+		return '%s_page_%d_%d' % (self._get_memcache_key(), self.page_size,
+								page_number)
+	
+	@_timed('memcache')
+	def _get_cached_page(self, page_number):
+		'''Returns a page stored in the page cache for the current generation of
+		the query's kind
+		@param page_number: The non-zero positive integer page number
+		@return: A tuple of the page's results and the cursor following them,
+		or None if the page is not cached
+		'''
+		stored = memcache.Client().get(self._get_page_cache_key(page_number))
+		if stored:
+			return (deserialize_entities(stored['results']), 
+					stored['end_cursor'])
+		return None
+	
+	@_timed('memcache')
+	def _set_cached_page(self, page_number, page):
+		'''Stores a page in the page cache for the current generation of the
+		query's kind
+		@param page_number: The non-zero positive integer page number
+		@param page: A tuple of the page's results and the cursor following
+		them
+		@return: nothing
+		'''
+		(results, end_cursor) = page
+		memcache.Client().set(self._get_page_cache_key(page_number), {
+				'results':serialize_entities(results),
+				'end_cursor':end_cursor
+				}, time=self.page_cache_time)
+	
+	def _get_page_cache_key(self, page_number):
+		'''Returns the memcache key a page is cached under. The key includes
+		the current generation of the query's kind, so it changes whenever an
+		entity of the kind is written.
+		@param page_number: The non-zero positive integer page number
+		@return: A string memcache key
+		'''
+		return '%s_results_%d_%d_%s' % (self._get_memcache_key(), 
+					self.page_size, page_number, 
+					self._get_generation(self._get_kind()))
+	
+	def _get_generation(self, kind):
+		'''Returns the generation of a kind, reading it from memcache only if
+		it has not been read by this instance, or bump_generation() has been 
+		called for the kind in this process since
+		@param kind: a string kind
+		@return: an integer generation
+		'''
+		bump_count = get_bump_count(kind)
+		if self._generations.get(kind, (None, None))[1] != bump_count:
+			self._generations[kind] = (get_generation(kind), bump_count)
+		return self._generations[kind][0]
+	
+	def _get_kind(self):
+		'''Returns the kind of the entities returned by the query
+		@return: A string kind
+		'''
+		query = self._query
+		while query.__dict__.has_key('_query'): query = query._query
+		return query._model_class.kind()
+	
+	@_timed('datastore')
+	def _count_results(self, limit=1000):
+		'''Counts the results of the query, up to a limit
+		@param limit: The maximum number of results to count
+		@return: A tuple of the integer number of results, and True if the
+		count reached the limit so is only a lower bound
+		'''
+		result_count = self._query.count(limit)
+		return (result_count, result_count >= limit)
+	
+	@_timed('datastore')
+	def _walk_results(self, deadline):
+		'''Counts the results of the query from the page returned by 
+		_get_walk_start_page() using keys-only queries of batches of whole 
+		pages, recording the cursor following each full batch
+		@param deadline: The number of seconds after which to stop, or None
+		@return: A tuple of the number of results counted (including those 
+		before the cursor started from) and True if the deadline passed
+		before the end of the results was reached
+		'''
+		started = time.time()
+		page_number = self._get_walk_start_page()
+		batch_pages = max(self.count_batch_size // self.page_size, 1)
+		batch_size = batch_pages * self.page_size
+		keys_query = self._get_keys_query()
+		
+		while True:
+			keys_query.with_cursor(self._get_cursor_for_page(page_number))
+			num_keys = len(keys_query.fetch(batch_size))
+			self._num_count_batches += 1
+			if num_keys < batch_size:
+				return (self._page_offset(page_number) + num_keys, False)
+			
+			page_number += batch_pages
+			self._set_cursor_for_page(page_number, keys_query.cursor())
+			self._walked_offsets.add(self._page_offset(page_number))
+			if deadline is not None and time.time() - started >= deadline:
+				return (self._page_offset(page_number), True)
+	
+	def _get_walk_start_page(self):
+		'''Returns the page that a walk counting the results starts from. 
+		Without a count_ttl, that is the furthest page with a known cursor. 
+		With one, cursors found before the count expired may no longer end
+		pages, so the walk starts from the first page, the cursor ending an 
+		unexpired lower bound left by an earlier walk, or the furthest cursor
+		walked by this PagedQuery since the count expired, whichever is 
+		furthest.
+		@return: A page number of 1 or higher, whose cursor is known
+		'''
+		if self.count_ttl is None:
+			return self._get_nearest_cursor_page(len(self._page_cursors))
+		
+		offsets = set(self._walked_offsets)
+		if self._count_approximate and self._min_result_count:
+			offsets.add(self._min_result_count)
+		pages = [o // self.page_size + 1 for o in offsets 
+				if o % self.page_size == 0]
+		pages = [p for p in pages if self._has_cursor_for_page(p)]
+		return max(pages + [1])
+	
+	@_timed('datastore')
+	def _count_results_from(self, page_number, limit, offset=0):
+		'''Counts the results of the query from the start of a page using a 
+		keys-only query, up to a limit
+		@param page_number: The non-zero positive integer page number to count
+		from. A cursor for the page must be known.
+		@param limit: The maximum number of results to count
+		@param offset: The number of results to skip before counting
+		@return: A tuple of the number of results and the cursor following 
+		them
+		'''
+		keys_query = self._get_keys_query()
+		keys_query.with_cursor(self._get_cursor_for_page(page_number))
+		keys = keys_query.fetch(limit, offset)
+		self._num_count_pages_queries += 1
+		return (len(keys), keys_query.cursor())
+	
+	def _count_merged_pages(self, limit):
+		'''Returns the number of pages of a merged query up to limit, counting
+		no more results than the pages hold. The number of results, or a 
+		lower bound on it, is recorded and persisted.
+		@param limit: The positive non-zero maximum number of pages to count
+		@return: an integer value between 0 and limit
+		'''
+		(num_results, approximate) = self._count_results(
+												self._page_offset(limit + 1))
+		self._num_count_pages_queries += 1
+		if approximate: self._record_min_result_count(num_results)
+		else: self._record_result_count(num_results)
+		
+		self._persist_if_required()
+		self._report_stats()
+		return min(self._pages_for_results(num_results), limit)
+	
+	def _check_counter(self, query, counter):
+		'''Checks that a ShardedCounter given for a query of a CountedModel 
+		subclass counts the results of that query, as a counter of another
+		query shape or filter value gives wrong page counts.
+		@param query: the db.Query or db.GqlQuery, with any facade removed
+		@param counter: the counter supplied to the constructor, or None
+		@raise TypeError: raised if the counter is not the query's counter
+		'''
+		#imported here as the counting module itself imports from paging
+		from he3.db.tower.counting import CountedModel, ShardedCounter,\
+			get_query_counter
+		if not isinstance(counter, ShardedCounter)\
+			or not isinstance(query, db.Query)\
+			or not query._model_class\
+			or not issubclass(query._model_class, CountedModel):
+			return
+		if get_query_counter(query).name != counter.name:
+			raise TypeError('Counter does not count the query: ' + counter.name)
+	
+	def _get_result_count(self):
+		'''Returns the number of results of the query, if known. A counter, if
+		set, is always consulted. Reverse cursors are discarded if the number
+		has changed since they were found, as they are relative to the end of
+		the results.
+		@return: an integer number of results, or None if not known
+		'''
+		if self.counter:
+			#counters are cheap and live, so their totals are not cached
+			self._num_counter_calls += 1
+			self._record_result_count(self.counter.count())
+		else:
+			self._expire_result_counts()
+		return self._result_count
+	
+	def _record_result_count(self, result_count):
+		'''Records the exact number of results of the query, which replaces 
+		any lower bound. Reverse cursors are discarded if the number has 
+		changed, as they are relative to the end of the results. The time it
+		was counted at is kept if the number is unchanged, so that count_ttl
+		runs from when it was learned and the persisted form is unchanged.
+		@param result_count: an integer number of results
+		@return: nothing
+		'''
+		if result_count != self._result_count or self._counted_at is None:
+			self._counted_at = time.time()
+		if result_count != self._result_count:
+			self._reverse_cursors = {}
+			self._result_count = result_count
+		self._min_result_count = None
+		self._count_approximate = False
+		self._page_count = self._pages_for_results(result_count)
+	
+	def _record_min_result_count(self, min_result_count):
+		'''Records a lower bound on the number of results of the query. A 
+		known number of results that the bound exceeds is discarded, as the
+		results have changed.
+		@param min_result_count: an integer number of results
+		@return: nothing
+		'''
+		if self._result_count is not None:
+			if min_result_count <= self._result_count: return
+			self._result_count = None
+			self._reverse_cursors = {}
+		if min_result_count > (self._min_result_count or 0):
+			self._min_result_count = min_result_count
+			self._page_count = self._get_known_page_count()
+			self._counted_at = time.time()
+	
+	def _expire_result_counts(self):
+		'''Discards the number of results and any lower bound on it if they 
+		were learned more than count_ttl seconds ago, along with the record 
+		of which cursors this PagedQuery walked to learn them
+		@return: nothing
+		'''
+		if self.count_ttl is None or self._counted_at is None\
+			or time.time() - self._counted_at <= self.count_ttl:
+			return
+		self._result_count = None
+		self._min_result_count = None
+		self._page_count = None
+		self._reverse_cursors = {}
+		self._counted_at = None
+		self._count_approximate = False
+		self._walked_offsets = set()
+	
+	def _pages_for_results(self, result_count):
+		'''Returns the number of pages required to hold a number of results
+		@param result_count: an integer number of results
+		@return: an integer number of pages
+		'''
+		(full_pages, remainder) = divmod(result_count, self.page_size)
+		return full_pages if remainder == 0 else full_pages + 1
+	
+	def _query_page(self, page_number):
+		'''Retrieves a page of results using the best means available: a page
+		stored by look-ahead, a cursor (pre-walking to one if enabled), the 
+		reversed query or an offset from the nearest cursor.
+		@param page_number: The non-zero positive integer page number
+		@return: A tuple of the page's results and the cursor following them,
+		or None if pre-walking found the page does not exist
+		'''
+		if page_number > 1 and not self._has_cursor_for_page(page_number):
+			reverse_page = self._query_reverse_page(page_number, 
+								self._get_nearest_cursor(page_number)[1])
+			if reverse_page: return reverse_page
+		
+		if page_number > 1 and self.prewalk_budget\
+			and not self._has_cursor_for_page(page_number)\
+			and not self._is_merged()\
+			and not self._prewalk_to_page(page_number):
+			return None
+
+		stored_page = None
+		if self._has_cursor_for_page(page_number):
+			offset = 0
+			cursor = self._get_cursor_for_page(page_number)
+			if self.lookahead and not self.bookmark_secret\
+				and self._has_lookahead(page_number):
+				stored_page = self._get_lookahead_page(page_number, cursor)
+			if stored_page: self._num_lookahead_hits += 1
+			else: self._num_cursor_queries += 1 
+		elif page_number > 1:
+			
+			#if we can not use a cursor, we need to use the offset method
+			#the offset method errors if it is out of range. Therefore:
+			#if page_number > 1 and page_number > self.page_count(): return []
+			#The offset is taken from the nearest known cursor.
+			
+			(cursor, offset) = self._get_nearest_cursor(page_number)
+			
+			#record that we did an offset query. Useful for testing
+			self._num_offset_queries += 1
+		else:
+			self._num_page1_queries += 1
+			cursor = None
+			offset= 0
+
+		return stored_page or self._run_page_query(cursor, offset)
+	
+	@_timed('datastore')
+	def _query_reverse_page(self, page_number, forward_offset):
+		'''Retrieves a page of results by running the query in reverse, if the
+		number of results is known from a counter or within count_ttl, and 
+		fewer results must be skipped than going forward. Results are skipped
+		from the nearest reverse cursor after the page, or from the end of 
+		the results.
+		@param page_number: The non-zero positive integer page number
+		@param forward_offset: The number of results that would be skipped to
+		fetch the page going forward
+		@return: A tuple of the page's results and None (the cursor following
+		them is not known), or None if the page is not fetched in reverse
+		'''
+		if self._query_type != 'Query' or self._is_merged(): return None
+		#a stale number of results would shift pages fetched in reverse
+		#relative to those fetched going forward, so it must be live or
+		#bounded by count_ttl
+		if not self.counter and self.count_ttl is None: return None
+		result_count = self._get_result_count()
+		if result_count is None: return None
+		
+		page_start = self._page_offset(page_number)
+		page_end = min(page_start + self.page_size, result_count)
+		if page_start >= page_end: return None
+		
+		#reverse_cursors[o] follows the result at offset o in reverse
+		later_offsets = [o for o in self._reverse_cursors.keys() 
+						if o >= page_end]
+		if later_offsets:
+			start_offset = min(later_offsets)
+			cursor = self._reverse_cursors[start_offset]
+			offset = start_offset - page_end
+		else:
+			cursor = None
+			offset = result_count - page_end
+		if offset >= forward_offset: return None
+		
+		query = self._get_reverse_query()
+		query.with_cursor(cursor)
+		results = query.fetch(page_end - page_start, offset)
+		self._reverse_cursors[page_start] = query.cursor()
+		self._num_reverse_queries += 1
+		
+		results.reverse()
+		if self.entity_cache: results = self._get_cached_entities(results)
+		return (results, None)
+	
+	def _get_reverse_query(self):
+		'''Returns a copy of the query with every sort order reversed, creating
+		it if required. The datastore sorts by the property of an inequality 
+		filter first even if the query has no order on it, so that order is 
+		added first, and a __key__ order is added last if the query has none,
+		as results are otherwise ordered by key. The copy is keys-only if an 
+		entity_cache is set, and is discarded whenever the cache is cleared.
+		@return: a db.Query
+		'''
+		if not self._reverse_query:
+			query = _copy_query(self._query, keys_only=bool(self.entity_cache))
+			orderings = list(query._Query__orderings)
+			inequality = _get_inequality_property(query)
+			if inequality and (not orderings or orderings[0][0] != inequality):
+				orderings.insert(0, (inequality, datastore.Query.ASCENDING))
+			if '__key__' not in [p for (p, d) in orderings]:
+				orderings.append(('__key__', datastore.Query.ASCENDING))
+			query._Query__orderings = [(p, 
+					d == datastore.Query.ASCENDING and datastore.Query.DESCENDING
+					or datastore.Query.ASCENDING) for (p, d) in orderings]
+			self._reverse_query = query
+		return self._reverse_query
+	
+	@_timed('datastore')
+	def _run_page_query(self, cursor, offset):
+		'''Runs the query for a single page of results, starting from a cursor
+		and offset. If an entity_cache is set, the query is run keys-only and
+		the keys resolved through the cache.
+		@param cursor: The cursor to start from, or None to start from the 
+		first result
+		@param offset: Number of results to skip after the cursor
+		@return: A tuple of the page's results and the cursor following them.
+		If an entity_cache is set, results may contain None values for keys
+		whose entities no longer exist.
+		'''
+		if self._is_merged():
+			return self._run_merged_page_query(cursor, offset)
+		
+		if self.entity_cache:
+			keys_query = self._get_keys_query()
+			keys_query.with_cursor(cursor)
+			keys = keys_query.fetch(self.page_size, offset)
+			return (self._get_cached_entities(keys), keys_query.cursor())
+		
+		self._query.with_cursor(cursor)
+		results = self.fetch(limit=self.page_size, offset=offset)
+		end_cursor = self._query.cursor()
+		self._query.with_cursor(None)
+		return (results, end_cursor)
+	
+	@_timed('entity_cache')
+	def _get_cached_entities(self, keys):
+		'''Resolves keys to entities through the entity_cache
+		@param keys: A list of keys
+		@return: A list of the entities, with None for keys whose entities no
+		longer exist
+		'''
+		return self.entity_cache.get(keys)
+	
+	def _run_merged_page_query(self, cursor, offset):
+		'''Runs each sub-query of a merged query from its own cursor and 
+		merges the results by the query's sort orders, discarding duplicates.
+		A sub-query whose results were only partly used keeps its cursor, 
+		with the number of its results used since, which the next page skips.
+		Only once that reaches the page size is the cursor moved to the last 
+		used result with a keys-only query.
+		@param cursor: The merged cursor to start from (holding a cursor for
+		each sub-query), or None to start from the first result
+		@param offset: Number of merged results to skip after the cursor
+		@return: A tuple of the page's results and the merged cursor 
+		following them
+		'''
+		sub_queries = self._get_sub_queries()
+		if cursor: 
+			positions = [_split_sub_cursor(c) 
+						for c in cursor.split(_cursor_separator)]
+		else: 
+			positions = [(None, 0)] * len(sub_queries)
+		
+		limit = offset + self.page_size
+		sub_results = []
+		for (sub_query, (sub_cursor, skip)) in zip(sub_queries, positions):
+			if sub_cursor == _cursor_exhausted:
+				sub_results.append(([], None))
+				continue
+			sub_query.with_cursor(sub_cursor)
+			sub_results.append((sub_query.fetch(limit, skip), 
+							sub_query.cursor()))
+			self._num_sub_queries += 1
+		
+		(results, used) = self._merge_sub_results(
+										[r for (r, c) in sub_results], limit)
+		
+		end_cursors = []
+		for i in range(len(sub_queries)):
+			(sub_query_results, sub_end_cursor) = sub_results[i]
+			(sub_cursor, skip) = positions[i]
+			if sub_cursor == _cursor_exhausted\
+				or (used[i] == len(sub_query_results) 
+					and len(sub_query_results) < limit):
+				end_cursors.append(_cursor_exhausted)
+			elif used[i] == len(sub_query_results):
+				end_cursors.append(sub_end_cursor)
+			elif used[i] == 0:
+				end_cursors.append(_join_sub_cursor(sub_cursor, skip))
+			elif skip + used[i] < self.page_size:
+				end_cursors.append(_join_sub_cursor(sub_cursor, skip + used[i]))
+			else:
+				keys_query = self._get_sub_queries(keys_only=True)[i]
+				keys_query.with_cursor(sub_cursor)
+				keys_query.fetch(used[i], skip)
+				end_cursors.append(keys_query.cursor())
+				self._num_rebase_queries += 1
+		
+		return (results[offset:], _cursor_separator.join(end_cursors))
+	
+	def _merge_sub_results(self, sub_results, limit):
+		'''Merges the results of sub-queries by the query's sort orders, 
+		repeatedly taking the first of the next results of each sub-query from
+		a heap. Duplicates (entities matching several sub-queries) of any 
+		result already merged are discarded, and are counted as used even
+		past the limit, so that the next page does not start with a duplicate
+		of a result of this one.
+		@param sub_results: a list of the lists of results of each sub-query
+		@param limit: the maximum number of results to take
+		@return: a tuple of the list of merged results and a list of the 
+		number of results used from each sub-query
+		'''
+		heap = [_MergeCandidate(results[0], i, self._compare_results)
+				for (i, results) in enumerate(sub_results) if results]
+		heapq.heapify(heap)
+		
+		merged = []
+		used = [0] * len(sub_results)
+		merged_keys = set()
+		while heap and (len(merged) < limit 
+						or heap[0].result.key() in merged_keys):
+			candidate = heap[0]
+			i = candidate.index
+			used[i] += 1
+			if candidate.result.key() not in merged_keys:
+				merged.append(candidate.result)
+				merged_keys.add(candidate.result.key())
+			
+			if used[i] < len(sub_results[i]):
+				heapq.heapreplace(heap, _MergeCandidate(sub_results[i][used[i]], 
+												i, self._compare_results))
+			else:
+				heapq.heappop(heap)
+		return (merged, used)
+	
+	def _compare_results(self, result, other_result):
+		'''Compares two results of the query by its sort orders, and then by
+		key, as the datastore orders them
+		@param result: an entity
+		@param other_result: another entity
+		@return: a negative integer if result is first, 0 if they are equal or
+		a positive integer if other_result is first
+		'''
+		query = self._query
+		while query.__dict__.has_key('_query'): query = query._query
+		
+		for (name, direction) in query._Query__orderings:
+			comparison = cmp(_get_sort_value(result, name, direction),
+							_get_sort_value(other_result, name, direction))
+			if comparison:
+				if direction == datastore.Query.DESCENDING: return -comparison
+				return comparison
+		return cmp(result.key(), other_result.key())
+	
+	def _get_sub_queries(self, keys_only=False):
+		'''Returns copies of each sub-query of a merged query, creating them if
+		required. The copies are discarded whenever the cache is cleared.
+		@param keys_only: if True, the copies return keys
+		@return: a list of db.Query objects
+		'''
+		if not self._sub_queries.has_key(keys_only):
+			sub_queries = []
+			for query in self._get_queries():
+				while query.__dict__.has_key('_query'): query = query._query
+				for i in range(len(query._Query__query_sets)):
+					sub_query = _copy_query(query, keys_only)
+					sub_query._Query__query_sets = [
+											sub_query._Query__query_sets[i]]
+					sub_queries.append(sub_query)
+			self._sub_queries[keys_only] = sub_queries
+		return self._sub_queries[keys_only]
+	
+	def _get_queries(self):
+		'''Returns the queries whose results are paged
+		@return: a list of queries
+		'''
+		return [self._query]
+	
+	def _is_merged(self):
+		'''Returns True if the query is run as several sub-queries, as db.Query
+		runs queries with IN and != filters
+		@return: True or False
+		'''
+		if self._query_type != 'Query': return False
+		query = self._query
+		while query.__dict__.has_key('_query'): query = query._query
+		return len(query._Query__query_sets) > 1
+	
+	def _get_keys_query(self):
+		'''Returns a keys-only copy of the query, creating it if required. The
+		copy is discarded whenever the cache is cleared, which includes any
+		mutation of the query.
+		@return: a keys-only db.Query or db.GqlQuery
+		'''
+		if not self._keys_query:
+			self._keys_query = _copy_query(self._query, keys_only=True)
+		return self._keys_query
+	
+	def _get_nearest_cursor_page(self, page_number):
+		'''Returns the highest page number at or below page_number for which a
+		cursor is known. Page 1 never needs a cursor, so 1 is returned if no
+		other page qualifies.
+		@param page_number: The non-zero positive integer page number to start
+		searching down from
+		@return: A page number between 1 and page_number
+		'''
+		for page in range(min(page_number, len(self._page_cursors)), 1, -1):
+			if self._page_cursors[page-1]: return page
+		return 1
+	
+	def _get_nearest_cursor(self, page_number):
+		'''Returns the known cursor nearest before the start of a page, which
+		may be the cursor of an earlier page or one found by a PagedQuery of 
+		another page size, and the number of results from it to the page
+		@param page_number: The non-zero positive integer page number
+		@return: A tuple of the cursor (None for the first result) and the 
+		integer number of results to skip after it
+		'''
+		page_start = self._page_offset(page_number)
+		start_page = self._get_nearest_cursor_page(page_number)
+		start_offset = self._page_offset(start_page)
+		cursor = self._get_cursor_for_page(start_page)
+		for (offset, offset_cursor) in self._offset_cursors.items():
+			if start_offset < offset <= page_start:
+				(start_offset, cursor) = (offset, offset_cursor)
+		return (cursor, page_start - start_offset)
+	
+	@_timed('datastore')
+	def _prewalk_to_page(self, page_number, budget=None):
+		'''Walks forward from the nearest known cursor towards page_number 
+		using keys-only queries of page_size results, recording the cursor of
+		each page passed. The walk stops on reaching page_number, at the end
+		of the results or once the budget of queries has been made.
+		@param page_number: The non-zero positive integer page number to walk 
+		towards
+		@param budget: The maximum number of queries to make, or None for
+		prewalk_budget
+		@return: False if the results ran out before page_number was reached,
+		True otherwise
+		'''
+		page = self._get_nearest_cursor_page(page_number)
+		keys_query = self._get_keys_query()
+		
+		if budget is None: budget = self.prewalk_budget
+		for dummy in range(budget):
+			if page >= page_number: break
+			
+			keys_query.with_cursor(self._get_cursor_for_page(page))
+			keys = keys_query.fetch(self.page_size)
+			self._num_prewalk_queries += 1
+			
+			if len(keys) < self.page_size:
+				self._record_result_count(self._page_offset(page) + len(keys))
+				if not keys and page > 1: 
+					self._set_cursor_for_page(page, None)
+				return False
+			page += 1
+			self._set_cursor_for_page(page, keys_query.cursor())
+			self._walked_offsets.add(self._page_offset(page))
+			self._record_min_result_count(self._page_offset(page))
+		return True
+	
 	def _get_query_id(self):
 		'''Returns the ID of the query. This id is unique to the query. Whenever
 		a query is rebuilt the same way (ie semantically identical) the ID will
-		be the same
+		be the same, across instances and processes. The id is cached until 
+		the cache is cleared, which includes any mutation of the query.
 		@return: a string ID
-		@todo: initial version cached id value. For some reason this caused 
-		unexplainable errors in test cases. Cause unknown 
 		'''
 		if not self._id:
 			self._id = self._generate_query_id()
@@ -383,7 +1661,7 @@ class PagedQuery(object):
 		'''Generates a query ID for the PagedQuery from scratch
 		@return: a string ID
 		'''
-		return str(hash(pickle.dumps(self._query,2)))
+		return query_fingerprint(self._query)
 		
 			
 	def _check_query_type_is(self, required_query_type):
@@ -412,6 +1690,55 @@ class PagedQuery(object):
 						'A page number must be a positive integer greater than 0')
 
 	
+	def _check_non_negative_integer(self, value, description):
+		'''This is a helper method to assert that a setting is an integer of 0
+		or higher
+		@param value: the value to check
+		@param description: name of the setting, used in the error message
+		@return: nothing
+		@raise TypeError: if the value is not an integer of 0 or higher
+		'''
+		if type(value) != int or value < 0:
+			raise TypeError(
+						'A %s must be an integer of 0 or higher' % description)
+	
+	def _get_prewalk_budget(self):
+		'''Returns the prewalk budget set during instantiation or by setting
+		prewalk_budget
+		@return: An integer of 0 or higher
+		'''
+		return self._prewalk_budget
+	
+	def _set_prewalk_budget(self, prewalk_budget):
+		'''Sets the maximum number of keys-only queries made when walking 
+		forward to a page without a cursor.
+		@param prewalk_budget: an integer of 0 or higher. 0 disables 
+		pre-walking
+		@return: void
+		@raise TypeError: if prewalk_budget is not an integer of 0 or higher
+		'''
+		self._check_non_negative_integer(prewalk_budget, 'prewalk budget')
+		self._prewalk_budget = prewalk_budget
+	
+	def _get_checkpoint_interval(self):
+		'''Returns the checkpoint interval set during instantiation or by 
+		setting checkpoint_interval
+		@return: An integer of 0 or higher
+		'''
+		return self._checkpoint_interval
+	
+	def _set_checkpoint_interval(self, checkpoint_interval):
+		'''Sets the interval between pages whose cursors are always persisted.
+		@param checkpoint_interval: an integer of 0 or higher. 0 persists the
+		cursors of all pages
+		@return: void
+		@raise TypeError: if checkpoint_interval is not an integer of 0 or 
+		higher
+		'''
+		self._check_non_negative_integer(checkpoint_interval, 
+										'checkpoint interval')
+		self._checkpoint_interval = checkpoint_interval
+	
 	def _check_page_size(self, page_size):
 		'''This is a helper method to check the type and value of a page_size
 		parameter to ensure it is valid. If it is not valid a TypeError is
@@ -424,52 +1751,341 @@ class PagedQuery(object):
 			raise TypeError(
 						'A page size must be a positive integer greater than 0')
 	
-	def _update_cursors_with_results(self, page_number, results):
+	def _update_cursors_with_results(self, page_number, results, cursor):
 		'''Updates the cached page cursors with information inferred from the
 		page_number and the contents of that page number.
 		@param page_number: non-zero positive integer page number that generated
 		the results.
 		@param results: List of entities returned by a Query or GQL querty for 
 		a specific page. 
+		@param cursor: the cursor following the last of the results, or None
+		if it is not known
 		@return: Nothing
 		''' 
 		
+		page_start = self._page_offset(page_number)
 		if len(results) == self.page_size:
+			#there are at least as many results as those up to this page
+			self._record_min_result_count(page_start + len(results))
+		elif results or page_number == 1\
+			or self._has_cursor_for_page(page_number):
+			#a short page, or an empty page following a full one, ends the
+			#results
+			self._record_result_count(page_start + len(results))
+		
+		if len(results) == self.page_size and cursor:
 			#persist the cursor (but only if a full page of results has been 
-			#returned)
+			#returned, and it is known)
 			self._set_cursor_for_page(
 						page_number = page_number + 1,
-						cursor = self._query.cursor())
+						cursor = cursor)
 		elif len(results) == 0:
 			#remove the cursor for the current page
 			self._set_cursor_for_page(
 						page_number = page_number,
 						cursor = None)
+	def _touch_pages(self, *page_numbers):
+		'''Marks pages as the most recently used, discarding the least recently
+		used pages beyond recent_page_limit.
+		@param page_numbers: non-zero positive integer page numbers, least
+		recently used first
+		@return: Nothing
+		'''
+		for page_number in page_numbers:
+			if page_number in self._recent_pages: 
+				self._recent_pages.remove(page_number)
+			self._recent_pages.append(page_number)
+		del self._recent_pages[:-self.recent_page_limit]
+	
+	def _record_page_hit(self, page_number):
+		'''Adds a hit to a page, discarding the hits of the pages with the 
+		fewest beyond hit_page_limit.
+		@param page_number: The non-zero positive integer page number
+		@return: Nothing
+		'''
+		now = time.time()
+		offset = self._page_offset(page_number)
+		self._page_hits[offset] = (self._get_page_hits(offset, now) + 1, now)
+		self._trim_page_hits(now)
+	
+	def _get_page_hits(self, offset, now):
+		'''Returns the hits of the page starting at an offset, halved for every
+		hit_half_life seconds since its last hit
+		@param offset: The integer offset of the page's first result
+		@param now: The current time, in seconds since the epoch
+		@return: A float number of hits, 0 for a page without hits
+		'''
+		return _decay_hits(self._page_hits.get(offset, (0, now)), now, 
+						self.hit_half_life)
+	
+	def _trim_page_hits(self, now):
+		'''Discards the hits of the pages with the fewest beyond 
+		hit_page_limit
+		@param now: The current time, in seconds since the epoch
+		@return: Nothing
+		'''
+		if len(self._page_hits) <= self.hit_page_limit: return
+		offsets = sorted(self._page_hits.keys(), 
+						key=lambda o: -self._get_page_hits(o, now))
+		for offset in offsets[self.hit_page_limit:]:
+			del self._page_hits[offset]
+	
+	def _get_checkpoints(self):
+		'''Returns the checkpoint pages, spaced checkpoint_interval apart (or 
+		a multiple of it if there are more than max_checkpoints)
+		@return: A list of page numbers, each of which has a cursor
+		'''
+		pages = [p for p in range(2, len(self._page_cursors) + 1) 
+				if self._page_cursors[p-1]]
+		
+		interval = self.checkpoint_interval
+		checkpoints = [p for p in pages if (p - 1) % interval == 0]
+		while len(checkpoints) > self.max_checkpoints:
+			interval *= 2
+			checkpoints = [p for p in checkpoints if (p - 1) % interval == 0]
+		return checkpoints
+	
+	def _get_checkpoint_pages(self):
+		'''Returns the pages whose cursors are persisted when checkpointing.
+		These are the checkpoint pages plus the recently used pages.
+		@return: A set of page numbers, each of which has a cursor
+		'''
+		kept = set(self._get_checkpoints())
+		kept.update([p for p in self._recent_pages 
+					if self._has_cursor_for_page(p)])
+		return kept
+	
+	def _retain_cursors(self, persisted_form):
+		'''Leaves the cursors of the pages with the fewest hits out of a 
+		persisted form until its encoding fits within max_persisted_size. Ties
+		are broken by leaving out the deepest pages first. The cursors of 
+		every retention_interval-th page (pages 1, k+1, 2k+1 ...), checkpoint
+		pages, the furthest cursor and those walked by count_all() or warm() 
+		(which have no hits) are never left out, so the form may still exceed
+		max_persisted_size. 
+		
+		Finding the cursors to leave out takes several encodings of the form,
+		so they are only found again once the form has changed other than in
+		its page hits.
+		@param persisted_form: The persisted form, which is updated
+		@return: The persisted form
+		'''
+		if not self.max_persisted_size: return persisted_form
+		
+		retained_for = (dict(persisted_form, page_hits=None), 
+						self.max_persisted_size, self.page_size)
+		if self._retained_for and self._retained_for[0] == retained_for:
+			dropped = self._retained_for[1]
+		else:
+			dropped = self._get_dropped_offsets(persisted_form)
+			self._retained_for = (retained_for, dropped)
+		if dropped:
+			persisted_form['cursors'] = dict((o, c) for (o, c) in 
+						persisted_form['cursors'].items() if o not in dropped)
+		return persisted_form
+	
+	def _get_dropped_offsets(self, persisted_form):
+		'''Returns the offsets of the cursors _retain_cursors() leaves out of
+		a persisted form
+		@param persisted_form: The persisted form, which is not changed
+		@return: A set of integer offsets
+		'''
+		if len(encode_persisted_form(persisted_form))\
+			<= self.max_persisted_size:
+			return set()
+		
+		now = time.time()
+		cursors = persisted_form['cursors']
+		kept = set(self._walked_offsets)
+		if self.checkpoint_interval:
+			kept.update([self._page_offset(p) for p in self._get_checkpoints()])
+		if cursors:
+			kept.add(max(cursors.keys()))
+		retained_span = self.retention_interval * self.page_size
+		droppable = sorted([o for o in cursors.keys() if o not in kept 
+						and (not retained_span or o % retained_span)],
+						key=lambda o: (self._get_page_hits(o, now), -o))
+		
+		#find the fewest cursors to leave out by bisection, as the size of 
+		#the compressed encoding can only be found by encoding it
+		trial_form = dict(persisted_form)
+		(low, high) = (1, len(droppable))
+		while low < high:
+			middle = (low + high) // 2
+			trial_form['cursors'] = dict((o, c) for (o, c) in 
+						cursors.items() if o not in droppable[:middle])
+			if len(encode_persisted_form(trial_form))\
+				<= self.max_persisted_size:
+				high = middle
+			else:
+				low = middle + 1
+		return set(droppable[:high])
+	
 	def _persist_if_required(self):
 		'''Persists the persistable cached elements of the object for retrieval
-		in a separate request only if conditions are appropriate. 
+		in a separate request only if conditions are appropriate. Nothing is
+		persisted if a bookmark_secret is set, and a change of page hits 
+		alone is persisted at most every hit_persist_interval seconds.
 		@return: nothing
 		'''
+		if self.bookmark_secret: return
 		persisted_form = self._get_persisted_form()
 		
-		if (not self._last_persisted_as)\
-			or self._last_persisted_as != persisted_form:
+		if ((not self._last_persisted_as)\
+			or self._last_persisted_as != persisted_form)\
+			and not self._is_recent_hit_change(persisted_form):
 			
-			self._persist(persisted_form)
-			self._last_persisted_as = persisted_form
+			if self._batch:
+				#the batch persists all its queries at the end of the request
+				self._batch._add_pending(self)
+			else:
+				self._last_persisted_as = self._persist(persisted_form)
 			
+	def _is_recent_hit_change(self, persisted_form):
+		'''Returns True if a persisted form differs from the one last 
+		persisted only in its page hits, and the latest of the hits last 
+		persisted was within hit_persist_interval seconds. Hits change with 
+		every page fetched, so are otherwise persisted at most that often.
+		@param persisted_form: The persisted form
+		@return: True if the form need not be persisted
+		'''
+		last_form = self._last_persisted_as
+		if not last_form or dict(last_form, page_hits=None)\
+			!= dict(persisted_form, page_hits=None):
+			return False
+		hit_times = [t for (h, t) in last_form.get('page_hits', {}).values()]
+		return bool(hit_times)\
+			and time.time() - max(hit_times) < self.hit_persist_interval
+	
+	@_timed('memcache')
 	def _persist(self, persisted_form):
-		'''Persists the provided persisted form to the memcache peristence layer
+		'''Persists the provided persisted form to the in-process and memcache
+		peristence layers, and to the datastore if datastore_fallback is set.
+		
+		Other instances may have persisted cursors for the same query since 
+		this one was restored, so memcache is updated by a compare-and-set 
+		against the form read by the restore (or by an add if none was 
+		stored). Only if that fails, or the restore did not read memcache, is
+		the stored form read again and the cursors held there that this 
+		instance lacks merged in before the next attempt. If cas_retries 
+		attempts fail, the form is set regardless.
 		@param persisted_form: object to persist
-		@return: nothing
+		@return: the persisted form actually persisted, including any merged
+		cursors
 		''' 
-		memcache.Client().set(self._get_memcache_key(), persisted_form)
+		key = self._get_memcache_key()
+		client = self._get_memcache_client()
+		for attempt in range(self.cas_retries):
+			if self._cas_read is None:
+				persisted_form = self._read_for_cas(client, key)\
+					or persisted_form
+			data = encode_persisted_form(persisted_form)
+			if self._cas_read: written = client.cas(key, data)
+			else: written = client.add(key, data)
+			#the compare-and-set value is used up by the write either way
+			self._cas_read = None
+			if written: break
+			self._num_cas_retries += 1
+		else:
+			client.set(key, encode_persisted_form(persisted_form))
+		
+		_local_states.set(key, (time.time(), persisted_form))
+		if self.datastore_fallback:
+			self._put_state_entity(persisted_form)
 		self._num_persist += 1
+		return persisted_form
+	
+	def _read_for_cas(self, client, key):
+		'''Reads the form stored in memcache for a compare-and-set and merges 
+		it into the query
+		@param client: the memcache.Client to write with
+		@param key: the memcache key of the query
+		@return: the merged persisted form, or None if no form was merged
+		'''
+		data = client.gets(key)
+		self._cas_read = data is not None
+		stored_form = decode_persisted_form(data)
+		if not stored_form: return None
+		self._merge_persisted_form(stored_form)
+		return self._get_persisted_form()
+	
+	def _get_memcache_client(self):
+		'''Returns the memcache.Client used to persist the query, which holds
+		the compare-and-set values of the forms it read
+		@return: a memcache.Client
+		'''
+		if not self._memcache_client:
+			self._memcache_client = memcache.Client()
+		return self._memcache_client
+	
+	@_timed('datastore')
+	def _put_state_entity(self, persisted_form):
+		'''Stores a persisted form in the datastore
+		@param persisted_form: the persisted form to store
+		@return: nothing
+		'''
+		self._get_state_entity(persisted_form).put()
+	
+	def _merge_persisted_form(self, persisted_form):
+		'''Adds the cursors held in a persisted form to those of the query, 
+		where the query has none for the page. Cursors already held take 
+		precedence. The hits of each page are merged by keeping the higher.
+		@param persisted_form: a persisted form, such as one persisted by
+		another instance of the same query
+		@return: nothing
+		'''
+		self._add_offset_cursors(persisted_form['cursors'])
+		
+		#a known number of results, or the higher lower bound, is kept
+		result_count = persisted_form.get('result_count')
+		min_result_count = persisted_form['min_result_count'] or 0
+		if self._result_count is None:
+			if result_count is not None\
+				and result_count >= (self._min_result_count or 0):
+				self._result_count = result_count
+				self._min_result_count = None
+				self._counted_at = persisted_form.get('counted_at')
+				self._count_approximate = False
+			elif min_result_count > (self._min_result_count or 0):
+				self._min_result_count = min_result_count
+				self._counted_at = persisted_form.get('counted_at')
+				self._count_approximate = persisted_form.get(
+											'count_approximate', False)
+		if self._page_count is None:
+			self._page_count = self._get_known_page_count()
+		if self._result_count is not None\
+			and self._result_count == result_count:
+			for (offset, cursor) in persisted_form['reverse_cursors'].items():
+				self._reverse_cursors.setdefault(offset, cursor)
+		
+		#the hits of each page are taken from whichever form has more
+		now = time.time()
+		for (offset, page_hits) in persisted_form.get('page_hits', {}).items():
+			if _decay_hits(page_hits, now, self.hit_half_life)\
+				> self._get_page_hits(offset, now):
+				self._page_hits[offset] = page_hits
+		self._trim_page_hits(now)
+		for (offset, started_at) in persisted_form.get('lookahead_offsets', 
+													{}).items():
+			if started_at > self._lookahead_offsets.get(offset, 0):
+				self._lookahead_offsets[offset] = started_at
+	
+	def _get_state_entity(self, persisted_form):
+		'''Returns the datastore entity used to persist a persisted form when
+		datastore_fallback is set
+		@param persisted_form: object to persist
+		@return: A PagedQueryState entity
+		'''
+		return PagedQueryState(key_name=self._get_memcache_key(), 
+							state=db.Blob(encode_persisted_form(persisted_form)))
 			
 	def _restore_if_required(self):
-		'''Restores the persisted version of the PagedQuery if required.
+		'''Restores the persisted version of the PagedQuery if required. A
+		restore is only attempted once, unless the cache is cleared. Nothing is
+		restored if a bookmark_secret is set.
 		'''
-		if not self._last_persisted_as:
+		if self.bookmark_secret: return
+		if not self._last_persisted_as and not self._restored:
 			self._last_persisted_as = self._restore()
 	
 	def _restore(self):
@@ -477,14 +2093,82 @@ class PagedQuery(object):
 		within the query and returns the persisted form
 		@return: The persisted form 
 		'''
-		persisted_form = memcache.Client().get(self._get_memcache_key())
-		
+		persisted_form = self._load_persisted_form()
+		self._apply_persisted_form(persisted_form)
+		return persisted_form
+	
+	def _apply_persisted_form(self, persisted_form):
+		'''Sets the values within the query from a persisted form
+		@param persisted_form: The persisted form, or None if none was found
+		@return: nothing
+		'''
+		self._restored = True
 		if persisted_form:
-			self._page_cursors = [s for s in persisted_form['page_cursors']]
-			self._page_count = persisted_form['page_count']
+			self._page_cursors = [None]
+			self._offset_cursors = {}
+			self._add_offset_cursors(persisted_form['cursors'])
+			self._recent_pages = self._pages_at_offsets(
+											persisted_form['recent_offsets'])
+			self._result_count = persisted_form.get('result_count')
+			self._min_result_count = persisted_form['min_result_count']
+			self._counted_at = persisted_form.get('counted_at')
+			self._count_approximate = persisted_form.get('count_approximate',
+														False)
+			self._walked_offsets = set()
+			self._page_count = self._get_known_page_count()
+			self._reverse_cursors = dict(
+								persisted_form.get('reverse_cursors', {}))
+			self._page_hits = dict(persisted_form.get('page_hits', {}))
+			self._lookahead_offsets = dict(
+								persisted_form.get('lookahead_offsets', {}))
 			self._num_restore += 1
+	
+	@_timed('memcache')
+	def _load_persisted_form(self):
+		'''Returns the persisted form from the fastest persistence layer 
+		holding it: the in-process cache (if updated within local_state_time
+		seconds), then memcache, then the datastore (if datastore_fallback is
+		set). Slower layers refill the faster ones.
+		@return: The persisted form, or None if it is not persisted
+		'''
+		key = self._get_memcache_key()
+		persisted_form = self._get_local_form()
+		if persisted_form: return persisted_form
+		
+		#read for a compare-and-set, so _persist() need not read it again
+		data = self._get_memcache_client().gets(key)
+		self._cas_read = data is not None
+		persisted_form = decode_persisted_form(data)
+		if persisted_form is None and self.datastore_fallback:
+			state = self._get_state_entity_by_key(key)
+			if state:
+				persisted_form = decode_persisted_form(str(state.state))
+				memcache.Client().set(key, str(state.state))
+				self._cas_read = None
+		
+		if persisted_form:
+			_local_states.set(key, (time.time(), persisted_form))
 		return persisted_form
 	
+	@_timed('datastore')
+	def _get_state_entity_by_key(self, key):
+		'''Returns the PagedQueryState stored in the datastore for the query
+		@param key: the key name of the entity
+		@return: a PagedQueryState, or None if none is stored
+		'''
+		return PagedQueryState.get_by_key_name(key)
+	
+	def _get_local_form(self):
+		'''Returns the persisted form held in the in-process cache, provided it
+		was updated within local_state_time seconds
+		@return: The persisted form, or None
+		'''
+		local_state = _local_states.get(self._get_memcache_key())
+		if local_state and time.time() - local_state[0] < self.local_state_time:
+			self._num_local_restore += 1
+			return local_state[1]
+		return None
+	
 	def _get_memcache_key(self):
 		'''Returns the correct memcache key used to identify this query in
 		the memcache system
@@ -493,35 +2177,740 @@ class PagedQuery(object):
 		return namespace + '_PagedQuery-persistence_' + str(self.id)
 			
 	def _get_persisted_form(self):
-		'''Returns the form the PagedQuery information is persisted in
+		'''Returns the form the PagedQuery information is persisted in, which
+		does not depend on the page size. Cursors and recently used pages are 
+		keyed by result offset; when checkpointing, only the cursors of the
+		checkpoint and recently used pages are persisted. A lower bound on the
+		number of results is persisted if known, and once the exact number is
+		known, it is persisted with the reverse cursors. Either is persisted 
+		with the time it was learned, and a lower bound left by a walk that
+		ran out of time is marked as such. Page hits are persisted if 
+		recorded, as are the pages whose look-ahead started within 
+		lookahead_time seconds, and the coldest cursors are left out to fit 
+		max_persisted_size.
 		@return an object
 		'''
-		return {
-			'page_cursors':[s for s in self._page_cursors],
-			'page_count':self._page_count
+		if self.checkpoint_interval:
+			cursors = dict((self._page_offset(p), self._get_cursor_for_page(p)) 
+						for p in self._get_checkpoint_pages())
+		else:
+			cursors = self._get_offset_cursors()
+		persisted_form = {
+			'cursors':cursors,
+			'recent_offsets':[self._page_offset(p) for p in self._recent_pages],
+			'min_result_count':self._min_result_count
 			}
+		if self._counted_at is not None:
+			persisted_form['counted_at'] = self._counted_at
+		if self._count_approximate and self._result_count is None:
+			persisted_form['count_approximate'] = True
+		if self._result_count is not None:
+			persisted_form['result_count'] = self._result_count
+			persisted_form['reverse_cursors'] = dict(self._reverse_cursors)
+		if self._page_hits:
+			persisted_form['page_hits'] = dict(self._page_hits)
+		now = time.time()
+		lookahead_offsets = dict((o, t) for (o, t) 
+			in self._lookahead_offsets.items() if now - t < self.lookahead_time)
+		if lookahead_offsets:
+			persisted_form['lookahead_offsets'] = lookahead_offsets
+		return self._retain_cursors(persisted_form)
 									
 	page_size = property(fget=_get_page_size, fset=_set_page_size, 
 						doc='Configured page size of the PagedQuery')
 
 	id = property(fget=_get_query_id, doc='unique id of this query')
+	
+	prewalk_budget = property(fget=_get_prewalk_budget, 
+						fset=_set_prewalk_budget,
+						doc='Maximum keys-only queries used to walk to a page')
+	
+	checkpoint_interval = property(fget=_get_checkpoint_interval,
+						fset=_set_checkpoint_interval,
+						doc='Interval between pages whose cursors are persisted')
+
+
+class UnionPagedQuery(PagedQuery):
+	'''
+	This class is a PagedQuery over the sorted union of the results of 
+	several db.Query objects, which may be of different kinds. The queries
+	must have compatible sort orders, being ordered by the same property
+	names in the same directions. Like the sub-queries of a merged query 
+	(see PagedQuery), each query is run from its own cursor for page_size 
+	results per page, and the results are merged by the sort orders of the 
+	first query.
+	
+	USAGE:
+	
+	myFeed = UnionPagedQuery([Post.all().order('-created'), 
+							Comment.all().order('-created')], 20)
+	myResults = myFeed.fetch_page(2)
+	
+	The queries can not be altered by filter(), order() or ancestor() once 
+	the UnionPagedQuery is created. page_count() and count() total the 
+	counts of each query, which are made up to 1000 results each. Like 
+	merged queries, a union can not be walked by cursor, so warm() only 
+	counts its results.
+	'''
+	
+	def __init__(self, queries, page_size, **kwds):
+		'''
+		Constructor for a union paged query.
+		@param queries: a list of db.Query objects
+		@param page_size: a positive non-zero integer defining the size of 
+		each page.
+		@param kwds: the other arguments of PagedQuery
+		@raise TypeError: raised if queries is empty, any query is not a 
+		db.Query or the queries do not have the same sort orders
+		'''
+		if not queries:
+			raise TypeError('A union query requires at least one query')
+		for query in queries:
+			if not isinstance(query, db.Query):
+				raise TypeError('Query type not supported in a union: '\
+					+ type(query).__name__)
+			if query._Query__orderings != queries[0]._Query__orderings:
+				raise TypeError('The queries of a union must have the same '\
+					'sort orders')
+		
+		PagedQuery.__init__(self, queries[0], page_size, **kwds)
+		self._queries = list(queries)
+		self._query_type = 'Union'
+	
+	def fetch(self, limit, offset=0):
+		'''Returns the merged results of the queries, as per db.Query.fetch()
+		@param limit: Maximum amount of results to retrieve
+		@param offset: Number of results to skip
+		@return: A list of entities
+		'''
+		sub_results = [_copy_query(query).fetch(limit + offset) 
+					for query in self._queries]
+		return self._merge_sub_results(sub_results, limit + offset)[0][offset:]
+	
+	def count(self, limit=1000):
+		'''Returns the number of results of the queries, up to limit
+		@param limit: The maximum number of results to count.
+		@return: an integer number of results
+		'''
+		return min(sum([query.count(limit) for query in self._queries]), limit)
+	
+	def _count_results(self, limit=1000):
+		'''Counts the results of the queries, each up to a limit
+		@param limit: The maximum number of results of each query to count
+		@return: A tuple of the integer total number of results, and True if
+		the count of any query reached the limit so the total is only a lower
+		bound
+		'''
+		counts = [query.count(limit) for query in self._queries]
+		return (sum(counts), max(counts) >= limit)
+	
+	def _get_queries(self):
+		'''Returns the queries whose results are paged
+		@return: a list of queries
+		'''
+		return self._queries
+	
+	def _is_merged(self):
+		'''Returns True, as the results of the queries are always merged
+		@return: True
+		'''
+		return True
+	
+	def _generate_query_id(self):
+		'''Generates a query ID from the fingerprints of the queries
+		@return: a string ID
+		'''
+		return hashlib.sha1(' '.join([query_fingerprint(query) 
+							for query in self._queries])).hexdigest()
+	
+	def _get_page_cache_key(self, page_number):
+		'''Returns the memcache key a page is cached under. The key includes
+		the current generation of the kind of each query.
+		@param page_number: The non-zero positive integer page number
+		@return: A string memcache key
+		'''
+		return '%s_results_%d_%d_%s' % (self._get_memcache_key(), 
+					self.page_size, page_number, '_'.join([
+					str(self._get_generation(query._model_class.kind())) 
+					for query in self._queries]))
+
+
+class _MergeCandidate(object):
+	'''The next result of a sub-query, ordered in the heap used to merge the
+	results of sub-queries by a comparison function, then by sub-query.
+	'''
+	
+	def __init__(self, result, index, compare):
+		self.result = result
+		self.index = index
+		self.compare = compare
+	
+	def __cmp__(self, other):
+		return self.compare(self.result, other.result)\
+			or cmp(self.index, other.index)
+
+
+class PagedQueryBatch(object):
+	'''
+	This class coordinates the persistence of several PagedQuery objects used
+	in the same request. restore() restores every registered PagedQuery with a
+	single memcache get_multi() call, and persist() persists all of those with
+	changes using a compare-and-set of the forms restore() read, and an add 
+	of those it found missing. Registered PagedQuery
+	objects do not persist themselves. The in-process and datastore 
+	persistence layers are used as they are by an individual PagedQuery.
+	
+	USAGE:
+	
+	Register each PagedQuery as it is created, restore them all before 
+	fetching pages and persist them all at the end of the request:
+	
+	myBatch = PagedQueryBatch()
+	myPagedQuery = myBatch.register(PagedQuery(myQuery, 10))
+	myOtherPagedQuery = myBatch.register(PagedQuery(myOtherQuery, 10))
+	myBatch.restore()
+	... fetch pages ...
+	myBatch.persist()
+	
+	A registered PagedQuery used before restore() is called restores itself
+	individually.
+	'''
+	
+	def __init__(self):
+		'''
+		Constructor for a PagedQueryBatch.
+		'''
+		self._paged_queries = []
+		self._pending = []
+		self._client = memcache.Client()
+		
+		#the number of memcache calls reading, and writing, several keys
+		self._num_get_multi = 0
+		self._num_set_multi = 0
+	
+	def register(self, paged_query):
+		'''Registers a PagedQuery with the batch. The PagedQuery is persisted
+		by persist() rather than by itself from then on.
+		@param paged_query: A PagedQuery object
+		@return: The PagedQuery object
+		'''
+		paged_query._batch = self
+		self._paged_queries.append(paged_query)
+		return paged_query
+	
+	def restore(self):
+		'''Restores every registered PagedQuery not yet restored, using one
+		memcache get_multi() call (and, for those with datastore_fallback set,
+		one datastore get) for any not held in the in-process cache.
+		@return: nothing
+		'''
+		paged_queries = {}
+		for paged_query in self._paged_queries:
+			if not paged_query._last_persisted_as and not paged_query._restored\
+				and not paged_query.bookmark_secret:
+				paged_queries.setdefault(paged_query._get_memcache_key(), 
+										[]).append(paged_query)
+		
+		forms = {}
+		for (key, queries) in paged_queries.items():
+			local_form = queries[0]._get_local_form()
+			if local_form: forms[key] = local_form
+		
+		missing = [k for k in paged_queries.keys() if not forms.has_key(k)]
+		if missing:
+			#read for a compare-and-set, so persist() need not read them again
+			stored = self._client.get_multi(missing, for_cas=True)
+			for (k, data) in stored.items():
+				forms[k] = decode_persisted_form(data)
+			self._num_get_multi += 1
+			for k in missing:
+				for paged_query in paged_queries[k]:
+					paged_query._memcache_client = self._client
+					paged_query._cas_read = stored.has_key(k)
+			
+			fallback = [k for k in missing if not forms.get(k)
+					and paged_queries[k][0].datastore_fallback]
+			if fallback:
+				recovered = dict((s.key().name(), str(s.state))
+							for s in PagedQueryState.get_by_key_name(fallback)
+							if s is not None)
+				memcache.Client().set_multi(recovered)
+				self._num_set_multi += 1
+				for (k, data) in recovered.items():
+					forms[k] = decode_persisted_form(data)
+					for paged_query in paged_queries[k]:
+						paged_query._cas_read = None
+			
+			for k in missing:
+				if forms.get(k): _local_states.set(k, (time.time(), forms[k]))
+		
+		for (key, queries) in paged_queries.items():
+			for paged_query in queries:
+				paged_query._apply_persisted_form(forms.get(key))
+				paged_query._last_persisted_as = forms.get(key)
+	
+	def persist(self):
+		'''Persists every registered PagedQuery with changes using at most one
+		write of each kind: a compare-and-set of the forms restore() read 
+		from memcache, and an add of those it found missing. Queries whose
+		form restore() did not read from memcache (such as those restored 
+		from the in-process cache) are first read with one get_multi() call, 
+		merging in cursors persisted by other instances as 
+		PagedQuery._persist() does. Those with datastore_fallback set are 
+		written with one datastore put. Any PagedQuery whose write fails, 
+		such as one persisted by another instance since it was read, merges
+		and persists itself. So at most three memcache calls are made for the
+		batch, besides those of any failed writes. Call at the end of the 
+		request.
+		@return: nothing
+		'''
+		paged_queries = dict((q._get_memcache_key(), q) for q in self._pending
+					if q._last_persisted_as != q._get_persisted_form())
+		self._pending = []
+		if not paged_queries: return
+		
+		client = self._client
+		unread = [k for (k, q) in paged_queries.items() 
+				if q._cas_read is None or q._memcache_client is not client]
+		if unread:
+			stored = client.get_multi(unread, for_cas=True)
+			self._num_get_multi += 1
+			for key in unread:
+				paged_query = paged_queries[key]
+				paged_query._memcache_client = client
+				paged_query._cas_read = stored.has_key(key)
+				stored_form = decode_persisted_form(stored.get(key))
+				if stored_form: paged_query._merge_persisted_form(stored_form)
+		
+		forms = dict((k, q._get_persisted_form()) 
+					for (k, q) in paged_queries.items())
+		cas_forms = dict((k, encode_persisted_form(f)) 
+					for (k, f) in forms.items() if paged_queries[k]._cas_read)
+		add_forms = dict((k, encode_persisted_form(f)) 
+				for (k, f) in forms.items() if not paged_queries[k]._cas_read)
+		failed = []
+		if cas_forms:
+			failed += client.cas_multi(cas_forms)
+			self._num_set_multi += 1
+		if add_forms:
+			failed += client.add_multi(add_forms)
+			self._num_set_multi += 1
+		for paged_query in paged_queries.values():
+			#the compare-and-set values are used up by the writes either way
+			paged_query._cas_read = None
+		
+		entities = []
+		for (key, paged_query) in paged_queries.items():
+			if key in failed:
+				paged_query._last_persisted_as = paged_query._persist(forms[key])
+				continue
+			_local_states.set(key, (time.time(), forms[key]))
+			if paged_query.datastore_fallback:
+				entities.append(paged_query._get_state_entity(forms[key]))
+			paged_query._last_persisted_as = forms[key]
+			paged_query._num_persist += 1
+		if entities:
+			db.put(entities)
+	
+	def _add_pending(self, paged_query):
+		'''Records that a registered PagedQuery has changes to persist
+		@param paged_query: A registered PagedQuery object
+		@return: nothing
+		'''
+		if paged_query not in self._pending:
+			self._pending.append(paged_query)
+
+
+class PagedQueryState(db.Model):
+	'''The persisted form of a PagedQuery, stored in the datastore when
+	datastore_fallback is set. The key name is the PagedQuery's memcache key.
+	'''
+	
+	state = db.BlobProperty(required=True)
+	updated = db.DateTimeProperty(auto_now=True)
+
+
+def query_fingerprint(query):
+	'''Returns a stable fingerprint of a query. The fingerprint is a digest of
+	the query's kind, filters, orders, ancestor, keys-only setting and 
+	namespace (for db.Query) or GQL text and bound arguments (for 
+	db.GqlQuery). Semantically identical queries have the same fingerprint in
+	every process. The query's cursor does not affect the fingerprint.
+	
+	Queries of an unrecognised structure fall back to a digest of their 
+	pickled form.
+	@param query: a db.Query or db.GqlQuery object, or a facade (such as 
+	PrefetchingQuery) wrapping one
+	@return: a 40 character hexadecimal string
+	'''
+	while query.__dict__.has_key('_query'): query = query._query
+	
+	if isinstance(query, db.GqlQuery):
+		gql = query._proto_query
+		recognised = hasattr(gql, '_GQL__symbols')
+		parts = ('GqlQuery',
+				getattr(gql, '_GQL__symbols', None),
+				getattr(query, '_args', None),
+				getattr(query, '_kwds', None),
+				getattr(gql, '_GQL__namespace', None))
+	else:
+		model_class = getattr(query, '_model_class', None)
+		recognised = hasattr(query, '_Query__query_sets')
+		parts = ('Query',
+				model_class and model_class.kind(),
+				getattr(query, '_Query__query_sets', None),
+				getattr(query, '_Query__orderings', None),
+				getattr(query, '_Query__ancestor', None),
+				getattr(query, '_keys_only', None),
+				getattr(query, '_namespace', None))
+	
+	if recognised:
+		form = canonical_form(parts)
+	else:
+		form = pickle.dumps(query, 2)
+	return hashlib.sha1(form).hexdigest()
+
+def canonical_form(value):
+	'''Returns a string representing a value used in a query, such that equal
+	values always produce the same string. Model instances are represented by
+	their keys and unicode strings by their utf-8 encoding.
+	@param value: a value, or a list, tuple or dictionary of values
+	@return: a string
+	'''
+	if isinstance(value, (list, tuple)):
+		return '[%s]' % ','.join([canonical_form(v) for v in value])
+	elif isinstance(value, dict):
+		return '{%s}' % ','.join(['%s:%s' % (canonical_form(k), 
+											canonical_form(v)) 
+								for (k, v) in sorted(value.items())])
+	elif isinstance(value, db.Model):
+		return 'Key(%s)' % value.key()
+	elif isinstance(value, db.Key):
+		return 'Key(%s)' % value
+	elif isinstance(value, unicode):
+		return repr(value.encode('utf-8'))
+	elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+		return '%s(%s)' % (type(value).__name__, value.isoformat())
+	return repr(value)
+
+def encode_persisted_form(persisted_form):
+	'''Encodes the persisted form of a PagedQuery as a compact string. Cursors
+	are sorted by offset, decoded from base64 and each is stored as the 
+	number of leading bytes it shares with the previous cursor plus its 
+	remaining bytes, as the cursors of one query differ little. Reverse 
+	cursors are encoded the same way. Page hits are stored as single 
+	precision floats with the whole second of their last hit, and look-ahead
+	start times as double precision floats. The result is compressed and 
+	prefixed with a version byte.
+	@param persisted_form: a persisted form, as returned by 
+	PagedQuery._get_persisted_form()
+	@return: a string
+	'''
+	recent_offsets = persisted_form['recent_offsets']
+	min_result_count = persisted_form['min_result_count']
+	counted = persisted_form.has_key('result_count')
+	timed = persisted_form.has_key('counted_at')
+	hit = persisted_form.has_key('page_hits')
+	approximate = persisted_form.has_key('count_approximate')
+	looked_ahead = persisted_form.has_key('lookahead_offsets')
+	flags = (counted and 2 or 0) | (timed and 4 or 0) | (hit and 8 or 0)\
+		| (approximate and 16 or 0) | (looked_ahead and 32 or 0)
+	
+	parts = [struct.pack('>BiI', flags, 
+				min_result_count is None and -1 or min_result_count, 
+				len(recent_offsets))]
+	parts.extend(struct.pack('>I', o) for o in recent_offsets)
+	_encode_cursors(sorted(persisted_form['cursors'].items()), parts)
+	if counted:
+		parts.append(struct.pack('>i', persisted_form['result_count']))
+		_encode_cursors(sorted(persisted_form['reverse_cursors'].items()), parts)
+	if timed:
+		parts.append(struct.pack('>d', persisted_form['counted_at']))
+	if hit:
+		page_hits = sorted(persisted_form['page_hits'].items())
+		parts.append(struct.pack('>I', len(page_hits)))
+		parts.extend(struct.pack('>Ifi', o, hits, int(hit_at)) 
+					for (o, (hits, hit_at)) in page_hits)
+	if looked_ahead:
+		lookahead_offsets = sorted(persisted_form['lookahead_offsets'].items())
+		parts.append(struct.pack('>I', len(lookahead_offsets)))
+		parts.extend(struct.pack('>Id', o, started_at) 
+					for (o, started_at) in lookahead_offsets)
+	return chr(_persisted_form_version) + zlib.compress(''.join(parts))
+
+def decode_persisted_form(data):
+	'''Decodes a persisted form encoded by encode_persisted_form(). 
+	@param data: a string, or None
+	@return: the persisted form, or None if data is not a string, was encoded
+	with an unknown version or is corrupt
+	'''
+	if not isinstance(data, str) or not data\
+		or ord(data[0]) != _persisted_form_version:
+		return None
+	try:
+		return _decode_persisted_form(zlib.decompress(data[1:]))
+	except (zlib.error, struct.error, ValueError, OverflowError):
+		return None
+
+def _decode_persisted_form(data):
+	'''Decodes the decompressed encoding of a persisted form
+	@param data: the decompressed string
+	@return: the persisted form
+	@raise struct.error: raised if data is truncated
+	@raise ValueError: raised if data does not end with the persisted form
+	'''
+	(flags, min_result_count, num_recent) = struct.unpack_from('>BiI', data)
+	offset = struct.calcsize('>BiI')
+	recent_offsets = list(struct.unpack_from('>%dI' % num_recent, data, 
+											offset))
+	offset += 4 * num_recent
+	(entries, offset) = _decode_cursors(data, offset)
+	
+	if min_result_count < 0: min_result_count = None
+	persisted_form = {
+		'cursors':dict(entries),
+		'recent_offsets':recent_offsets,
+		'min_result_count':min_result_count
+		}
+	if flags & 2:
+		(persisted_form['result_count'],) = struct.unpack_from('>i', data, 
+																offset)
+		(entries, offset) = _decode_cursors(data, offset + 4)
+		persisted_form['reverse_cursors'] = dict(entries)
+	if flags & 4:
+		(persisted_form['counted_at'],) = struct.unpack_from('>d', data, offset)
+		offset += 8
+	if flags & 8:
+		(num_hits,) = struct.unpack_from('>I', data, offset)
+		offset += 4
+		persisted_form['page_hits'] = {}
+		for i in xrange(num_hits):
+			(o, hits, hit_at) = struct.unpack_from('>Ifi', data, offset)
+			offset += struct.calcsize('>Ifi')
+			persisted_form['page_hits'][o] = (hits, hit_at)
+	if flags & 16:
+		persisted_form['count_approximate'] = True
+	if flags & 32:
+		(num_lookaheads,) = struct.unpack_from('>I', data, offset)
+		offset += 4
+		persisted_form['lookahead_offsets'] = {}
+		for i in xrange(num_lookaheads):
+			(o, started_at) = struct.unpack_from('>Id', data, offset)
+			offset += struct.calcsize('>Id')
+			persisted_form['lookahead_offsets'][o] = started_at
+	if offset != len(data):
+		raise ValueError('Persisted form has %d bytes left over' 
+						% (len(data) - offset))
+	return persisted_form
+
+def _encode_cursors(entries, parts):
+	'''Appends the encoding of a list of result offsets and cursors to a list
+	of strings, as described in encode_persisted_form()
+	@param entries: a list of tuples of result offset and cursor (or None)
+	@param parts: the list of strings to append to
+	@return: nothing
+	'''
+	parts.append(struct.pack('>I', len(entries)))
+	previous = ''
+	for (result_offset, cursor) in entries:
+		if cursor is None:
+			parts.append(struct.pack('>IBHI', result_offset, _cursor_none, 0, 0))
+			continue
+		(cursor_type, data) = _pack_cursor(cursor)
+		shared = 0
+		limit = min(len(previous), len(data), 0xFFFF)
+		while shared < limit and previous[shared] == data[shared]: shared += 1
+		parts.append(struct.pack('>IBHI', result_offset, cursor_type, shared, 
+								len(data) - shared))
+		parts.append(data[shared:])
+		previous = data
+
+def _decode_cursors(data, offset):
+	'''Decodes a list of result offsets and cursors encoded by 
+	_encode_cursors()
+	@param data: the decompressed string
+	@param offset: the position in data the list starts at
+	@return: a tuple of the list of tuples of result offset and cursor, and the
+	position in data following the list
+	'''
+	(num_entries,) = struct.unpack_from('>I', data, offset)
+	offset += 4
+	
+	entries = []
+	previous = ''
+	for i in xrange(num_entries):
+		(result_offset, cursor_type, shared, length) = struct.unpack_from(
+														'>IBHI', data, offset)
+		offset += struct.calcsize('>IBHI')
+		if cursor_type == _cursor_none:
+			entries.append((result_offset, None))
+			continue
+		if offset + length > len(data):
+			raise struct.error('Cursor extends past the end of the data')
+		cursor = previous[:shared] + data[offset:offset + length]
+		offset += length
+		previous = cursor
+		entries.append((result_offset, _unpack_cursor(cursor_type, cursor)))
+	return (entries, offset)
+
+def _split_sub_cursor(cursor):
+	'''Returns the cursor of a sub-query held in a merged query's cursor and
+	the number of results to skip after it
+	@param cursor: the string held for the sub-query
+	@return: a tuple of the cursor (None for the first result) and an integer
+	'''
+	(cursor, separator, skip) = cursor.partition(_cursor_offset_separator)
+	return (cursor or None, int(skip or 0))
+
+def _join_sub_cursor(cursor, skip):
+	'''Returns the string held for a sub-query in a merged query's cursor
+	@param cursor: the cursor of the sub-query, or None for the first result
+	@param skip: the number of results to skip after the cursor
+	@return: a string
+	'''
+	if not skip: return cursor or ''
+	return '%s%s%d' % (cursor or '', _cursor_offset_separator, skip)
+
+def _pack_cursor(cursor):
+	'''Returns the compact form of a cursor: the bytes a base64 cursor 
+	decodes to, or the cursor itself if it is not base64 (such as the cursor
+	of a merged query)
+	@param cursor: a string cursor
+	@return: a tuple of the cursor type (_cursor_base64 or _cursor_raw) and 
+	the string data
+	'''
+	cursor = str(cursor)
+	try:
+		decoded = base64.urlsafe_b64decode(cursor)
+		if base64.urlsafe_b64encode(decoded) == cursor:
+			return (_cursor_base64, decoded)
+	except TypeError:
+		pass
+	return (_cursor_raw, cursor)
+
+def _unpack_cursor(cursor_type, data):
+	'''Returns the cursor a compact form returned by _pack_cursor() was 
+	made from
+	@param cursor_type: _cursor_base64 or _cursor_raw
+	@param data: the string data
+	@return: a string cursor
+	'''
+	if cursor_type == _cursor_base64:
+		return base64.urlsafe_b64encode(data)
+	return data
+
+def _digests_equal(digest, other_digest):
+	'''Compares two digests in a time independent of where they differ, so
+	that a signature can not be found by timing comparisons
+	@param digest: a string digest
+	@param other_digest: a string digest
+	@return: True if the digests are equal
+	'''
+	if len(digest) != len(other_digest): return False
+	difference = 0
+	for (a, b) in zip(digest, other_digest): difference |= ord(a) ^ ord(b)
+	return difference == 0
+
+def _decay_hits(page_hits, now, half_life):
+	'''Returns a page's hits halved for every half_life seconds since its last
+	hit
+	@param page_hits: A tuple of the number of hits at the last hit, and the
+	time of the last hit in seconds since the epoch
+	@param now: The current time, in seconds since the epoch
+	@param half_life: The number of seconds over which hits halve
+	@return: A float number of hits
+	'''
+	(hits, hit_at) = page_hits
+	return hits * 0.5 ** (max(now - hit_at, 0) / float(half_life))
+
+def _get_inequality_property(query):
+	'''Returns the property of a db.Query's inequality filters, which the 
+	datastore sorts its results by first
+	@param query: a db.Query
+	@return: a property name, or None if the query has no inequality filter
+	'''
+	for query_set in query._Query__query_sets:
+		for property_operator in query_set.keys():
+			parts = property_operator.split()
+			if len(parts) == 2 and parts[1] in _inequality_operators:
+				return parts[0]
+	return None
+
+def _get_sort_value(entity, name, direction):
+	'''Returns the value of an entity's property that the datastore sorts
+	the entity by. Of a list, that is the lowest value for an ascending order
+	and the highest for a descending order.
+	@param entity: a db.Model instance
+	@param name: the property name, or __key__
+	@param direction: datastore.Query.ASCENDING or datastore.Query.DESCENDING
+	@return: the value
+	'''
+	if name == '__key__': return entity.key()
+	
+	prop = entity.properties().get(name)
+	if prop: value = prop.get_value_for_datastore(entity)
+	else: value = getattr(entity, name, None)
+	
+	if isinstance(value, list):
+		if not value: return None
+		if direction == datastore.Query.DESCENDING: return max(value)
+		return min(value)
+	return value
+
+def _copy_query(query, keys_only=False):
+	'''Returns a copy of a query. The copy shares no state with the original,
+	so running it does not disturb the original's cursor. Cursors returned by
+	the copy can be used with the original query.
+	@param query: a db.Query or db.GqlQuery object, or a facade (such as 
+	PrefetchingQuery) wrapping one. Facades are not copied.
+	@param keys_only: if True, the copy returns keys rather than entities
+	@return: a query of the same type
+	'''
+	while query.__dict__.has_key('_query'): query = query._query
+	
+	copied_query = pickle.loads(pickle.dumps(query, 2))
+	if keys_only:
+		copied_query._keys_only = True
+		if isinstance(copied_query, db.GqlQuery):
+			copied_query._proto_query._keys_only = True
+	return copied_query
 
 
 class PageLinks:
 	'''This is an object representing a list of hyperlinks to a set of
 	pages.
+	
+	If the total number of pages is not known, supply a page_count of None 
+	and the PagedQuery being paged. Only the pages that would be linked to 
+	are then counted (see PagedQuery.count_pages()), and if further pages 
+	exist a '...' entry, with no url, follows the page links:
+	
+	myPageLinks = PageLinks(3, None, '/list', 'page', paged_query=myPagedQuery)
+	
+	If the PagedQuery has a bookmark_secret, supply a bookmark_field to add 
+	the bookmark of each page with a known cursor to its url (see 
+	PagedQuery.get_bookmark()):
+	
+	myPageLinks = PageLinks(3, None, '/list', 'page', paged_query=myPagedQuery,
+							bookmark_field='bm')
 	'''
 	
-	def __init__(self, page, page_count, url_root, page_field, page_range= 10):
+	def __init__(self, page, page_count, url_root, page_field, page_range= 10,
+				paged_query=None, bookmark_field=None):
 		'''intialises the PageLinks object with the information required
 		to generate the page link set
 		@param page: The current page
-		@param page_count: The total number of pages
+		@param page_count: The total number of pages, or None to count the
+		pages of paged_query as required
 		@param url_root: The start of the URL assigned to each page.
 		@param page_field: The name of the URL parameter to use for pages
 		@param page_range: number of pages in total to show, excluding previous
 		, next and current page. rounded down for odd numbers. Must be positive
 		and non-zero.
+		@param paged_query: The PagedQuery whose pages are linked to. Only
+		required if page_count is None or a bookmark_field is supplied
+		@param bookmark_field: The name of the URL parameter to use for 
+		bookmarks, or None to add no bookmarks
 		'''
 		
 		self.page = page
@@ -529,6 +2918,8 @@ class PageLinks:
 		self.url_root = url_root
 		self.page_field = page_field
 		self.page_range = page_range
+		self.paged_query = paged_query
+		self.bookmark_field = bookmark_field
 		
 	def get_links(self):
 		'''uses the initialisation information to return a list of links
@@ -536,35 +2927,58 @@ class PageLinks:
 		'''
 		#find the number of items to show either side (if possible)
 		i_side_range = self.page_range//2
+		
+		#count only the pages that may be shown, and one more
+		page_count = self.page_count
+		more_pages = False
+		if page_count is None:
+			last_page = max(2*i_side_range, self.page + i_side_range)
+			page_count = self.paged_query.count_pages(last_page + 1, 
+									max(self.page - i_side_range, 1))
+			more_pages = page_count > last_page
+			page_count = min(page_count, last_page)
+		
 		#create the appropriate page range to show
 		if self.page < i_side_range + 1: 
 			pages = range(1, 
-				self.page_count + 1 if self.page_count < (2*i_side_range) else (2*i_side_range)+1)
+				page_count + 1 if page_count < (2*i_side_range) else (2*i_side_range)+1)
 		else:
 			pages = range(self.page - i_side_range
-				, self.page_count + 1 if self.page_count < (self.page + i_side_range) 
+				, page_count + 1 if page_count < (self.page + i_side_range) 
 				else (self.page + i_side_range + 1))
 		
-		#determine whether parameters are already present in URL and set first 
-		#symbol appropriately.
-		first_symbol = '&' if self.url_root.count('?') else '?'
-		
-
 		#use page range to construct list
-		page_links =\
-			[(str(p),'%s%s%s=%d' % (self.url_root, first_symbol,self.page_field,p)) for p in pages]
+		page_links = [(str(p), self._get_url(p)) for p in pages]
+		
+		#show that there are more pages than those linked to
+		if more_pages:
+			page_links.append(('...', None))
 
 		#add a prev link if required
 		if self.page > 1:
-			prev_link  = ('Prev', '%s%s%s=%d' % 
-						(self.url_root, first_symbol, self.page_field, self.page - 1) )
+			prev_link  = ('Prev', self._get_url(self.page - 1))
 			page_links.insert(0,prev_link)
 		
 		#add a next link if required
-		if self.page < self.page_count:
-			next_link = ('Next', '%s%s%s=%d' % 
-						(self.url_root, first_symbol, self.page_field, self.page + 1) )
+		if self.page < page_count or more_pages:
+			next_link = ('Next', self._get_url(self.page + 1))
 			page_links.append(next_link)
 		
 		return page_links
-				
\ No newline at end of file
+				
+	
+	def _get_url(self, page):
+		'''Returns the url of a page, including its bookmark if a 
+		bookmark_field is set and a bookmark is available
+		@param page: The page number
+		@return: A string url
+		'''
+		#determine whether parameters are already present in URL and set first 
+		#symbol appropriately.
+		first_symbol = '&' if self.url_root.count('?') else '?'
+		url = '%s%s%s=%d' % (self.url_root, first_symbol, self.page_field, page)
+		
+		bookmark = self.bookmark_field and self.paged_query.get_bookmark(page)
+		if bookmark:
+			url += '&%s=%s' % (self.bookmark_field, bookmark)
+		return url
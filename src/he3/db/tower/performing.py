@@ -47,6 +47,14 @@ class PrefetchingQuery(object):
 	Note that PrefetchingQuery can also prefetch the entity's parent, if that 
 	is useful. Simply pass the string 'parent' in the list of reference 
 	properties to prefetch. 
+	
+	References of the prefetched entities can be prefetched too, by passing a
+	dotted path of property names (or 'parent') through them. Each level of
+	references is fetched with a single db.get(), and an entity referenced by
+	several paths is fetched once:
+	
+	myPrefetchingQuery = PrefetchingQuery(Post.all(), 
+									('author.role', 'topic.parent'))
 		
 	You can specify reference properties to prefetch using PrefetchingQuery in
 	3 ways (in the following order of precedence):
@@ -73,8 +81,9 @@ class PrefetchingQuery(object):
 		'''
 		Constructor for a PrefetchingQuery.
 		@param query: a google.appengine.ext.db.query or db.GqlQuery object
-		@param properties_to_prefetch: a list of reference property names
-			defining which properties to prefetch on a fetch() call. If not
+		@param properties_to_prefetch: a list of reference properties, their 
+			names or dotted paths of names defining which properties to 
+			prefetch on a fetch() call. If not
 			supplied, a class attribute is checked. If not present, properties
 			to dereference are automatically determined. 
 		
@@ -239,8 +248,10 @@ class PrefetchingQuery(object):
 		self._properties_to_prefetch = list_of_prop_names
 	
 	def _prefetch_refprops(self, entities, props):
-		'''This entire function almost identical to Nick Johnsons blog post 
-		referenced above. I need to think *really* hard to follow it. 
+		'''Based on Nick Johnsons blog post referenced above, extended to 
+		resolve dotted paths breadth-first: all the references at one depth
+		are fetched with a single db.get(), and each key is fetched only once
+		across every path and depth.
 		
 		Changes from Nicks Code: 
 		1. Filtered none values from set of keys passed to db.get(). There was an
@@ -254,31 +265,73 @@ class PrefetchingQuery(object):
 			from db.Get(). Skip populating those fields where an entity was not
 			returned. If an application does not clean up dangling references
 			this would otherwise cause errors at 'x.key()' 
+		
+		@param entities: the list of entities to prefetch references for
+		@param props: a list of reference properties, property names, 'parent'
+		or dotted paths of names such as 'author.role' (which also prefetches
+		'author')
+		@return: entities
 		'''
-		fields = [(entity, prop) for entity in entities for prop 
-				in props]
-		ref_keys = [x.key().parent() if prop == 'parent' else 
-				prop.get_value_for_datastore(x) for x, prop in fields]
-
-		ref_entities = dict((x.key(), x) for x in db.get(set(ref_keys)-set((None,)))
-						if x is not None)
-		for (entity, prop), ref_key in zip(fields, ref_keys): 
-			if ref_entities.has_key(ref_key):
+		paths = []
+		for prop in props:
+			if isinstance(prop, basestring): path = tuple(prop.split('.'))
+			else: path = (prop,)
+			for depth in range(1, len(path) + 1):
+				if path[:depth] not in paths: paths.append(path[:depth])
+		
+		#the entities reached by each path, and every entity fetched by key
+		reached = {():entities}
+		ref_entities = {}
+		for depth in range(1, max([len(path) for path in paths] or [0]) + 1):
+			fields = []
+			for path in [p for p in paths if len(p) == depth]:
+				reached[path] = []
+				for entity in reached[path[:-1]]:
+					(prop, ref_key) = PrefetchingQuery._get_reference(entity, 
+																	path[-1])
+					if ref_key: fields.append((path, entity, prop, ref_key))
+			
+			ref_keys = list(set([ref_key for (path, entity, prop, ref_key) 
+							in fields if not ref_entities.has_key(ref_key)]))
+			if ref_keys:
+				ref_entities.update(zip(ref_keys, db.get(ref_keys)))
+			
+			reached_keys = set()
+			for (path, entity, prop, ref_key) in fields:
+				ref_entity = ref_entities[ref_key]
+				if ref_entity is None:
+					#We couldn't retrieve a referential entity for the current 
+					#entity,prop pair. This can happen if a App Engine 
+					#application deleted entities without cleaning up the 
+					#entities that reference them. This why simply testing 
+					#referential entities on retrieval, without purposefully 
+					#cleaning up dangling references, sucks.
+					#</rant>
+					continue
 				if prop == 'parent': 
 					# Big warning ! Using internals of Model (might	break in the future)
-					if ref_key:entity._parent = ref_entities[ref_key] 
+					entity._parent = ref_entity
 				else:
-					if ref_key:prop.__set__(entity, ref_entities[ref_key])
-			else:
-				#We couldn't retrieve a referential entity for the current 
-				#entity,prop pair. This can happen if a App Engine application
-				#deleted entities without cleaning up the entities that reference
-				#them. This why simply testing referential entities on retrieval,
-				#without purposefully cleaning up dangling references, sucks.
-				#</rant>
-				pass 
+					prop.__set__(entity, ref_entity)
+				if (path, ref_key) not in reached_keys:
+					reached_keys.add((path, ref_key))
+					reached[path].append(ref_entity)
 		return entities
 	
+	@staticmethod
+	def _get_reference(entity, prop):
+		'''Returns the reference property of an entity and the key it holds
+		@param entity: a model instance
+		@param prop: a reference property, the name of one, or 'parent'
+		@return: a tuple of the property (or 'parent') and the key, which is
+		None if the entity holds no reference by that property
+		'''
+		if prop == 'parent': return ('parent', entity.key().parent())
+		
+		if isinstance(prop, basestring): prop = entity.properties().get(prop)
+		if not isinstance(prop, db.ReferenceProperty): return (None, None)
+		return (prop, prop.get_value_for_datastore(entity))
+	
 	@staticmethod
 	def _get_properties_defined_in_class(entity_instance):
 		'''Returns the properties to prefetch that are defined on the class of
@@ -0,0 +1,214 @@
+'''
+This module contains classes and functions for warming the persisted state of
+paged queries in the background, using the task queue, so that their deep
+pages stay served from cursors after the results change.
+'''
+import google.appengine.ext.db as db
+from google.appengine.ext import webapp
+import pickle
+import time
+
+try:
+	from google.appengine.api import taskqueue
+except ImportError:
+	from google.appengine.api.labs import taskqueue
+
+from he3.db.tower.paging import PagedQuery, UnionPagedQuery
+
+namespace = 'he3'
+
+#the URL WarmingHandler is mapped to, and the queue its tasks are added to
+warming_url = '/_he3/warming'
+warming_queue = 'default'
+
+#warming tasks for the same query are named alike within each interval of
+#this many seconds, so at most one is added per interval
+warming_interval = 60
+
+#the default number of pages walked page by page when warming, and the number
+#of seconds a warming task spends counting the rest of the results
+warming_pages = 100
+warming_deadline = 20
+
+#functions returning the paged queries warmed on a schedule
+_scheduled_queries = []
+
+#the PagedQuery class attributes that affect the persisted state, carried
+#to warming tasks so that overrides of them are applied when warming
+_warmed_attributes = ('max_checkpoints', 'recent_page_limit', 
+					'max_persisted_size', 'hit_half_life', 'hit_page_limit', 
+					'count_batch_size', 'cas_retries')
+
+class WarmedModel(db.Model):
+	'''
+	This class is a base for models whose paged queries are warmed in the
+	background (see warm_in_background()) whenever one of its entities is
+	written. The queries are listed in the warmed_queries class attribute as
+	functions taking the written entity and returning a PagedQuery:
+
+	class Post(WarmedModel):
+		warmed_queries = (
+			lambda post: PagedQuery(Post.all().order('-created'), 20),
+			lambda post: PagedQuery(Post.all().filter('topic =', post.topic)
+									.order('-created'), 20))
+
+	Writes made within the same warming_interval share one warming task,
+	which runs warming_delay seconds after the interval ends. Entities
+	written with the module level db.put() and db.delete() functions do not
+	warm any queries. Call warm_queries() after using them.
+	'''
+
+	warmed_queries = ()
+	warming_delay = 10
+
+	def put(self):
+		'''Writes the entity to the datastore as per db.Model.put(), then
+		warms its queries in the background
+		@return: the key of the entity
+		'''
+		key = super(WarmedModel, self).put()
+		self.warm_queries()
+		return key
+
+	def delete(self):
+		'''Deletes the entity from the datastore as per db.Model.delete(),
+		then warms its queries in the background
+		@return: nothing
+		'''
+		super(WarmedModel, self).delete()
+		self.warm_queries()
+
+	def warm_queries(self):
+		'''Adds a warming task for each of the entity's warmed_queries, unless
+		one was already added in the current warming_interval
+		@return: nothing
+		'''
+		for get_paged_query in self.warmed_queries:
+			warm_in_background(get_paged_query(self),
+							delay=self.warming_delay)
+
+
+class WarmingHandler(webapp.RequestHandler):
+	'''
+	This class is a request handler that runs warming tasks, and adds warming
+	tasks for the queries registered by schedule_warming() when requested by
+	cron. Map it to warming_url with administrator login required:
+
+	application = webapp.WSGIApplication([(warming.warming_url,
+										warming.WarmingHandler)])
+
+	- url: /_he3/warming
+	  script: main.py
+	  login: admin
+
+	and request it from cron.yaml to warm the scheduled queries:
+
+	- description: warm paged queries
+	  url: /_he3/warming
+	  schedule: every 10 minutes
+
+	Requests not made by the task queue or by cron are refused.
+	'''
+
+	def get(self):
+		'''Adds a warming task for each scheduled query'''
+		if not self.request.headers.get('X-AppEngine-Cron'):
+			self.error(403)
+			return
+		for get_paged_query in _scheduled_queries:
+			warm_in_background(get_paged_query())
+
+	def post(self):
+		'''Warms the query held in the payload of a warming task'''
+		#App Engine strips this header from requests made from outside, so 
+		#only the task queue can get a body unpickled by warm_from_payload()
+		if not self.request.headers.get('X-AppEngine-QueueName'):
+			self.error(403)
+			return
+		warm_from_payload(self.request.body)
+
+
+def schedule_warming(get_paged_query):
+	'''Registers a paged query to be warmed whenever WarmingHandler is
+	requested by cron. Call it when your handler module is imported:
+
+	warming.schedule_warming(lambda: PagedQuery(Post.all().order('-created'),
+											20))
+	@param get_paged_query: a function taking no arguments and returning a
+	PagedQuery
+	@return: nothing
+	'''
+	_scheduled_queries.append(get_paged_query)
+
+def warm_in_background(paged_query, max_pages=None, delay=0):
+	'''Adds a task to warm a paged query (see PagedQuery.warm()) after the
+	current warming_interval ends, unless one was already added for the
+	query in the interval. The task is handled by WarmingHandler.
+	@param paged_query: a PagedQuery or UnionPagedQuery
+	@param max_pages: the number of pages to walk page by page, or None for
+	warming_pages
+	@param delay: the number of seconds after the interval ends to run the
+	task
+	@return: True if a task was added, False if one already had been
+	'''
+	if max_pages is None: max_pages = warming_pages
+
+	now = time.time()
+	interval = int(now // warming_interval)
+	task = taskqueue.Task(url=warming_url,
+				payload=_get_payload(paged_query, max_pages),
+				headers={'Content-Type':'application/octet-stream'},
+				name='%s-warming-%s-%d' % (namespace, paged_query.id, interval),
+				countdown=(interval + 1) * warming_interval - now + delay)
+	try:
+		task.add(warming_queue)
+	except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+		return False
+	return True
+
+def warm_from_payload(payload):
+	'''Warms the paged query held in the payload of a warming task. As 
+	unpickling can run arbitrary code, the payload must only come from a 
+	task added by warm_in_background(), such as the body of a request whose
+	X-AppEngine-QueueName header has been checked.
+	@param payload: the string payload
+	@return: the warmed PagedQuery
+	'''
+	settings = pickle.loads(payload)
+	(queries, page_size) = (settings.pop('queries'), settings.pop('page_size'))
+	max_pages = settings.pop('max_pages')
+	attributes = settings.pop('attributes')
+	if settings.pop('union'):
+		paged_query = UnionPagedQuery(queries, page_size, **settings)
+	else:
+		paged_query = PagedQuery(queries[0], page_size, **settings)
+	for (name, value) in attributes.items():
+		setattr(paged_query, name, value)
+	paged_query.warm(max_pages, warming_deadline)
+	return paged_query
+
+def _get_payload(paged_query, max_pages):
+	'''Returns the payload of a task to warm a paged query, holding its
+	queries and the settings and _warmed_attributes that affect its 
+	persisted state
+	@param paged_query: a PagedQuery or UnionPagedQuery
+	@param max_pages: the number of pages to walk page by page
+	@return: a string payload
+	'''
+	queries = []
+	for query in paged_query._get_queries():
+		#facades such as PrefetchingQuery are not needed to walk the results
+		while query.__dict__.has_key('_query'): query = query._query
+		queries.append(query)
+
+	return pickle.dumps({
+		'queries':queries,
+		'union':isinstance(paged_query, UnionPagedQuery),
+		'page_size':paged_query.page_size,
+		'max_pages':max_pages,
+		'checkpoint_interval':paged_query.checkpoint_interval,
+		'datastore_fallback':paged_query.datastore_fallback,
+		'count_ttl':paged_query.count_ttl,
+		'attributes':dict((name, getattr(paged_query, name)) 
+						for name in _warmed_attributes)
+		}, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,244 @@
+'''
+Benchmarks of he3.db.tower.paging.PagedQuery access patterns.
+
+The local datastore stub is filled with synthetic datasets, and for each
+dataset a set of access patterns is run against a PagedQuery:
+
+	progressive - pages 1, 2, 3 ... in turn, one request per page
+	random - jumps to random pages
+	deep - jumps straight to the last page on a new query
+	back-and-forth - forward a few pages, back a few pages, and so on
+	concurrent - two overlapping requests at a time, each restoring the
+	persisted state before the other persists its own
+
+For each pattern the number of datastore and memcache RPCs (by call), the
+bytes of memcache traffic, the size of the persisted state and the wall time
+are reported. Results are saved as JSON, and can be compared with the results
+of an earlier run:
+
+python Benchmark_Paging.py --output=baseline.json
+python Benchmark_Paging.py --output=latest.json --baseline=baseline.json
+
+The App Engine SDK, including its lib/django, and the src folder must be on
+the python path. Filling the largest dataset takes a long time; use --sizes
+to choose smaller ones.
+'''
+import google.appengine.ext.db as db
+import google.appengine.api.memcache as memcache
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+from django.utils import simplejson
+import optparse
+import os
+import random
+import time
+
+from he3.db.tower import paging
+from he3.db.tower.paging import PagedQuery
+
+class BenchmarkEntity(db.Model):
+	'''An entity of a synthetic dataset'''
+
+	dataset = db.StringProperty(required=True)
+	rank = db.IntegerProperty(required=True)
+	text = db.StringProperty()
+
+
+class RPCCounter(object):
+	'''
+	This class counts the RPCs made through the API proxy, and the bytes of
+	their requests and responses, when registered as a post-call hook.
+	'''
+
+	def __init__(self):
+		self.reset()
+
+	def __call__(self, service, call, request, response):
+		name = '%s.%s' % (service, call)
+		self.calls[name] = self.calls.get(name, 0) + 1
+		self.bytes[service] = self.bytes.get(service, 0)\
+			+ request.ByteSize() + response.ByteSize()
+
+	def reset(self):
+		'''Discards the counts so far
+		@return: nothing
+		'''
+		self.calls = {}
+		self.bytes = {}
+
+	def count_calls(self, service):
+		'''Returns the number of calls made to a service
+		@param service: the service name, such as 'memcache'
+		@return: an integer number of calls
+		'''
+		return sum([n for (name, n) in self.calls.items()
+					if name.startswith(service + '.')])
+
+
+def setup_stubs(app_id='he3-lib'):
+	'''Registers new, empty datastore and memcache stubs, and an RPCCounter
+	@param app_id: the application id to use
+	@return: the RPCCounter
+	'''
+	os.environ['APPLICATION_ID'] = app_id
+	apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+	apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+				datastore_file_stub.DatastoreFileStub(app_id, None, None))
+	apiproxy_stub_map.apiproxy.RegisterStub('memcache',
+											memcache_stub.MemcacheStub())
+
+	counter = RPCCounter()
+	apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpc-counter',
+														counter)
+	return counter
+
+def fill_dataset(name, size, batch_size=500):
+	'''Puts a synthetic dataset of entities into the datastore
+	@param name: the string name of the dataset
+	@param size: the number of entities
+	@param batch_size: the number of entities put at a time
+	@return: nothing
+	'''
+	for start in range(0, size, batch_size):
+		db.put([BenchmarkEntity(dataset=name, rank=rank, text='item %d' % rank)
+				for rank in range(start, min(start + batch_size, size))])
+
+def create_paged_query(name, page_size):
+	'''Returns a PagedQuery over a dataset, as created by a new request
+	@param name: the string name of the dataset
+	@param page_size: the page size
+	@return: a PagedQuery
+	'''
+	paged_query = PagedQuery(BenchmarkEntity.all().filter('dataset =', name)
+							.order('rank'), page_size)
+	#each request is treated as though served by a different instance
+	paged_query.local_state_time = 0
+	return paged_query
+
+def run_progressive(name, page_count, page_size, rng):
+	'''Fetches pages 1, 2, 3 ... one request per page'''
+	for page_number in range(1, min(page_count, 50) + 1):
+		create_paged_query(name, page_size).fetch_page(page_number)
+
+def run_random(name, page_count, page_size, rng):
+	'''Fetches random pages, one request per page'''
+	for i in range(20):
+		create_paged_query(name, page_size).fetch_page(
+												rng.randint(1, page_count))
+
+def run_deep(name, page_count, page_size, rng):
+	'''Fetches the last page, then the one before it'''
+	create_paged_query(name, page_size).fetch_page(page_count)
+	create_paged_query(name, page_size).fetch_page(max(page_count - 1, 1))
+
+def run_back_and_forth(name, page_count, page_size, rng):
+	'''Moves forward five pages and back three, one request per page'''
+	page_number = 1
+	for i in range(10):
+		for step in [1] * 5 + [-1] * 3:
+			page_number = min(max(page_number + step, 1), page_count)
+			create_paged_query(name, page_size).fetch_page(page_number)
+
+def run_concurrent(name, page_count, page_size, rng):
+	'''Fetches successive pages with two overlapping requests at a time'''
+	for page_number in range(1, min(page_count, 50), 2):
+		first = create_paged_query(name, page_size)
+		second = create_paged_query(name, page_size)
+		for paged_query in (first, second):
+			paged_query.id
+			paged_query._restore_if_required()
+		first.fetch_page(page_number)
+		second.fetch_page(page_number + 1)
+
+patterns = [('progressive', run_progressive), ('random', run_random),
+			('deep', run_deep), ('back-and-forth', run_back_and_forth),
+			('concurrent', run_concurrent)]
+
+def run_pattern(counter, name, size, page_size, pattern, seed):
+	'''Runs an access pattern from an empty cache and measures it
+	@return: a dictionary of measurements
+	'''
+	memcache.flush_all()
+	paging._local_states.clear()
+	page_count = max((size + page_size - 1) // page_size, 1)
+
+	counter.reset()
+	started = time.time()
+	pattern(name, page_count, page_size, random.Random(seed))
+	wall_time = time.time() - started
+	calls = dict(counter.calls)
+	memcache_bytes = counter.bytes.get('memcache', 0)
+
+	paged_query = create_paged_query(name, page_size)
+	state = memcache.get(paged_query._get_memcache_key())
+	return {
+		'rpcs':calls,
+		'datastore_calls':counter.count_calls('datastore_v3'),
+		'memcache_calls':counter.count_calls('memcache'),
+		'memcache_bytes':memcache_bytes,
+		'state_bytes':len(state or ''),
+		'wall_time':wall_time
+		}
+
+def run_benchmarks(sizes, page_size, seed):
+	'''Fills a dataset of each size and runs every access pattern on it
+	@return: a dictionary of results by dataset and pattern
+	'''
+	counter = setup_stubs()
+	results = {}
+	for size in sizes:
+		name = 'dataset-%d' % size
+		fill_dataset(name, size)
+		results[name] = {}
+		for (pattern_name, pattern) in patterns:
+			results[name][pattern_name] = run_pattern(counter, name, size,
+												page_size, pattern, seed)
+			print '%s %s: %s' % (name, pattern_name,
+							_summarise(results[name][pattern_name]))
+	return results
+
+def compare_results(results, baseline):
+	'''Prints the change in each measurement from a baseline
+	@param results: results as returned by run_benchmarks()
+	@param baseline: earlier results of the same form
+	@return: nothing
+	'''
+	for (name, dataset_results) in sorted(results.items()):
+		for (pattern_name, measurements) in sorted(dataset_results.items()):
+			base = baseline.get(name, {}).get(pattern_name)
+			if not base: continue
+			changes = ['%s %+g' % (k, measurements[k] - base[k])
+					for k in sorted(measurements.keys())
+					if k != 'rpcs' and base.has_key(k)]
+			print '%s %s vs baseline: %s' % (name, pattern_name,
+											', '.join(changes))
+
+def _summarise(measurements):
+	'''Returns the measurements other than individual RPCs as a string'''
+	return ', '.join(['%s %g' % (k, v) for (k, v) in
+					sorted(measurements.items()) if k != 'rpcs'])
+
+def main():
+	parser = optparse.OptionParser()
+	parser.add_option('--sizes', default='10000,100000,1000000',
+					help='comma separated dataset sizes')
+	parser.add_option('--page-size', type='int', default=20)
+	parser.add_option('--seed', type='int', default=1)
+	parser.add_option('--output', help='file to save the results to as JSON')
+	parser.add_option('--baseline', help='JSON results to compare with')
+	(options, args) = parser.parse_args()
+
+	results = run_benchmarks([int(s) for s in options.sizes.split(',')],
+							options.page_size, options.seed)
+	if options.output:
+		output = open(options.output, 'w')
+		try: simplejson.dump(results, output, sort_keys=True, indent=2)
+		finally: output.close()
+	if options.baseline:
+		baseline_file = open(options.baseline)
+		try: compare_results(results, simplejson.load(baseline_file))
+		finally: baseline_file.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,8 @@
+'''
+Benchmark package for he3-lib testing
+
+This package contains benchmarks of he3-appengine-lib, run offline against the
+App Engine SDK's datastore and memcache stubs rather than by gaeunit. Each
+benchmark module can be run as a script; see its docstring for usage.
+
+'''
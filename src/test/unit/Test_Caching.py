@@ -0,0 +1,130 @@
+import google.appengine.ext.db as db
+import google.appengine.api.memcache as memcache
+
+from he3.db.tower.caching import EntityCache, GenerationalModel, \
+	serialize_entities, deserialize_entities, get_generation, bump_generation
+from gaeunit import GAETestCase
+
+class EntityCacheTest(GAETestCase):
+	'''Contains tests for the he3.db.tower.caching.EntityCache class'''
+	
+	def setUp(self):
+		memcache.flush_all()
+		self.util_create_test_item_data()
+	
+	def test_get(self):
+		'''Tests that get() returns entities in key order'''
+		
+		cache = EntityCache()
+		keys = [self.item3.key(), self.item1.key(), self.item2.key()]
+		
+		#test 1 - entities are returned in the order of the keys
+		items = cache.get(keys)
+		self.assertTrue([i.name for i in items] == ['item3', 'item1', 'item2'])
+		
+		#test 2 - string keys are supported, and duplicate keys are returned
+		#once for each time they appear
+		items = cache.get([str(self.item1.key()), self.item1.key()])
+		self.assertTrue(len(items) == 2)
+		self.assertTrue(items[0].name == 'item1' and items[1].name == 'item1')
+		
+		#test 3 - keys without entities return None
+		self.item2.delete()
+		items = EntityCache().get([self.item1.key(), db.Key.from_path(
+								'CachedTestEntity', 'missing')])
+		self.assertTrue(items[0].name == 'item1')
+		self.assertTrue(items[1] is None)
+		
+	def test_tiers(self):
+		'''Tests that each tier of the cache is used in turn'''
+		
+		keys = [self.item1.key(), self.item2.key()]
+		
+		#test 1 - the first get() goes to the datastore
+		cache = EntityCache()
+		cache.get(keys)
+		self.assertTrue(cache._num_datastore_gets == 1)
+		self.assertTrue(cache._num_memcache_hits == 0)
+		
+		#test 2 - the second get() is served locally
+		cache.get(keys)
+		self.assertTrue(cache._num_datastore_gets == 1)
+		self.assertTrue(cache._num_local_hits == 2)
+		
+		#test 3 - a new cache (ie a new request) is served from memcache
+		cache = EntityCache()
+		items = cache.get(keys)
+		self.assertTrue(cache._num_datastore_gets == 0)
+		self.assertTrue(cache._num_memcache_hits == 2)
+		self.assertTrue(items[1].name == 'item2')
+		
+		#test 4 - deleted keys are retrieved from the datastore again
+		cache.delete([self.item1.key()])
+		cache.get(keys)
+		self.assertTrue(cache._num_datastore_gets == 1)
+		
+	def test_serialization(self):
+		'''Tests entities survive serialization'''
+		
+		data = serialize_entities([self.item1, None])
+		items = deserialize_entities(data)
+		self.assertTrue(items[0].key() == self.item1.key())
+		self.assertTrue(items[0].name == 'item1')
+		self.assertTrue(items[1] is None)
+	
+	def util_create_test_item_data(self):
+		'''creates a set of test data'''
+		
+		self.item1 = CachedTestEntity(name='item1')
+		self.item1.put()
+		self.item2 = CachedTestEntity(name='item2')
+		self.item2.put()
+		self.item3 = CachedTestEntity(name='item3')
+		self.item3.put()
+
+class GenerationTest(GAETestCase):
+	'''Contains tests for kind generations in he3.db.tower.caching'''
+	
+	def test_generation(self):
+		'''Tests that generations change when bumped'''
+		
+		#test 1 - the generation is stable until bumped
+		generation = get_generation('GenerationTestKind')
+		self.assertTrue(generation == get_generation('GenerationTestKind'))
+		
+		#test 2 - bumping changes the generation of that kind only
+		other_generation = get_generation('OtherGenerationTestKind')
+		bump_generation('GenerationTestKind')
+		self.assertTrue(generation != get_generation('GenerationTestKind'))
+		self.assertTrue(other_generation == 
+					get_generation('OtherGenerationTestKind'))
+		
+		#test 3 - a generation lost from memcache is not reused
+		generation = get_generation('GenerationTestKind')
+		memcache.delete('he3_generation_GenerationTestKind')
+		self.assertTrue(generation != get_generation('GenerationTestKind'))
+		
+	def test_generational_model(self):
+		'''Tests that writing a GenerationalModel changes its generation'''
+		
+		generation = get_generation(GenerationalTestEntity.kind())
+		thing = GenerationalTestEntity(name='thing')
+		thing.put()
+		put_generation = get_generation(GenerationalTestEntity.kind())
+		self.assertTrue(generation != put_generation)
+		
+		thing.delete()
+		self.assertTrue(put_generation != 
+					get_generation(GenerationalTestEntity.kind()))
+
+class CachedTestEntity(db.Model):
+	'''This is an entity to be used for testing purposes. It is intended to be
+	application agnostic'''
+	
+	name = db.StringProperty(required=True)
+
+class GenerationalTestEntity(GenerationalModel):
+	'''This is an entity to be used for testing purposes. It is intended to be
+	application agnostic'''
+	
+	name = db.StringProperty(required=True)
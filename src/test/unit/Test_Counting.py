@@ -0,0 +1,191 @@
+import google.appengine.ext.db as db
+import google.appengine.api.memcache as memcache
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import deferred
+import base64
+
+from he3.db.tower.counting import ShardedCounter, CountedModel, get_counter,\
+	get_query_counter
+from he3.db.tower.paging import PagedQuery
+from gaeunit import GAETestCase
+
+class ShardedCounterTest(GAETestCase):
+	'''Contains tests for the he3.db.tower.counting.ShardedCounter class'''
+	
+	def test_increment(self):
+		'''Tests that increments are reflected in the count'''
+		
+		counter = ShardedCounter('test_increment')
+		start = counter.count()
+		
+		#test 1 - increments add to the count
+		counter.increment()
+		counter.increment(2)
+		self.assertTrue(counter.count() == start + 3)
+		
+		#test 2 - negative increments subtract from the count
+		counter.increment(-1)
+		self.assertTrue(counter.count() == start + 2)
+		
+		#test 3 - the count is the same for a new counter of the same name
+		self.assertTrue(ShardedCounter('test_increment').count() == start + 2)
+		
+		#test 4 - the count is correct when not cached
+		ShardedCounter('test_increment_uncached').increment(5)
+		counter = ShardedCounter('test_increment_uncached')
+		memcache.delete(counter._get_memcache_key())
+		self.assertTrue(counter.count() == 5)
+		
+class CountedModelTest(GAETestCase):
+	'''Contains tests for the he3.db.tower.counting.CountedModel class'''
+	
+	def test_put_and_delete(self):
+		'''Tests that put() and delete() keep counters up to date'''
+		
+		all_counter = get_counter(CountedTestEntity)
+		red_counter = get_counter(CountedTestEntity, colour='red')
+		blue_counter = get_counter(CountedTestEntity, colour=u'blue')
+		all_start = all_counter.count()
+		red_start = red_counter.count()
+		blue_start = blue_counter.count()
+		
+		#test 1 - new entities are counted
+		thing1 = CountedTestEntity(colour='red')
+		thing1.put()
+		thing2 = CountedTestEntity(colour='red')
+		thing2.put()
+		self.assertTrue(all_counter.count() == all_start + 2)
+		self.assertTrue(red_counter.count() == red_start + 2)
+		
+		#test 2 - putting an unchanged entity does not count it again
+		thing1.put()
+		self.assertTrue(all_counter.count() == all_start + 2)
+		
+		#test 3 - changing a counted value moves the entity between counters
+		thing2 = CountedTestEntity.get(thing2.key())
+		thing2.colour = 'blue'
+		thing2.put()
+		self.assertTrue(all_counter.count() == all_start + 2)
+		self.assertTrue(red_counter.count() == red_start + 1)
+		self.assertTrue(blue_counter.count() == blue_start + 1)
+		
+		#test 4 - deleting an entity uncounts it
+		CountedTestEntity.get(thing1.key()).delete()
+		self.assertTrue(all_counter.count() == all_start + 1)
+		self.assertTrue(red_counter.count() == red_start)
+		
+	def test_put_over_key_name(self):
+		'''Tests that a new instance put over a stored entity is not counted
+		again'''
+		
+		red_counter = get_counter(CountedTestEntity, colour='red-key-name')
+		blue_counter = get_counter(CountedTestEntity, colour='blue-key-name')
+		red_start = red_counter.count()
+		blue_start = blue_counter.count()
+		CountedTestEntity(key_name='overwritten', colour='red-key-name').put()
+		
+		#test 1 - an unchanged overwrite is not counted
+		CountedTestEntity(key_name='overwritten', colour='red-key-name').put()
+		self.assertTrue(red_counter.count() == red_start + 1)
+		
+		#test 2 - a changed overwrite moves the entity between counters
+		CountedTestEntity(key_name='overwritten', colour='blue-key-name').put()
+		self.assertTrue(red_counter.count() == red_start)
+		self.assertTrue(blue_counter.count() == blue_start + 1)
+		
+		#test 3 - deleting an instance that was never fetched or put uncounts
+		#the stored entity
+		CountedTestEntity(key_name='overwritten', colour='red-key-name')\
+			.delete()
+		self.assertTrue(red_counter.count() == red_start)
+		self.assertTrue(blue_counter.count() == blue_start)
+		
+		#test 4 - an instance known to be new is counted without a lookup
+		CountedTestEntity(key_name='new-key-name', colour='red-key-name')\
+			.put(new=True)
+		self.assertTrue(red_counter.count() == red_start + 1)
+		CountedTestEntity.get_by_key_name('new-key-name').delete()
+		self.assertTrue(red_counter.count() == red_start)
+	
+	def test_put_in_transaction(self):
+		'''Tests that counters are updated by a task when an entity is put in
+		a transaction'''
+		
+		taskqueue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+		taskqueue_stub.FlushQueue('default')
+		counter = get_counter(CountedTestEntity, colour='red-transaction')
+		start = counter.count()
+		
+		#test 1 - the put succeeds, and the counters are not yet updated
+		db.run_in_transaction(
+					lambda: CountedTestEntity(colour='red-transaction').put())
+		self.assertTrue(counter.count() == start)
+		
+		#test 2 - the task updates the counters
+		tasks = taskqueue_stub.GetTasks('default')
+		self.assertTrue(len(tasks) == 1)
+		deferred.run(base64.b64decode(tasks[0]['body']))
+		self.assertTrue(counter.count() == start + 1)
+		taskqueue_stub.FlushQueue('default')
+	
+	def test_get_counter(self):
+		'''Tests get_counter() only returns counters for counted filters'''
+		
+		self.assertTrue(get_counter(CountedTestEntity, colour='red').name ==
+					get_counter(CountedTestEntity, colour=u'red').name)
+		self.assertTrue(get_counter(CountedTestEntity, colour='red').name !=
+					get_counter(CountedTestEntity, colour='blue').name)
+		self.assertRaises(TypeError, get_counter, CountedTestEntity, 
+						name='red')
+	
+	def test_get_query_counter(self):
+		'''Tests get_query_counter() returns the counter of equality queries
+		of counted shapes only'''
+		
+		#test 1 - the counters of counted shapes are returned
+		self.assertTrue(get_query_counter(CountedTestEntity.all()).name ==
+					get_counter(CountedTestEntity).name)
+		self.assertTrue(get_query_counter(
+					CountedTestEntity.all().filter('colour =', 'red')).name ==
+					get_counter(CountedTestEntity, colour='red').name)
+		
+		#test 2 - other queries are rejected
+		self.assertRaises(TypeError, get_query_counter, 
+					CountedTestEntity.all().filter('colour >', 'red'))
+		self.assertRaises(TypeError, get_query_counter, 
+				CountedTestEntity.all().filter('colour IN', ['red', 'blue']))
+		self.assertRaises(TypeError, get_query_counter, 
+					CountedTestEntity.all().filter('name =', 'red'))
+	
+	def test_paged_query_page_count(self):
+		'''Tests that PagedQuery uses a counter instead of counting'''
+		
+		colour = 'green-page-count'
+		counter = get_counter(CountedTestEntity, colour=colour)
+		for i in range(5):
+			CountedTestEntity(colour=colour).put()
+		
+		q = PagedQuery(CountedTestEntity.all().filter('colour =', colour), 2,
+					counter=counter)
+		self.assertTrue(q.page_count() == 3)
+		self.assertTrue(q.has_page(3))
+		self.assertFalse(q.has_page(4))
+		self.assertTrue(q._num_count_calls == 0)
+		
+		#the counter is live, so new entities are reflected immediately
+		CountedTestEntity(colour=colour).put()
+		CountedTestEntity(colour=colour).put()
+		self.assertTrue(q.page_count() == 4)
+		
+		#a counter of another query is rejected
+		self.assertRaises(TypeError, PagedQuery, 
+					CountedTestEntity.all().filter('colour =', colour), 2,
+					counter=get_counter(CountedTestEntity, colour='red'))
+		
+class CountedTestEntity(CountedModel):
+	'''This is an entity to be used for testing purposes. It is intended to be
+	application agnostic'''
+	
+	counted_filters = ((), ('colour',))
+	
+	colour = db.StringProperty()
@@ -0,0 +1,82 @@
+import google.appengine.api.memcache as memcache
+from django.utils import simplejson
+
+from he3.db.tower.monitoring import QueryStats
+from gaeunit import GAETestCase
+
+class QueryStatsTest(GAETestCase):
+	'''Contains tests for the he3.db.tower.monitoring.QueryStats class'''
+
+	def test_record(self):
+		'''Tests that reports are totalled by fingerprint'''
+
+		stats = QueryStats('test-record')
+		stats.clear()
+		stats.record('a', {'offset_queries':1, 'datastore_time':0.5})
+		stats.record('a', {'offset_queries':2, 'datastore_time':0.25})
+		stats.record('b', {'offset_queries':0})
+
+		totals = stats.get_stats()
+		self.assertTrue(totals['a'] == {'offset_queries':3,
+									'datastore_time':0.75, 'reports':2})
+		self.assertTrue(totals['b'] == {'offset_queries':0, 'reports':1})
+		self.assertTrue(stats._num_flushes == 0)
+
+	def test_flush(self):
+		'''Tests that reports are flushed to memcache and combined there'''
+
+		stats = QueryStats('test-flush')
+		stats.buffer_size = 2
+		stats.clear()
+
+		#test 1 - filling the ring buffer flushes it
+		stats.record('a', {'offset_queries':1})
+		self.assertTrue(stats._num_flushes == 0)
+		stats.record('a', {'offset_queries':1})
+		self.assertTrue(stats._num_flushes == 1)
+		self.assertTrue(memcache.get(stats._get_memcache_key()) ==
+						{'a':{'offset_queries':2, 'reports':2}})
+
+		#test 2 - other instances add to the same totals
+		stats2 = QueryStats('test-flush')
+		stats2.record('a', {'offset_queries':1})
+		self.assertTrue(stats2.get_stats()['a']['offset_queries'] == 3)
+		stats2.flush()
+		self.assertTrue(stats.get_stats() ==
+						{'a':{'offset_queries':3, 'reports':3}})
+
+		#test 3 - reports are flushed once flush_interval has passed
+		stats3 = QueryStats('test-flush')
+		stats3.flush_interval = 0
+		stats3.record('b', {'offset_queries':1})
+		self.assertTrue(stats3._num_flushes == 1)
+		self.assertTrue(stats.get_stats()['b']['reports'] == 1)
+
+		#test 4 - totals that cannot be flushed are kept for the next flush
+		stats4 = QueryStats('test-flush')
+		stats4.cas_retries = 0
+		stats4.record('c', {'offset_queries':1})
+		stats4.flush()
+		self.assertTrue(stats4._num_flushes == 0)
+		self.assertTrue(memcache.get(stats4._get_memcache_key()).get('c') 
+						is None)
+		self.assertTrue(stats4.get_stats()['c']['reports'] == 1)
+		stats4.cas_retries = 3
+		stats4.flush()
+		self.assertTrue(stats4._num_flushes == 1)
+		self.assertTrue(stats.get_stats()['c'] == 
+						{'offset_queries':1, 'reports':1})
+
+		#test 5 - the ring buffer keeps the size it was created with
+		stats5 = QueryStats('test-flush')
+		stats5.buffer_size = 1
+		stats5.record('d', {'offset_queries':1})
+		self.assertTrue(stats5._num_flushes == 0)
+
+	def test_to_json(self):
+		'''Tests dumping the totals as JSON'''
+
+		stats = QueryStats('test-json')
+		stats.clear()
+		stats.record('a', {'offset_queries':1, 'datastore_time':0.5})
+		self.assertTrue(simplejson.loads(stats.to_json()) == stats.get_stats())
@@ -2,7 +2,11 @@ import logging
 import google.appengine.ext.db as db
 
 from datetime import date
-from he3.db.tower.paging import PagedQuery, PageLinks
+from he3.db.tower.paging import PagedQuery, PageLinks, PagedQueryBatch, \
+	UnionPagedQuery, \
+	PagedQueryState, query_fingerprint, encode_persisted_form, \
+	decode_persisted_form, paged_query_stats
+from he3.db.tower.caching import EntityCache, bump_generation
 from gaeunit import GAETestCase
 	
 class PagedQueryTest(GAETestCase):
@@ -633,7 +637,8 @@ class PagedQueryTest(GAETestCase):
 		
 	def test_id3(self):
 		#perform a fetch and ensure id does not change
-		#note a fetch_page() automatically clears cache and id will change
+		#note a fetch_page(clear=True) clears the cache but the regenerated
+		#id is the same since the query has not changed
 		q = self.util_create_persons_pagedQuery()
 		q_id = q.id
 		q_internal_id = q._id
@@ -641,7 +646,7 @@ class PagedQueryTest(GAETestCase):
 		persons = q.fetch_page(clear=True) #clears
 		
 		self.assertTrue(q._id != None)
-		self.assertTrue(q_id != q.id)
+		self.assertTrue(q_id == q.id)
 		
 		#a different fetch_page(x) shouldn't change the ID
 		q = self.util_create_persons_pagedQuery()
@@ -672,49 +677,51 @@ class PagedQueryTest(GAETestCase):
 		
 	def test_id_principle(self):
 		'''Tests the underlying principle for identifying queries'''
-		import pickle
-		
-		q1 = PersonTestEntity.all().ancestor(self.warwick)
-		q1_pickle = pickle.dumps(q1, 2)
-		q1_hash = hash(q1_pickle)
-		q1_str = str(q1_hash)
 		
-		q2 = q1.filter('name >', 'c')
-		q2_pickle = pickle.dumps(q2, 2)
-		q2_hash = hash(q2_pickle)
-		q2_str = str(q2_hash)
+		#test 1 - identical queries built separately share a fingerprint
+		q1 = PersonTestEntity.all().ancestor(self.warwick).order('-name')
+		q2 = PersonTestEntity.all().ancestor(self.warwick).order('-name')
+		self.assertTrue(query_fingerprint(q1) == query_fingerprint(q2))
+		self.assertTrue(len(query_fingerprint(q1)) == 40)
 		
-		self.assertTrue(q1_pickle != q2_pickle)
-		self.assertTrue(q1_hash != q2_hash)
-		self.assertTrue(q1_str != q2_str)
+		#test 2 - filters, orders and ancestors change the fingerprint
+		q1 = PersonTestEntity.all().ancestor(self.warwick)
+		q1_fingerprint = query_fingerprint(q1)
+		q1.filter('name >', 'c')
+		self.assertTrue(q1_fingerprint != query_fingerprint(q1))
 		
 		q1 = PersonTestEntity.all()
-		q1_pickle = pickle.dumps(q1, 2)
-		q1_hash = hash(q1_pickle)
-		q1_str = str(q1_hash)
+		q1_fingerprint = query_fingerprint(q1)
+		q1.order('-name')
+		self.assertTrue(q1_fingerprint != query_fingerprint(q1))
 		
-		q2 = q1.order('-name')
-		q2_pickle = pickle.dumps(q2, 2)
-		q2_hash = hash(q2_pickle)
-		q2_str = str(q2_hash)
-		
-		self.assertTrue(q1_pickle != q2_pickle)
-		self.assertTrue(q1_hash != q2_hash)
-		self.assertTrue(q1_str != q2_str)
-
+		q1 = PersonTestEntity.all().ancestor(self.warwick)
+		q2 = PersonTestEntity.all().ancestor(self.kate)
+		self.assertTrue(query_fingerprint(q1) != query_fingerprint(q2))
+		
+		#test 3 - filter values are compared by value, not identity
+		q1 = PersonTestEntity.all().filter('name =', 'Kate')
+		q2 = PersonTestEntity.all().filter('name =', u'Kate')
+		q3 = PersonTestEntity.all().filter('name =', 'Alex')
+		self.assertTrue(query_fingerprint(q1) == query_fingerprint(q2))
+		self.assertTrue(query_fingerprint(q1) != query_fingerprint(q3))
+		
+		#test 4 - fetching (and so moving the cursor) does not change the
+		#fingerprint
 		q1 = PersonTestEntity.all()
-		q1_pickle = pickle.dumps(q1, 2)
-		q1_hash = hash(q1_pickle)
-		q1_str = str(q1_hash)
-		
-		q2 = q1.fetch(2)
-		q2_pickle = pickle.dumps(q2, 2)
-		q2_hash = hash(q2_pickle)
-		q2_str = str(q2_hash)
-		
-		self.assertTrue(q1_pickle != q2_pickle)
-		self.assertTrue(q1_hash != q2_hash)
-		self.assertTrue(q1_str != q2_str)		
+		q1_fingerprint = query_fingerprint(q1)
+		q1.fetch(2)
+		self.assertTrue(q1_fingerprint == query_fingerprint(q1))
+		
+		#test 5 - GQL queries differ by bound arguments
+		q1 = PersonTestEntity.gql('WHERE ANCESTOR IS :parent', 
+								parent=self.warwick)
+		q2 = PersonTestEntity.gql('WHERE ANCESTOR IS :parent', 
+								parent=self.kate)
+		q3 = PersonTestEntity.gql('WHERE ANCESTOR IS :parent', 
+								parent=self.warwick)
+		self.assertTrue(query_fingerprint(q1) != query_fingerprint(q2))
+		self.assertTrue(query_fingerprint(q1) == query_fingerprint(q3))
 
 	def test_has_page(self):
 		'''Tests the has_page() method'''
@@ -774,6 +781,1003 @@ class PagedQueryTest(GAETestCase):
 		#logging.info(self.pagedQuery._num_count_calls)
 		self.assertTrue(page_count + 1 == self.pagedQuery._num_count_calls)		
 
+	def test_fetch_page_prewalk(self):
+		'''Tests that a pre-walking PagedQuery reaches deep pages by cursor'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					prewalk_budget=5)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - jumping to page 3 walks pages 1 and 2 keys-only and then
+		#uses a cursor for page 3
+		persons = q.fetch_page(3)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(persons[1].name == 'Kate')
+		self.assertTrue(q._num_prewalk_queries == 2)
+		self.assertTrue(q._num_offset_queries == 0)
+		self.assertTrue(q._num_cursor_queries == 1)
+		self.assertTrue(q._page_cursors[1] != None)
+		self.assertTrue(q._page_cursors[2] != None)
+		
+		#test 2 - walking past the end of the results returns an empty page
+		#without an offset query
+		persons = q.fetch_page(5)
+		self.assertTrue(len(persons)==0)
+		self.assertTrue(q._num_offset_queries == 0)
+		
+		#test 3 - the same applies to GqlQuery based PagedQueries
+		q = self.util_create_persons_GQL_pagedQuery()
+		q.prewalk_budget = 5
+		q.clear()
+		persons = q.fetch_page(3)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q._num_offset_queries == 0)
+		
+		#test 4 - a budget too small to reach the page falls back to an offset
+		#query from the furthest cursor walked
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					prewalk_budget=1)
+		q.order('birthdate').order('name').clear()
+		persons = q.fetch_page(3)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(persons[1].name == 'Kate')
+		self.assertTrue(q._num_prewalk_queries == 1)
+		self.assertTrue(q._num_offset_queries == 1)
+		
+		#test 5 - invalid budgets raise an exception
+		self.assertRaises(TypeError, q.__setattr__, 'prewalk_budget', -1)
+		self.assertRaises(TypeError, q.__setattr__, 'prewalk_budget', 1.5)
+		self.assertRaises(TypeError, PagedQuery, PersonTestEntity.all(), 2,
+						'invalid')
+
+	def test_fetch_page_entity_cache(self):
+		'''Tests fetch_page() resolving keys-only pages through an entity cache'''
+		
+		cache = EntityCache()
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					entity_cache=cache)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - pages are returned in order and cursors are still recorded
+		persons = q.fetch_page(1)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Warwick')
+		self.assertTrue(persons[1].name == 'Alex')
+		
+		persons = q.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(persons[1].name == 'Shannon')
+		self.assertTrue(q._num_offset_queries == 0)
+		self.assertTrue(cache._num_datastore_gets == 2)
+		
+		#test 2 - a second PagedQuery sharing the cache does not get the
+		#entities from the datastore again
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					entity_cache=cache)
+		persons = q2.order('birthdate').order('name').fetch_page(2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(cache._num_datastore_gets == 2)
+		
+		#test 3 - GqlQuery based PagedQueries are supported
+		q3 = self.util_create_persons_GQL_pagedQuery()
+		q3.entity_cache = EntityCache()
+		persons = q3.fetch_page(1, clear=True)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Warwick')
+
+	def test_checkpointed_persistence(self):
+		'''Tests that checkpointing bounds the cursors persisted'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 1,
+					checkpoint_interval=2)
+		q.recent_page_limit = 2
+		q.order('birthdate').order('name').clear()
+		for page_number in range(1, 7):
+			persons = q.fetch_page(page_number)
+		
+		#test 1 - cursors are persisted for checkpoint pages 3, 5 and 7 and
+		#for the recently used pages 6 and 7 only, by result offset
+		persisted_cursors = q._last_persisted_as['cursors']
+		self.assertTrue(sorted(persisted_cursors.keys()) == [2, 4, 5, 6])
+		self.assertTrue(q._last_persisted_as['recent_offsets'] == [5, 6])
+		
+		#test 2 - a new instance reaches a page between checkpoints by a
+		#small offset from the nearest checkpoint
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 1,
+					checkpoint_interval=2)
+		q2.order('birthdate').order('name')
+		persons = q2.fetch_page(4)
+		self.assertTrue(persons[0].name == 'Shannon')
+		self.assertTrue(q2._num_restore == 1)
+		self.assertTrue(q2._num_offset_queries == 1)
+		
+		persons = q2.fetch_page(5)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q2._num_offset_queries == 1)
+		
+		#test 3 - when there are too many checkpoints the interval doubles
+		q.max_checkpoints = 1
+		self.assertTrue(q._get_checkpoint_pages() == set([5, 6, 7]))
+		
+		#test 4 - invalid intervals raise an exception
+		self.assertRaises(TypeError, q.__setattr__, 'checkpoint_interval', -1)
+
+	def test_fetch_page_lookahead(self):
+		'''Tests that look-ahead pages are served without a datastore query'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					lookahead=True)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - fetching page 1 starts a look-ahead query for page 2, which 
+		#is stored by complete_lookahead()
+		persons = q.fetch_page(1)
+		self.assertTrue(q._lookahead != None)
+		q.complete_lookahead()
+		self.assertTrue(q._lookahead == None)
+		
+		#test 2 - a new instance is served page 2 from the stored page
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					lookahead=True)
+		persons = q2.order('birthdate').order('name').fetch_page(2)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(persons[1].name == 'Shannon')
+		self.assertTrue(q2._num_lookahead_hits == 1)
+		self.assertTrue(q2._num_cursor_queries == 0)
+		
+		#test 3 - the cursor for page 3 was still recorded
+		self.assertTrue(q2._has_cursor_for_page(3))
+		q2.complete_lookahead()
+		persons = q2.fetch_page(3)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q2._num_lookahead_hits == 2)
+		
+		#test 4 - without lookahead, stored pages are not used
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		persons = q3.order('birthdate').order('name').fetch_page(2)
+		self.assertTrue(q3._num_lookahead_hits == 0)
+		self.assertTrue(q3._num_cursor_queries == 1)
+		
+		#test 5 - stored pages are only looked for if the persisted state 
+		#records a recent look-ahead
+		self.assertTrue(q3._has_lookahead(2))
+		q4 = self.util_create_ordered_persons_pagedQuery(lookahead=True, 
+												attrs={'lookahead_time':0})
+		persons = q4.fetch_page(2)
+		self.assertFalse(q4._has_lookahead(2))
+		self.assertTrue(q4._num_lookahead_hits == 0)
+		self.assertTrue(q4._num_cursor_queries == 1)
+
+	def test_fetch_page_page_cache(self):
+		'''Tests that cached pages are served until the generation changes'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					page_cache=True)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - the first fetch of a page queries the datastore
+		persons = q.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(q._num_page_cache_hits == 0)
+		self.assertTrue(q._num_offset_queries == 1)
+		
+		#test 2 - a new instance is served the page from the cache, and
+		#still learns the cursor for the next page
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					page_cache=True)
+		persons = q2.order('birthdate').order('name').fetch_page(2)
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(persons[1].name == 'Shannon')
+		self.assertTrue(q2._num_page_cache_hits == 1)
+		self.assertTrue(q2._num_cursor_queries == 0)
+		self.assertTrue(q2._num_offset_queries == 0)
+		self.assertTrue(q2._has_cursor_for_page(3))
+		
+		#test 3 - once the kind's generation changes the cache is not used
+		bump_generation(PersonTestEntity.kind())
+		persons = q2.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(q2._num_page_cache_hits == 1)
+		self.assertTrue(q2._num_cursor_queries == 1)
+		
+		#test 4 - the generation is read once per instance unless it is 
+		#changed in this process
+		import google.appengine.api.memcache as memcache
+		from he3.db.tower import caching
+		memcache.incr(caching._get_generation_key(PersonTestEntity.kind()))
+		persons = q2.fetch_page(2)
+		self.assertTrue(q2._num_page_cache_hits == 2)
+		q3 = self.util_create_ordered_persons_pagedQuery(page_cache=True)
+		persons = q3.fetch_page(2)
+		self.assertTrue(q3._num_page_cache_hits == 0)
+
+	def test_two_tier_persistence(self):
+		'''Tests restoring persisted information from each persistence layer'''
+		import google.appengine.api.memcache as memcache
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q.order('birthdate').order('name').clear()
+		persons = q.fetch_page(1)
+		persons = q.fetch_page(2)
+		memcache.delete(q._get_memcache_key())
+		
+		#test 1 - a new instance restores from the in-process cache without
+		#memcache
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		persons = q2.order('birthdate').order('name').fetch_page(3)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q2._num_local_restore == 1)
+		self.assertTrue(q2._num_offset_queries == 0)
+		
+		#test 2 - once the in-process copy is too old, memcache is used
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q3.local_state_time = 0
+		persons = q3.order('birthdate').order('name').fetch_page(3)
+		self.assertTrue(q3._num_local_restore == 0)
+		self.assertTrue(q3._num_restore == 1)
+		
+		#test 3 - with datastore fallback, information evicted from memcache
+		#is restored from the datastore
+		q4 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					datastore_fallback=True)
+		q4.order('birthdate').order('name').clear()
+		persons = q4.fetch_page(1)
+		persons = q4.fetch_page(2)
+		memcache.delete(q4._get_memcache_key())
+		
+		q5 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					datastore_fallback=True)
+		q5.local_state_time = 0
+		persons = q5.order('birthdate').order('name').fetch_page(3)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q5._num_restore == 1)
+		self.assertTrue(q5._num_offset_queries == 0)
+		self.assertTrue(memcache.get(q5._get_memcache_key()) != None)
+		
+		#test 4 - clearing removes the datastore copy
+		q5.clear()
+		self.assertTrue(PagedQueryState.get_by_key_name(
+											q5._get_memcache_key()) == None)
+
+	def test_fetch_last_page(self):
+		'''Tests fetching pages near the end of the results in reverse'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2, 
+					count_ttl=60)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - the last page is fetched in reverse once counted
+		persons = q.fetch_last_page()
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(persons[1].name == 'Kate')
+		self.assertTrue(q._num_count_calls == 1)
+		self.assertTrue(q._num_reverse_queries == 1)
+		self.assertTrue(q._num_offset_queries == 0)
+		
+		#test 2 - earlier pages continue from the reverse cursor
+		persons = q.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(persons[1].name == 'Shannon')
+		self.assertTrue(q._num_reverse_queries == 2)
+		self.assertTrue(q._num_offset_queries == 0)
+		
+		#test 3 - a new instance restores the count and needs no offset
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2,
+					count_ttl=60)
+		persons = q2.order('birthdate').order('name').fetch_last_page()
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q2._num_count_calls == 0)
+		self.assertTrue(q2._num_offset_queries == 0)
+		
+		#test 4 - descending orders are reversed
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 4,
+					count_ttl=60)
+		persons = q3.order('-name').fetch_last_page()
+		self.assertTrue(len(persons)==2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(persons[1].name == 'Alex')
+		self.assertTrue(q3._num_reverse_queries == 1)
+		
+		#test 5 - GqlQuery pages are fetched going forward
+		persons = self.pagedGqlQuery.fetch_last_page()
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(self.pagedGqlQuery._num_reverse_queries == 0)
+		self.assertTrue(self.pagedGqlQuery._num_offset_queries == 1)
+		
+		#test 6 - without a count_ttl, the count may be stale, so pages are
+		#fetched going forward
+		q4 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 4)
+		persons = q4.order('-name').fetch_last_page()
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q4._num_reverse_queries == 0)
+		self.assertTrue(q4._num_offset_queries == 1)
+		
+		#test 7 - an inequality filter's property is sorted by first, even
+		#without an order on it
+		q5 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick)
+						.filter('name >', 'B'), 2, count_ttl=60)
+		q5.clear()
+		persons = q5.fetch_last_page()
+		self.assertTrue([p.name for p in persons] == ['Warwick'])
+		self.assertTrue(q5._num_reverse_queries == 1)
+		persons = q5.fetch_page(2)
+		self.assertTrue([p.name for p in persons] == ['Richard', 'Shannon'])
+		self.assertTrue(q5._num_reverse_queries == 2)
+
+	def test_iter_pages(self):
+		'''Tests generating successive pages'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - all pages are generated, moving forward by cursor, and 
+		#persisted once
+		pages = [[p.name for p in persons] for persons in q.iter_pages()]
+		self.assertTrue(pages == [['Warwick', 'Alex'], ['Richard', 'Shannon'],
+								['Colleen', 'Kate']])
+		self.assertTrue(q._num_offset_queries == 0)
+		self.assertTrue(q._num_cursor_queries == 3)
+		self.assertTrue(q._num_persist == 1)
+		
+		#test 2 - a new instance generates a range of pages from the 
+		#restored cursors
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q2.order('birthdate').order('name')
+		pages = [[p.name for p in persons] for persons in q2.iter_pages(2, 3)]
+		self.assertTrue(pages == [['Richard', 'Shannon']])
+		self.assertTrue(q2._num_restore == 1)
+		self.assertTrue(q2._num_offset_queries == 0)
+		
+		#test 3 - state is persisted every iter_persist_interval pages
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 1)
+		q3.iter_persist_interval = 2
+		q3.order('birthdate').order('name').clear()
+		for persons in q3.iter_pages():
+			pass
+		self.assertTrue(len(q3._page_cursors) == 7)
+		self.assertTrue(q3._num_persist == 4)
+
+	def test_concurrent_persistence(self):
+		'''Tests that instances of the same query merge persisted cursors'''
+		import google.appengine.api.memcache as memcache
+		
+		q1 = self.util_create_ordered_persons_pagedQuery()
+		persons = q1.fetch_page(1, clear=True)
+		
+		#another instance learns the cursor for page 4
+		q2 = self.util_create_ordered_persons_pagedQuery(
+												attrs={'local_state_time':0})
+		persons = q2.fetch_page(3)
+		self.assertTrue(q2._has_cursor_for_page(4))
+		
+		#test 1 - persisting the first instance keeps the other's cursor
+		persons = q1.fetch_page(2)
+		self.assertTrue(q1._has_cursor_for_page(3))
+		self.assertTrue(q1._has_cursor_for_page(4))
+		persisted_form = decode_persisted_form(
+							memcache.Client().get(q1._get_memcache_key()))
+		self.assertTrue(persisted_form['cursors'][4] == q1._page_cursors[2])
+		self.assertTrue(persisted_form['cursors'][6] == q1._page_cursors[3])
+		self.assertTrue(q1._last_persisted_as == persisted_form)
+		
+		#test 2 - cursors held take precedence over merged ones
+		q1._merge_persisted_form({'cursors':{2:'other'}, 'recent_offsets':[],
+								'min_result_count':None})
+		self.assertTrue(q1._page_cursors[1] != 'other')
+		
+		#test 3 - a form read by the restore is written without reading it 
+		#again, unless another instance wrote it since
+		q3 = self.util_create_ordered_persons_pagedQuery(
+												attrs={'local_state_time':0})
+		q3._restore_if_required()
+		q3._persist(q3._get_persisted_form())
+		self.assertTrue(q3._num_cas_retries == 0)
+		
+		q3 = self.util_create_ordered_persons_pagedQuery(
+												attrs={'local_state_time':0})
+		q3._restore_if_required()
+		memcache.Client().set(q1._get_memcache_key(), 
+							encode_persisted_form(q1._last_persisted_as))
+		q3._persist(q3._get_persisted_form())
+		self.assertTrue(q3._num_cas_retries == 1)
+		self.assertTrue(q3._has_cursor_for_page(4))
+
+	def test_stats(self):
+		'''Tests the statistics of a PagedQuery and their aggregation'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q.order('birthdate').order('name').clear()
+		q.collect_stats = True
+		paged_query_stats.clear()
+		
+		#test 1 - the statistics of the instance
+		persons = q.fetch_page(2)
+		stats = q.get_stats()
+		self.assertTrue(stats['offset_queries'] == 1)
+		self.assertTrue(stats['cursor_queries'] == 0)
+		self.assertTrue(stats['persist'] == 1)
+		self.assertTrue(stats['entity_cache_time'] == 0)
+		
+		#test 2 - the changes of each fetch are aggregated by query id
+		persons = q.fetch_page(3)
+		totals = paged_query_stats.get_stats()[q.id]
+		self.assertTrue(totals['reports'] == 2)
+		self.assertTrue(totals['offset_queries'] == 1)
+		self.assertTrue(totals['cursor_queries'] == 1)
+		self.assertTrue(totals['persist'] == 2)
+		
+		#test 3 - nothing is reported without collect_stats, the default
+		q2 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		persons = q2.order('birthdate').order('name').fetch_page(3)
+		self.assertTrue(paged_query_stats.get_stats()[q.id]['reports'] == 2)
+
+	def test_count_pages(self):
+		'''Tests counting pages up to a limit without counting the results'''
+		
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 2)
+		q.order('birthdate').order('name').clear()
+		
+		#test 1 - pages up to the limit are found by one keys-only query, 
+		#which records the cursor of the following page
+		self.assertTrue(q.count_pages(2) == 2)
+		self.assertTrue(q._num_count_pages_queries == 1)
+		self.assertTrue(q._num_count_calls == 0)
+		self.assertTrue(q._has_cursor_for_page(3))
+		self.assertTrue(q._page_count == None)
+		
+		#test 2 - reaching the end of the results from the furthest cursor
+		#finds the number of pages
+		self.assertTrue(q.count_pages(10) == 3)
+		self.assertTrue(q._num_count_pages_queries == 2)
+		self.assertTrue(q._page_count == 3)
+		
+		#test 3 - once the number of pages is known no query is made
+		self.assertTrue(q.count_pages(2) == 2)
+		self.assertTrue(q.page_count() == 3)
+		self.assertTrue(q._num_count_pages_queries == 2)
+		self.assertTrue(q._num_count_calls == 0)
+		
+		#test 4 - only the results of the pages from start are fetched
+		q2 = self.util_create_ordered_persons_pagedQuery()
+		q2.clear()
+		self.assertTrue(q2.count_pages(3, 3) == 3)
+		self.assertTrue(q2._num_count_pages_queries == 1)
+		self.assertFalse(q2._has_cursor_for_page(3))
+		self.assertTrue(q2._has_cursor_for_page(4))
+		
+		#test 5 - pages are counted if the results end before start
+		q2.clear()
+		self.assertTrue(q2.count_pages(5, 5) == 3)
+		self.assertTrue(q2._num_count_pages_queries == 2)
+		
+		#test 6 - merged queries count only the results of the pages
+		q3 = self.util_create_persons_IN_pagedQuery()
+		q3.clear()
+		self.assertTrue(q3.count_pages(2) == 2)
+		self.assertTrue(q3._result_count is None)
+		self.assertTrue(q3.count_pages(10) == 4)
+		self.assertTrue(q3._result_count == 4)
+		self.assertTrue(q3._num_count_pages_queries == 2)
+		self.assertTrue(q3._num_count_calls == 0)
+
+	def test_merged_query(self):
+		'''Tests paging queries with IN and != filters'''
+		
+		#test 1 - the results of the sub-queries are merged in order, 
+		#moving from page to page by cursor
+		q = self.util_create_persons_IN_pagedQuery()
+		q.clear()
+		self.assertTrue(q._is_merged())
+		names = [q.fetch_page(n)[0].name for n in range(1, 5)]
+		self.assertTrue(names == ['Alex', 'Colleen', 'Kate', 'Shannon'])
+		self.assertTrue(q.fetch_page(5) == [])
+		self.assertTrue(q._num_offset_queries == 0)
+		self.assertTrue(len(q._page_cursors[2].split(' ')) == 4)
+		
+		#test 2 - a new instance fetches a deep page from its restored cursor
+		q2 = self.util_create_persons_IN_pagedQuery()
+		persons = q2.fetch_page(4)
+		self.assertTrue(persons[0].name == 'Shannon')
+		self.assertTrue(q2._num_offset_queries == 0)
+		self.assertTrue(q2._num_cursor_queries == 1)
+		
+		#test 3 - descending orders, a != filter and offsets
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick)
+						.filter('name !=', 'Warwick').order('-name'), 2)
+		q3.clear()
+		persons = q3.fetch_page(3)
+		self.assertTrue([p.name for p in persons] == ['Alex'])
+		self.assertTrue(q3._num_offset_queries == 1)
+		persons = q3.fetch_page(1)
+		self.assertTrue([p.name for p in persons] == ['Shannon', 'Richard'])
+		persons = q3.fetch_page(2)
+		self.assertTrue([p.name for p in persons] == ['Kate', 'Colleen'])
+		self.assertTrue(q3._num_cursor_queries == 1)
+		
+		#test 4 - a result matching several sub-queries is not repeated at
+		#the start of the next page
+		q4 = UnionPagedQuery([
+				PersonTestEntity.all().ancestor(self.warwick)
+					.filter('name <', 'L').order('name'),
+				PersonTestEntity.all().ancestor(self.warwick)
+					.filter('name >', 'B').order('name')], 2)
+		q4.clear()
+		pages = [[p.name for p in q4.fetch_page(n)] for n in range(1, 4)]
+		self.assertTrue(pages == [['Alex', 'Colleen'], ['Kate', 'Richard'],
+								['Shannon', 'Warwick']])
+		self.assertTrue(q4._num_offset_queries == 0)
+		self.assertTrue(q4._num_rebase_queries == 0)
+		
+		#test 5 - a duplicate is discarded wherever it appears in the page
+		(alex, kate) = [PersonTestEntity.all().ancestor(self.warwick)
+					.filter('name =', name).get() for name in ('Alex', 'Kate')]
+		(merged, used) = q4._merge_sub_results([[alex, kate], [kate, alex]], 3)
+		self.assertTrue([p.name for p in merged] == ['Alex', 'Kate'])
+		self.assertTrue(used == [2, 2])
+
+	def test_union_query(self):
+		'''Tests paging the union of queries of different kinds'''
+		
+		PetTestEntity(name='Rex', birthdate=date(year=1979,month=1,day=1)).put()
+		PetTestEntity(name='Tibbles', 
+					birthdate=date(year=1981,month=1,day=1)).put()
+		
+		#test 1 - pages of the merged results, moving forward by cursor
+		q = self.util_create_persons_pets_union_pagedQuery()
+		q.clear()
+		pages = [[p.name for p in q.fetch_page(n)] for n in range(1, 4)]
+		self.assertTrue(pages == [['Warwick', 'Alex', 'Rex'], 
+								['Richard', 'Shannon', 'Tibbles'], 
+								['Colleen', 'Kate']])
+		self.assertTrue(q._num_offset_queries == 0)
+		self.assertTrue(q._num_cursor_queries == 2)
+		
+		#test 2 - a new instance has the same id and restores the cursors
+		q2 = self.util_create_persons_pets_union_pagedQuery()
+		self.assertTrue(q2.id == q.id)
+		persons = q2.fetch_page(3)
+		self.assertTrue([p.name for p in persons] == ['Colleen', 'Kate'])
+		self.assertTrue(q2._num_cursor_queries == 1)
+		
+		#test 3 - counting and fetching the merged results
+		self.assertTrue(q2.count() == 8)
+		self.assertTrue(q2.page_count() == 3)
+		self.assertTrue([p.name for p in q2.fetch(2, 1)] == ['Alex', 'Rex'])
+		
+		#test 4 - the queries can not be altered, and must be db.Query objects
+		#with the same sort orders
+		self.assertRaises(TypeError, q2.filter, 'name >', 'C')
+		self.assertRaises(TypeError, UnionPagedQuery, 
+						[PersonTestEntity.gql('ORDER BY name')], 3)
+		self.assertRaises(TypeError, UnionPagedQuery, 
+						[PersonTestEntity.all().order('name'),
+						PetTestEntity.all().order('-name')], 3)
+
+	def test_bookmarks(self):
+		'''Tests paging statelessly from signed bookmarks'''
+		
+		#test 1 - nothing is persisted, and only known cursors are bookmarked
+		q = self.util_create_ordered_persons_pagedQuery(2, 
+												bookmark_secret='secret')
+		q.clear()
+		q.fetch_page(1)
+		self.assertTrue(q._num_persist == 0)
+		self.assertTrue(q.get_bookmark(1) is None)
+		bookmark = q.get_bookmark(2)
+		self.assertTrue(bookmark)
+		self.assertTrue(q.get_bookmark(3) is None)
+		
+		#test 2 - a new instance starts from the bookmark without restoring
+		q2 = self.util_create_ordered_persons_pagedQuery(2, 
+												bookmark_secret='secret')
+		persons = q2.fetch_page(2, bookmark=bookmark)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(persons[1].name == 'Shannon')
+		self.assertTrue(q2._num_cursor_queries == 1)
+		self.assertTrue(q2._num_offset_queries == 0)
+		self.assertTrue(q2._num_restore == 0)
+		self.assertTrue(q2._num_local_restore == 0)
+		
+		#test 3 - bookmarks signed with another secret or tampered with are
+		#ignored
+		tampered = bookmark[:20] + (bookmark[20] == 'A' and 'B' or 'A')\
+			+ bookmark[21:]
+		for (secret, b) in [('other', bookmark), ('secret', tampered)]:
+			q3 = self.util_create_ordered_persons_pagedQuery(2, 
+												bookmark_secret=secret)
+			q3.fetch_page(2, bookmark=b)
+			self.assertTrue(q3._num_cursor_queries == 0)
+			self.assertTrue(q3._num_offset_queries == 1)
+		
+		#test 4 - bookmarks can be used with other page sizes
+		q4 = self.util_create_ordered_persons_pagedQuery(1, 
+												bookmark_secret='secret')
+		persons = q4.fetch_page(3, bookmark=bookmark)
+		self.assertTrue(persons[0].name == 'Richard')
+		self.assertTrue(q4._num_cursor_queries == 1)
+		
+		#test 5 - page links carry the bookmarks
+		myLinks = PageLinks(2, 3, '/blah', 'page', paged_query=q2, 
+						bookmark_field='bm').get_links()
+		self.assertTrue(myLinks[1] == ('1', '/blah?page=1'))
+		self.assertTrue(myLinks[2] == 
+						('2', '/blah?page=2&bm=' + q2.get_bookmark(2)))
+		self.assertTrue(myLinks[-1] == 
+						('Next', '/blah?page=3&bm=' + q2.get_bookmark(3)))
+		
+		#test 6 - bookmarks require a secret
+		self.assertRaises(TypeError, self.pagedQuery.get_bookmark, 2)
+		
+		#test 7 - no memcache calls are made, even for a look-ahead, the page
+		#cache or the number of pages
+		from google.appengine.api import apiproxy_stub_map
+		stub = apiproxy_stub_map.apiproxy.GetStub('memcache')
+		calls = []
+		def make_sync_call(service, call, request, response):
+			calls.append(call)
+			return stub.__class__.MakeSyncCall(stub, service, call, request, 
+											response)
+		stub.MakeSyncCall = make_sync_call
+		try:
+			q7 = self.util_create_ordered_persons_pagedQuery(2, 
+					bookmark_secret='secret', lookahead=True, page_cache=True)
+			q7.clear()
+			persons = q7.fetch_page(2, bookmark=bookmark)
+			q7.complete_lookahead()
+			persons = q7.fetch_page(3)
+			self.assertTrue(q7.page_count() == 3)
+			self.assertTrue(q7.count_all() == (6, False))
+		finally:
+			del stub.MakeSyncCall
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(calls == [])
+	
+	def test_learned_page_count(self):
+		'''Tests learning the number of results from the pages fetched'''
+		
+		q = self.util_create_ordered_persons_pagedQuery(4)
+		q.clear()
+		
+		#test 1 - a full page gives a lower bound, used by count_pages()
+		persons = q.fetch_page(1)
+		self.assertTrue(q._min_result_count == 4)
+		self.assertTrue(q._page_count is None)
+		self.assertTrue(q.count_pages(1) == 1)
+		self.assertTrue(q._num_count_pages_queries == 0)
+		
+		#test 2 - a short page gives the exact number
+		persons = q.fetch_page(2)
+		self.assertTrue(q._result_count == 6)
+		self.assertTrue(q.page_count() == 2)
+		self.assertFalse(q.has_page(3))
+		self.assertTrue(q._num_count_calls == 0)
+		
+		#test 3 - the number is persisted
+		q2 = self.util_create_ordered_persons_pagedQuery(4)
+		self.assertTrue(q2.page_count() == 2)
+		self.assertTrue(q2._num_count_calls == 0)
+		
+		#test 3b - learning the same number again keeps the time it was 
+		#counted at
+		q2._counted_at -= 1
+		counted_at = q2._counted_at
+		persons = q2.fetch_page(2)
+		self.assertTrue(q2._result_count == 6)
+		self.assertTrue(q2._counted_at == counted_at)
+		
+		#test 4 - an empty page following a full one gives the exact number
+		q3 = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 3)
+		q3.order('name').clear()
+		for page_number in range(1, 4):
+			persons = q3.fetch_page(page_number)
+		self.assertTrue(q3._result_count == 6)
+		self.assertTrue(q3._num_count_calls == 0)
+		
+		#test 5 - the number is counted again once older than count_ttl
+		q4 = self.util_create_ordered_persons_pagedQuery(4, count_ttl=60)
+		q4.id
+		q4._restore_if_required()
+		self.assertTrue(q4.page_count() == 2)
+		self.assertTrue(q4._num_count_calls == 0)
+		q4._counted_at -= 120
+		self.assertTrue(q4.page_count() == 2)
+		self.assertTrue(q4._num_count_calls == 1)
+	
+	def test_count_all(self):
+		'''Tests counting the results in batches chained by cursor'''
+		
+		#count_batch_size is rounded down to one page
+		batched = {'count_batch_size':3}
+		
+		#test 1 - batches are counted past the batch size, recording the 
+		#cursor at the end of each
+		q = self.util_create_ordered_persons_pagedQuery(attrs=batched)
+		q.clear()
+		self.assertTrue(q.count_all() == (6, False))
+		self.assertTrue(q._num_count_batches == 4)
+		self.assertTrue(q._num_count_calls == 1)
+		self.assertTrue(q._has_cursor_for_page(4))
+		
+		#test 2 - the number is persisted
+		q2 = self.util_create_ordered_persons_pagedQuery(attrs=batched)
+		self.assertTrue(q2.count_all() == (6, False))
+		self.assertTrue(q2._num_count_batches == 0)
+		
+		#test 3 - a deadline gives an approximate lower bound, which 
+		#page_count() does not count further, even in a later instance
+		q3 = self.util_create_ordered_persons_pagedQuery(orders=('name',),
+														attrs=batched)
+		q3.clear()
+		self.assertTrue(q3.count_all(deadline=0) == (2, True))
+		self.assertTrue(q3.page_count() == 1)
+		self.assertTrue(q3._num_count_batches == 1)
+		q3 = self.util_create_ordered_persons_pagedQuery(orders=('name',),
+														attrs=batched)
+		self.assertTrue(q3.page_count() == 1)
+		self.assertTrue(q3._num_count_batches == 0)
+		
+		#test 4 - count_all() resumes from the furthest cursor
+		q4 = self.util_create_ordered_persons_pagedQuery(orders=('name',),
+														attrs=batched)
+		self.assertTrue(q4.count_all() == (6, False))
+		self.assertTrue(q4._num_count_batches == 3)
+		
+		#test 5 - count() counts every result given no limit
+		self.assertTrue(q4.count(limit=None) == 6)
+		
+		#test 6 - once the count expires, the results are counted again from
+		#the first page, as the cursors found before may no longer end pages
+		q5 = self.util_create_ordered_persons_pagedQuery(orders=('name',),
+										attrs=batched, count_ttl=60)
+		q5.clear()
+		self.assertTrue(q5.count_all() == (6, False))
+		self.kate.delete()
+		q5._counted_at -= 120
+		self.assertTrue(q5.count_all() == (5, False))
+		self.assertTrue(q5._num_count_batches == 7)
+	
+	def test_page_size_independence(self):
+		'''Tests that cursors are shared by PagedQuery objects of any page 
+		size'''
+		
+		restore = {'local_state_time':0}
+		q = self.util_create_ordered_persons_pagedQuery(2, attrs=restore)
+		q.clear()
+		for page_number in range(1, 4):
+			persons = q.fetch_page(page_number)
+		
+		#test 1 - pages starting at a known offset are fetched by cursor
+		q2 = self.util_create_ordered_persons_pagedQuery(4, attrs=restore)
+		persons = q2.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(q2._num_cursor_queries == 1)
+		self.assertTrue(q2._num_offset_queries == 0)
+		
+		#test 2 - other pages start from the nearest cursor before them
+		q3 = self.util_create_ordered_persons_pagedQuery(3, attrs=restore)
+		persons = q3.fetch_page(2)
+		self.assertTrue(persons[0].name == 'Shannon')
+		self.assertTrue(q3._num_offset_queries == 1)
+		self.assertTrue(q3._get_nearest_cursor(2)
+						== (q3._offset_cursors[2], 1))
+		
+		#test 3 - cursors found by every page size are persisted together
+		persisted_form = q3._last_persisted_as
+		self.assertTrue(sorted(persisted_form['cursors'].keys()) == [2, 4, 6])
+		
+		#test 4 - changing the page size keeps the cursors
+		q.page_size = 4
+		self.assertTrue(q._has_cursor_for_page(2))
+		self.assertTrue(sorted(q._offset_cursors.keys()) == [2, 6])
+	
+	def test_warm(self):
+		'''Tests that warming replaces the persisted state with cursors and a
+		count learned afresh'''
+		
+		restore = {'local_state_time':0}
+		q = self.util_create_ordered_persons_pagedQuery(attrs=restore)
+		q.clear()
+		self.assertTrue(q.count_all() == (6, False))
+		PersonTestEntity(parent=self.warwick, name='Zed', 
+						birthdate=date(year=1990,month=1,day=1)).put()
+		
+		#test 1 - the first pages are walked one at a time, then the rest of
+		#the results are counted
+		q = self.util_create_ordered_persons_pagedQuery(attrs=restore)
+		q.warm(2)
+		self.assertTrue(q._num_prewalk_queries == 2)
+		self.assertTrue(q._num_count_batches == 1)
+		self.assertTrue(q._has_cursor_for_page(3))
+		
+		#test 2 - the stale count is replaced in the persisted state
+		q2 = self.util_create_ordered_persons_pagedQuery(attrs=restore)
+		self.assertTrue(q2.page_count() == 4)
+		self.assertTrue(q2._num_count_calls == 0)
+		self.assertTrue(q2._has_cursor_for_page(3))
+		
+		#test 3 - should fail due to a bad number of pages
+		self.assertRaises(TypeError, q2.warm, -1)
+	
+	def test_cursor_retention(self):
+		'''Tests that the cursors of the pages with the fewest hits are left
+		out of persisted forms over max_persisted_size'''
+		
+		q = self.util_create_ordered_persons_pagedQuery(1, 
+						attrs={'local_state_time':0, 'hit_persist_interval':0,
+						'max_persisted_size':1000000}, checkpoint_interval=2)
+		q.clear()
+		for page_number in [1, 2, 3, 4, 5, 6, 4, 4, 6]:
+			q.fetch_page(page_number)
+		
+		#test 1 - every cursor fits, and hits are persisted
+		persisted_form = q._get_persisted_form()
+		self.assertTrue(sorted(persisted_form['cursors'].keys()) == 
+						[1, 2, 3, 4, 5, 6])
+		q2 = self.util_create_ordered_persons_pagedQuery(1)
+		q2.id
+		q2._restore_if_required()
+		self.assertTrue(round(q2._page_hits[3][0]) == 3)
+		self.assertTrue(round(q2._page_hits[5][0]) == 2)
+		
+		#test 2 - the page with the fewest hits is left out first
+		q.max_persisted_size = len(encode_persisted_form(persisted_form)) - 1
+		self.assertTrue(sorted(q._get_persisted_form()['cursors'].keys()) == 
+						[2, 3, 4, 5, 6])
+		
+		#test 3 - checkpoint pages are always kept
+		q.max_persisted_size = 1
+		self.assertTrue(sorted(q._get_persisted_form()['cursors'].keys()) == 
+						[2, 4, 6])
+		
+		#test 4 - hits are kept for at most hit_page_limit pages
+		q.hit_page_limit = 2
+		q.fetch_page(6)
+		self.assertTrue(sorted(q._page_hits.keys()) == [3, 5])
+		
+		#test 5 - the furthest cursor and those walked by count_all() are 
+		#kept, though they have no hits
+		q3 = self.util_create_ordered_persons_pagedQuery(1, 
+						attrs={'max_persisted_size':1, 'count_batch_size':2})
+		q3.clear()
+		self.assertTrue(q3.count_all() == (6, False))
+		q3.fetch_page(1)
+		self.assertTrue(q3._has_cursor_for_page(2))
+		self.assertTrue(sorted(q3._get_persisted_form()['cursors'].keys()) == 
+						[2, 4, 6])
+		
+		#test 6 - a change of hits alone is persisted at most every 
+		#hit_persist_interval seconds
+		q4 = self.util_create_ordered_persons_pagedQuery(1, 
+						attrs={'max_persisted_size':1000000})
+		q4.clear()
+		q4.fetch_page(1)
+		q4.fetch_page(1)
+		self.assertTrue(q4._num_persist == 1)
+		q4.hit_persist_interval = 0
+		q4.fetch_page(1)
+		self.assertTrue(q4._num_persist == 2)
+		
+		#test 7 - the cursor of every retention_interval-th page is kept 
+		#without checkpointing
+		q5 = self.util_create_ordered_persons_pagedQuery(1, 
+				attrs={'max_persisted_size':1, 'retention_interval':3})
+		q5.clear()
+		for page_number in range(1, 5):
+			q5.fetch_page(page_number)
+		self.assertTrue(sorted(q5._get_persisted_form()['cursors'].keys()) == 
+						[3, 4])
+	
+	def test_persisted_form_encoding(self):
+		'''Tests the encoding of persisted forms'''
+		import google.appengine.api.memcache as memcache
+		import pickle
+		
+		pagedQuery = PagedQuery(PersonTestEntity.all().ancestor(self.warwick)
+							.order('name'), 2)
+		pagedQuery.clear()
+		persons = pagedQuery.fetch_page(3)
+		
+		#test 1 - memcache holds the encoded form
+		persisted_form = pagedQuery._get_persisted_form()
+		data = memcache.Client().get(pagedQuery._get_memcache_key())
+		self.assertTrue(isinstance(data, str))
+		self.assertTrue(decode_persisted_form(data) == persisted_form)
+		self.assertTrue(len(data) < len(pickle.dumps(persisted_form, 2)))
+		
+		#test 2 - checkpointed forms, None cursors, unencoded cursors and 
+		#result counts
+		for persisted_form in [
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':None},
+				{'cursors':{2:'not a cursor', 4:None}, 'recent_offsets':[], 
+					'min_result_count':1000},
+				{'cursors':{6:persisted_form['cursors'][6]},
+					'recent_offsets':[6, 8], 'min_result_count':None},
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':None,
+					'result_count':0, 'reverse_cursors':{}},
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':8,
+					'counted_at':1234567890.5},
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':8,
+					'count_approximate':True},
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':None,
+					'page_hits':{0:(1.5, 1234567890), 4:(2.0, 1234567891)}},
+				{'cursors':{}, 'recent_offsets':[], 'min_result_count':None,
+					'lookahead_offsets':{2:1234567890.5}}]:
+			self.assertTrue(decode_persisted_form(
+							encode_persisted_form(persisted_form)) == persisted_form)
+		
+		#test 3 - unknown encodings are not restored
+		self.assertTrue(decode_persisted_form(None) is None)
+		self.assertTrue(decode_persisted_form(
+							pickle.dumps(persisted_form, 2)) is None)
+		
+		#test 4 - values that are not strings, and corrupt or truncated 
+		#encodings, are not restored
+		import zlib
+		data = encode_persisted_form(persisted_form)
+		version = data[0]
+		decompressed = zlib.decompress(data[1:])
+		for corrupt in [5, {'cursors':{}}, u'not a string', data[:1], 
+				data[:len(data) // 2], version + 'not compressed',
+				version + zlib.compress(decompressed[:-3]),
+				version + zlib.compress(decompressed + 'extra')]:
+			self.assertTrue(decode_persisted_form(corrupt) is None)
+
+	def test_batch(self):
+		'''Tests restoring and persisting PagedQuery objects as a batch'''
+		
+		#test 1 - fetching pages does not persist until the batch persists
+		(batch, by_name, by_birthdate) = self.util_create_persons_batch()
+		by_name.clear()
+		by_birthdate.clear()
+		batch.restore()
+		persons = by_name.fetch_page(1)
+		persons = by_birthdate.fetch_page(1)
+		persons = by_birthdate.fetch_page(2)
+		self.assertTrue(by_name._num_persist == 0)
+		self.assertTrue(by_birthdate._num_persist == 0)
+		
+		batch.persist()
+		self.assertTrue(batch._num_set_multi == 1)
+		self.assertTrue(batch._num_get_multi == 1)
+		self.assertTrue(by_name._num_persist == 1)
+		self.assertTrue(by_birthdate._num_persist == 1)
+		
+		#test 2 - a new batch restores both queries with one memcache call
+		(batch, by_name, by_birthdate) = self.util_create_persons_batch(
+													{'local_state_time':0})
+		batch.restore()
+		self.assertTrue(batch._num_get_multi == 1)
+		self.assertTrue(by_name._num_restore == 1)
+		self.assertTrue(by_birthdate._num_restore == 1)
+		
+		persons = by_birthdate.fetch_page(3)
+		self.assertTrue(persons[0].name == 'Colleen')
+		self.assertTrue(by_birthdate._num_offset_queries == 0)
+		
+		#test 3 - persisting without changes makes no memcache call
+		batch.persist()
+		persons = by_name.fetch_page(1)
+		batch.persist()
+		self.assertTrue(batch._num_set_multi == 1)
+		self.assertTrue(batch._num_get_multi == 1)
+		
+		#test 4 - queries restored from the in-process cache are read from
+		#memcache before they are written
+		(batch, by_name, by_birthdate) = self.util_create_persons_batch()
+		batch.restore()
+		self.assertTrue(batch._num_get_multi == 0)
+		persons = by_name.fetch_page(2)
+		batch.persist()
+		self.assertTrue(batch._num_get_multi == 1)
+		self.assertTrue(batch._num_set_multi == 1)
+		self.assertTrue(by_name._num_persist == 1)
+
 	def util_test_cursor_set(self, cursors):
 		'''utility function to test a set of cursors for validity'''
 		
@@ -789,6 +1793,45 @@ class PagedQueryTest(GAETestCase):
 		return PagedQuery(PersonTestEntity.all().ancestor(self.warwick),2)
 	
 	
+	def util_create_ordered_persons_pagedQuery(self, page_size=2, 
+							orders=('birthdate', 'name'), attrs=None, **kwds):
+		'''creates a new pagedQuery object for all PersonTestEntities
+		with Warwick entity as ancestor (includes Warwick), sorted by orders.
+		Keyword arguments are passed to PagedQuery, and attrs are set on the 
+		new object'''
+		q = PagedQuery(PersonTestEntity.all().ancestor(self.warwick), 
+					page_size, **kwds)
+		for order in orders: q.order(order)
+		for (name, value) in (attrs or {}).items(): setattr(q, name, value)
+		return q
+	
+	def util_create_persons_batch(self, attrs=None):
+		'''creates a new PagedQueryBatch with two pagedQuery objects 
+		registered, for all PersonTestEntities with Warwick entity as ancestor
+		by name and by birthdate. attrs are set on both pagedQuery objects'''
+		batch = PagedQueryBatch()
+		by_name = batch.register(self.util_create_ordered_persons_pagedQuery(
+												orders=('name',), attrs=attrs))
+		by_birthdate = batch.register(
+				self.util_create_ordered_persons_pagedQuery(attrs=attrs))
+		return (batch, by_name, by_birthdate)
+	
+	def util_create_persons_IN_pagedQuery(self):
+		'''creates a new pagedQuery object for four PersonTestEntities
+		with Warwick entity as ancestor, using an IN filter'''
+		return PagedQuery(PersonTestEntity.all().ancestor(self.warwick)
+						.filter('name IN', ['Alex', 'Colleen', 'Kate', 
+						'Shannon']).order('name'), 1)
+	
+	def util_create_persons_pets_union_pagedQuery(self):
+		'''creates a new pagedQuery object for the union of all 
+		PersonTestEntities with Warwick entity as ancestor and all 
+		PetTestEntities'''
+		return UnionPagedQuery([
+				PersonTestEntity.all().ancestor(self.warwick)
+					.order('birthdate').order('name'),
+				PetTestEntity.all().order('birthdate').order('name')], 3)
+	
 	def util_create_persons_GQL_pagedQuery(self):
 		'''creates a new pagedQuery object for all PersonTestEntities
 		using GQL'''
@@ -841,6 +1884,24 @@ class PagedQueryTest(GAETestCase):
 		logging.info([x[:6] if x else None for x in cursors])
 		
 	
+class PagesTestPagedQuery(object):
+	'''This is a stand-in for a PagedQuery with a number of pages, recording
+	the limits its pages are counted to'''
+	
+	def __init__(self, page_count):
+		self.page_count = page_count
+		self.limits = []
+	
+	def count_pages(self, limit):
+		self.limits.append(limit)
+		return min(self.page_count, limit)
+
+class PetTestEntity(db.Model):
+	'''This is a second kind of entity to be used for testing purposes'''
+	
+	name = db.StringProperty(required=True)
+	birthdate = db.DateProperty(default=None)
+
 class PersonTestEntity(db.Model):
 	'''This is an entity to be used for testing purposes. It is intended to be
 	application agnostic'''
@@ -854,6 +1915,32 @@ class PersonTestEntity(db.Model):
 class PageLinksTest(GAETestCase):
 	'''Contains tests for the utilities.db.pages.PageLinks class'''
 	
+	def test_lazy_page_count(self):
+		'''Tests page links counting only the pages they show'''
+		
+		#test 1 - more pages than are shown
+		pagedQuery = PagesTestPagedQuery(30)
+		pageLinks = PageLinks(2, None, '/blah', 'page', paged_query=pagedQuery)
+		myLinks = pageLinks.get_links()
+		self.assertTrue(pagedQuery.limits == [11])
+		self.assertTrue(len(myLinks) == 13) #ten pages + ... + 2
+		self.assertTrue(myLinks[-2] == ('...', None))
+		self.assertTrue(myLinks[-1][0] == 'Next')
+		
+		#test 2 - fewer pages than are shown
+		pagedQuery = PagesTestPagedQuery(3)
+		pageLinks = PageLinks(2, None, '/blah', 'page', paged_query=pagedQuery)
+		myLinks = pageLinks.get_links()
+		self.assertTrue(myLinks == PageLinks(2, 3, '/blah', 'page').get_links())
+		
+		#test 3 - pages either side of a later page
+		pagedQuery = PagesTestPagedQuery(30)
+		pageLinks = PageLinks(20, None, '/blah', 'page', 6, 
+							paged_query=pagedQuery)
+		myLinks = pageLinks.get_links()
+		self.assertTrue(pagedQuery.limits == [24])
+		self.assertTrue(len(myLinks) == 10) #7 pages + ... + 2
+		
 	def test_small_page_count(self):
 		
 		#test with default size
@@ -258,6 +258,35 @@ class PrefetchingQueryTest(GAETestCase):
 		self.assertTrue(prefetched_topic_inits < normal_topic_inits)
 		self.assertTrue(prefetched_parent_inits < normal_parent_inits)
 		
+	def test_dotted_paths(self):
+		'''Tests that references of references are prefetched a level at a 
+		time, fetching each entity once'''
+		
+		pfQuery = PrefetchingQuery(PostTestEntity.all().ancestor(self.bill)
+								, ('topic', 'parent.role', 'topic.parent'))
+		
+		PostTopicTestEntity.number_of_inits = 0
+		UserTestEntity.number_of_inits = 0
+		SecurityRoleTestEntity.number_of_inits = 0
+		
+		posts = pfQuery.fetch(100)
+		roles = [post.parent().role.role_name for post in posts]
+		topic_authors = [post.topic.parent().name for post in posts 
+						if post.topic]
+		
+		#test 1 - every path is resolved
+		self.assertTrue(roles == ['admin'] * 4)
+		self.assertTrue(topic_authors == ['bill'] * 3)
+		
+		#test 2 - entities reached by several paths are fetched once
+		self.assertTrue(PostTopicTestEntity.number_of_inits == 2)
+		self.assertTrue(UserTestEntity.number_of_inits == 1)
+		self.assertTrue(SecurityRoleTestEntity.number_of_inits == 1)
+		for post in posts:
+			self.assertTrue(post.parent() is posts[0].parent())
+			if post.topic: 
+				self.assertTrue(post.topic.parent() is posts[0].parent())
+		
 	def test_compatible_with_PagedQuery(self):
 		
 		from he3.db.tower.paging import PagedQuery
@@ -323,6 +352,13 @@ class SecurityRoleTestEntity(db.Model):
 	
 	properties_to_prefetch =('parent',)
 	
+	number_of_inits = 0
+	
+	def __init__(self, parent=None, key_name=None, _app=None, _from_entity=False
+				,**kwds):
+		SecurityRoleTestEntity.number_of_inits += 1
+		db.Model.__init__(self, parent, key_name, _app,_from_entity, **kwds)
+	
 	role_name = db.StringProperty(required=True)	
 	
 class UserTestEntity(db.Model):
@@ -0,0 +1,98 @@
+import google.appengine.ext.db as db
+from google.appengine.api import apiproxy_stub_map
+
+from he3.db.tower import warming
+from he3.db.tower.paging import PagedQuery, UnionPagedQuery
+from he3.db.tower.warming import WarmedModel, warm_in_background, \
+	warm_from_payload
+from gaeunit import GAETestCase
+
+class WarmingTest(GAETestCase):
+	'''Contains tests for he3.db.tower.warming'''
+
+	def setUp(self):
+		#avoid the interval ending part way through a test
+		self.warming_interval = warming.warming_interval
+		warming.warming_interval = 24 * 60 * 60
+		self.group = WarmedTestEntity(name='group', rank=0).put()
+		self.taskqueue_stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+		self.taskqueue_stub.FlushQueue(warming.warming_queue)
+
+	def tearDown(self):
+		warming.warming_interval = self.warming_interval
+		self.taskqueue_stub.FlushQueue(warming.warming_queue)
+
+	def test_warm_in_background(self):
+		'''Tests that a warming task is added once per query and interval'''
+
+		paged_query = PagedQuery(WarmedTestEntity.all().ancestor(self.group)
+								.order('-rank'), 2)
+
+		#test 1 - a task is added, named after the query
+		self.assertTrue(warm_in_background(paged_query))
+		tasks = self.taskqueue_stub.GetTasks(warming.warming_queue)
+		self.assertTrue(len(tasks) == 1)
+		self.assertTrue(paged_query.id in tasks[0]['name'])
+
+		#test 2 - no other task is added for the query in the same interval
+		self.assertFalse(warm_in_background(paged_query))
+		self.assertTrue(
+				len(self.taskqueue_stub.GetTasks(warming.warming_queue)) == 1)
+
+		#test 3 - writing a WarmedModel entity adds a task for its queries
+		WarmedTestEntity(parent=self.group, name='a', rank=1).put()
+		self.assertTrue(
+				len(self.taskqueue_stub.GetTasks(warming.warming_queue)) == 2)
+		WarmedTestEntity(parent=self.group, name='b', rank=2).put()
+		self.assertTrue(
+				len(self.taskqueue_stub.GetTasks(warming.warming_queue)) == 2)
+
+	def test_warm_from_payload(self):
+		'''Tests that a task payload warms the query it holds'''
+
+		db.put([WarmedTestEntity(parent=self.group, name=str(rank), rank=rank)
+				for rank in range(1, 6)])
+
+		#test 1 - the query's cursors and count are persisted
+		warmed = warm_from_payload(warming._get_payload(
+											self.util_create_pagedQuery(), 2))
+		self.assertTrue(warmed._num_prewalk_queries == 2)
+		q = self.util_create_pagedQuery()
+		self.assertTrue(q.page_count() == 3)
+		self.assertTrue(q._num_count_calls == 0)
+		self.assertTrue(q._has_cursor_for_page(3))
+
+		#test 2 - union queries are rebuilt as unions
+		union = UnionPagedQuery([WarmedTestEntity.all().ancestor(self.group)
+								.order('rank')], 2)
+		warmed = warm_from_payload(warming._get_payload(union, 2))
+		self.assertTrue(isinstance(warmed, UnionPagedQuery))
+		self.assertTrue(warmed.id == union.id)
+
+		#test 3 - class attributes overridden on the query are applied
+		q = self.util_create_pagedQuery()
+		q.max_persisted_size = 2000
+		q.count_batch_size = 100
+		warmed = warm_from_payload(warming._get_payload(q, 2))
+		self.assertTrue(warmed.max_persisted_size == 2000)
+		self.assertTrue(warmed.count_batch_size == 100)
+
+	def util_create_pagedQuery(self):
+		'''creates a new pagedQuery object for the WarmedTestEntities in the
+		test group, restoring from memcache every time'''
+		q = PagedQuery(WarmedTestEntity.all().ancestor(self.group)
+					.order('rank'), 2)
+		q.local_state_time = 0
+		return q
+
+
+class WarmedTestEntity(WarmedModel):
+	'''This is an entity to be used for testing purposes. It is intended to be
+	application agnostic'''
+
+	warmed_queries = (lambda entity: PagedQuery(WarmedTestEntity.all()
+						.ancestor(entity.parent_key() or entity.key())
+						.order('rank'), 2),)
+
+	name = db.StringProperty(required=True)
+	rank = db.IntegerProperty(required=True)